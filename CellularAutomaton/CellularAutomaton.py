@@ -4,18 +4,244 @@ import event_model
 import time
 import sys
 import copy
+import threading
+import layer_kernels
+import checkpoint
+import track_fit
+import track_selection
+import numpy as np
 from sklearn.decomposition import PCA
 
 NEXT_SENSOR = 2
 SECOND_NEXT_SENSOR = 4
+# Stages after which solve_checkpointed can save (and later resume from) the state of the solve
+STAGES = ("doublets", "neighbours", "ca", "tracks")
+# Parameters only used by the stages after each one, which may change when resuming from its checkpoint
+# (keep_intermediates and reuse_doublets do not change the tracks at all)
+LATER_PARAMETERS = {"doublets": ("max_tolerance", "max_scatter", "max_neighbours", "max_paths", "rank_by_fit"),
+                    "neighbours": ("max_paths", "rank_by_fit"), "ca": ("max_paths", "rank_by_fit"),
+                    "tracks": ("rank_by_fit",)}
+RESULT_NEUTRAL_PARAMETERS = ("keep_intermediates", "reuse_doublets")
+# Share of each stage in the time of a solve, and time per doublet of a whole solve, from profiling the velojson events:
+# the starting estimate of the time per doublet of each stage, refined by every solve with a deadline
+STAGE_SHARES = {"doublets": 0.05, "neighbours": 0.25, "ca": 0.2, "tracks": 0.5}
+SECONDS_PER_DOUBLET = 2e-5
+# Most doublets a doublet_pool keeps between solves, about those of a busy velojson event
+MAX_POOLED_DOUBLETS = 400000
+# The stages whose work each degradation sheds: their measured time is only a lower bound of that of the full stage
+SHED_STAGES = {"skip_sensor_doublets": ("neighbours",), "long_neighbours": ("neighbours",),
+               "multi_path_extraction": ("tracks",), "extraction_truncated": ("tracks",)}
+
+class ca_context(object):
+    """
+    working state of one CellularAutomaton solve: the event, its doublets and the tracks found
+    pool: the doublet_pool the doublets are taken from, if any
+    overflows: the number of doublets, neighbours and extraction branches dropped by the caps
+    deadline: the time.perf_counter() time the solve should be done by, if any;
+    degradations: the optional work shed to meet it (see CellularAutomaton.solve_with_deadline)
+    """
+    def __init__(self, event, pool=None):
+        self.event = event
+        self.pool = pool
+        self.doublets = []
+        self.doublet_arrays = []
+        self.hit_x = self.hit_y = self.hit_z = None
+        self.collected_tracks = []
+        self.long_tracks = []
+        self.all_collected_tracks = []
+        self.used_hits = None
+        self.overflows = {"doublets": 0, "neighbours": 0, "paths": 0}
+        self.path_budget = None
+        self.deadline = None
+        self.degradations = []
+        self.skip_sensor_doublets = True
+        self.long_neighbours = True
+        self.max_paths = None
+
+
+class doublet_pool(object):
+    """
+    doublet objects reused from solve to solve, so that a run over many events does not allocate them again for each one
+    take hands out the doublets of a solve, reset; new ones are only made when all the pooled ones are in use
+    release gives them back at the end of the solve: they let go of its hits, and at most max_pooled are kept
+    allocated and reused count the doublets of the current solve, total_allocated and total_reused those of all solves
+    """
+    def __init__(self, max_pooled=MAX_POOLED_DOUBLETS):
+        self.doublets = []
+        self.max_pooled = max_pooled
+        self.used = 0
+        self.solves = 0
+        self.allocated = self.reused = 0
+        self.total_allocated = self.total_reused = 0
+
+    def release(self):
+        """makes all the doublets available again, without references to the hits of the solve that used them"""
+        for doublet in self.doublets[:self.used]:
+            doublet.starting_point = doublet.ending_point = None
+            del doublet.left_neighbours[:]
+        del self.doublets[self.max_pooled:]
+        self.used = 0
+
+    def reset(self):
+        """makes all the doublets available again, for a new solve"""
+        self.release()
+        self.solves += 1
+        self.allocated = self.reused = 0
+
+    def take(self, hits, starts, ends):
+        """doublets from hits[starts[i]] to hits[ends[i]]"""
+        new = max(self.used + len(starts) - len(self.doublets), 0)
+        self.doublets.extend(event_model.doublets(None, None) for _ in range(new))
+        taken = self.doublets[self.used:self.used + len(starts)]
+        for doublet, start, end in zip(taken, starts, ends):
+            doublet.starting_point = hits[start]
+            doublet.ending_point = hits[end]
+            doublet.state = 1
+            doublet.new_state = 1
+            doublet.used = False
+            del doublet.left_neighbours[:]
+        self.used += len(starts)
+        self.allocated += new
+        self.reused += len(starts) - new
+        self.total_allocated += new
+        self.total_reused += len(starts) - new
+        return taken
+
+    def stats(self):
+        return {"solves": self.solves, "pooled": len(self.doublets), "allocated": self.allocated, "reused": self.reused,
+                "total_allocated": self.total_allocated, "total_reused": self.total_reused}
+
+
+class ca_batch(object):
+    """
+    a batch of events solved together: the hits of all events concatenated into one array,
+    and the doublets of all events per sensor layer; plus a ca_context per event
+    """
+    def __init__(self, events, pool=None):
+        self.contexts = [ca_context(event, pool) for event in events]
+        self.n_sensors = len(events[0].sensors)
+        self.hit_offsets = np.cumsum([0] + [len(event.hits) for event in events])
+        self.hit_x, self.hit_y, self.hit_z = layer_kernels.hit_arrays([h for event in events for h in event.hits])
+        for context, first, last in zip(self.contexts, self.hit_offsets[:-1], self.hit_offsets[1:]):
+            context.hit_x, context.hit_y, context.hit_z = self.hit_x[first:last], self.hit_y[first:last], self.hit_z[first:last]
+        self.doublet_arrays = []
+        self.doublet_offsets = []
+        self.long_neighbours = True
+
+    def sensor_hits(self, index):
+        """first (batch) hit and number of hits of sensor index in each event"""
+        sensors = [context.event.sensors[index] for context in self.contexts]
+        starts = self.hit_offsets[:-1] + np.array([sensor.hit_start_index for sensor in sensors], dtype=int)
+        return starts, np.array([sensor.hit_end_index - sensor.hit_start_index for sensor in sensors], dtype=int)
+
 
 class CellularAutomaton(object):
 
-    def __init__(self, max_slopes=(0.7, 0.7), max_tolerance=(0.4, 0.4), max_scatter=0.4):
+    def __init__(self, max_slopes=(0.7, 0.7), max_tolerance=(0.4, 0.4), max_scatter=0.4, executor=None,
+                 keep_intermediates=False, reuse_doublets=True, max_doca=None, z_range=None, rank_by_fit=False,
+                 max_doublets_per_hit=None, max_neighbours=None, max_paths=None):
+        """executor: optional concurrent.futures executor (eg. a ThreadPoolExecutor)
+        the per sensor layer work of doublet and neighbour building is spread over.
+
+        All the working state of a solve lives in a ca_context that is dropped
+        when it returns, so one instance can be used from many threads at once.
+        keep_intermediates keeps the context of the last solve as self.context
+        (doublets, collected tracks...), for debugging and visualisation; after solve_batch,
+        self.contexts holds the context of each event of the batch, and self.context that of the last one.
+
+        reuse_doublets keeps the doublet objects of each thread in a doublet_pool, reused by its next solves
+        (unless keep_intermediates is set, as the kept context holds on to them).
+
+        max_doca and z_range make a pointing cut on the doublets: the line through the two hits has to pass
+        within max_doca (mm) of the z axis, at a z of closest approach within z_range (min, max).
+        Doublets that miss the luminous region that far cannot belong to a VELO track. Both are off by default.
+
+        rank_by_fit ranks the tracks for the ghost and clone removal by the chi2 / ndof of a straight line fit
+        of all their hits (track_fit), rather than by the chi2 summed up during the extraction.
+
+        Caps bounding the work on pathological, high occupancy events (None: no cap):
+        max_doublets_per_hit keeps the doublets of smallest slope of each starting hit (when the doublets are built,
+        solve_graph takes the doublets of the graph as they are), max_neighbours the left neighbours of smallest
+        scatter of each doublet, and max_paths stops the extraction of a seed after that many candidate tracks.
+        overflow_stats gives the number of doublets, neighbours and paths dropped in the last solve; the paths are
+        counted as the branches of the extraction not followed, each of which holds at least one candidate track.
+        """
         self.__max_slopes = max_slopes
         self.__max_tolerance = max_tolerance
         self.__max_scatter = max_scatter
-        self.doublets = []
+        self.__max_doca = max_doca
+        self.__z_range = z_range
+        self.__rank_by_fit = rank_by_fit
+        self.__max_doublets_per_hit = max_doublets_per_hit
+        self.__max_neighbours = max_neighbours
+        self.__max_paths = max_paths
+        self.__executor = executor
+        self.__keep_intermediates = keep_intermediates
+        self.__reuse_doublets = reuse_doublets and not keep_intermediates
+        self.__pools = threading.local()
+        self.__stage_seconds = {stage: share * SECONDS_PER_DOUBLET for stage, share in STAGE_SHARES.items()}
+        self.__last_solve = threading.local()
+        self.context = None
+        self.contexts = []
+
+    def __getstate__(self):
+        # The pools and counters stay behind when the solver is sent to another process
+        state = self.__dict__.copy()
+        del state["_CellularAutomaton__pools"]
+        del state["_CellularAutomaton__last_solve"]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.__pools = threading.local()
+        self.__last_solve = threading.local()
+
+    def doublet_pool(self):
+        """
+        the doublet_pool of the calling thread, reset for a new solve; None if doublets are not reused
+        """
+        if not self.__reuse_doublets:
+            return None
+        pool = getattr(self.__pools, "pool", None)
+        if pool is None:
+            pool = self.__pools.pool = doublet_pool()
+        pool.reset()
+        return pool
+
+    def allocation_stats(self):
+        """
+        doublet_pool counters of the calling thread: doublets allocated and reused by the last solve and in total
+        """
+        pool = getattr(self.__pools, "pool", None)
+        return pool.stats() if pool is not None else None
+
+    def overflow_stats(self):
+        """
+        numbers of doublets, neighbours and extraction branches dropped by the caps in the last solve of the calling
+        thread (a list with those of each event after solve_batch), None before any solve
+        """
+        return getattr(self.__last_solve, "overflows", None)
+
+    def degradations(self):
+        """
+        the optional work shed by the last solve_with_deadline of the calling thread, in the order it was shed
+        (a list with that of each event after solve_batch)
+        """
+        return getattr(self.__last_solve, "degradations", None)
+
+    def record_solve(self, contexts, batch=False):
+        """
+        ends a solve: keeps the counters of its contexts (a list of them for a batch, even of one event),
+        and gives its doublets back to the pool
+        """
+        if contexts[0].pool is not None:
+            contexts[0].pool.release()
+        if batch:
+            self.__last_solve.overflows = [c.overflows for c in contexts]
+            self.__last_solve.degradations = [c.degradations for c in contexts]
+        else:
+            self.__last_solve.overflows = contexts[0].overflows
+            self.__last_solve.degradations = contexts[0].degradations
 
     def are_compatible_in_x(self, hit_0, hit_1):
         """Checks if two hits are compatible according
@@ -98,104 +324,270 @@ class CellularAutomaton(object):
 
         return scatter
 
-    def make_doublets(self, event):
+    def pointing_cut(self):
+        return self.__max_doca is not None or self.__z_range is not None
+
+    def points_to_beamline(self, hit_x, hit_y, hit_z, starts, ends):
         """
-        makes all doublets between all sensors, given that the two hits are compatible, depending on the angle with respect to z
-        also makes all doublets when a sensor is skipped.
+        the pointing cut of the doublets with start and end hits (starts, ends)
         """
-        self.doublets = []
-
-        for index, sensor in enumerate(event.sensors[:-NEXT_SENSOR]): #for each sensor
-            sensor_doublets = []
+        return layer_kernels.pointing(hit_x, hit_y, hit_z, starts, ends, self.__max_doca, self.__z_range)
 
-            #normal sensors
-            for index2, next_hit in enumerate(event.sensors[index + NEXT_SENSOR]): #for each right neighbour
-                hit_doublets = []
-                for hit in sensor:  # for each hit in each sensor
-                    if self.are_compatible(hit, next_hit):
-                        doublet = event_model.doublets(hit, next_hit)
-                        hit_doublets.append(doublet)
-                sensor_doublets.append(hit_doublets)
-
-            #skipped sensors
-            if index < len(event.sensors) - SECOND_NEXT_SENSOR:
-                for index3, next_hit in enumerate(event.sensors[index + SECOND_NEXT_SENSOR]): #for each next right neighbour
-                    hit_doublets = []
-                    for hit in sensor:  # for each hit in each sensor
-                        if self.are_compatible(hit, next_hit):
-                            doublet = event_model.doublets(hit, next_hit)
-                            hit_doublets.append(doublet)
-                    sensor_doublets.append(hit_doublets)
-            self.doublets.append(sensor_doublets)
-
-    def calculate_shared_point(self, doublet, left_doublet):
+    def doublet_cap(self, hit_x, hit_y, hit_z, starts, ends):
         """
-        checks if two doublets have a shared point
+        which of the doublets (starts, ends) are kept by max_doublets_per_hit: those of smallest slope of each starting hit
         """
-        return (left_doublet.ending_point.x == doublet.starting_point.x and
-                left_doublet.ending_point.y == doublet.starting_point.y and
-                left_doublet.ending_point.z == doublet.starting_point.z)
+        dx, dy, dz = hit_x[ends] - hit_x[starts], hit_y[ends] - hit_y[starts], hit_z[ends] - hit_z[starts]
+        order = np.lexsort(((dx * dx + dy * dy) / (dz * dz), starts))
+        rank = np.empty(len(order), dtype=int)
+        rank[order] = layer_kernels.group_positions(starts[order])
+        return rank < self.__max_doublets_per_hit
 
-    def find_left_neighbours(self, doublet, index):
+    def doublet_layer(self, context, index):
         """
-        for a given doublet find all left neighbours and append the index to the neighbours list in the doublet object
+        compatibility of the hits of sensor index with the hits of its right neighbours
+        returns a list of (right neighbour sensor, boolean matrix [right hit, hit])
         """
-        for hit_index, left_doublets in enumerate(self.doublets[index - NEXT_SENSOR]):
-            for doublet_index, left_doublet in enumerate(left_doublets):
-
-                if self.calculate_shared_point(doublet, left_doublet):
-                    if self.check_tolerance(left_doublet.starting_point, left_doublet.ending_point, doublet.ending_point):
-                        doublet.left_neighbours.append([index - NEXT_SENSOR, hit_index, doublet_index])
-                else:
-                    break
-
-        #also find long left neighbours not only short ones
-        if index >= SECOND_NEXT_SENSOR:
-            for hit_index, left_doublets in enumerate(self.doublets[index - SECOND_NEXT_SENSOR]):
-                for doublet_index, left_doublet in enumerate(left_doublets):
-
-                    if self.calculate_shared_point(doublet, left_doublet):
-                        if self.check_tolerance(left_doublet.starting_point, left_doublet.ending_point,
-                                                doublet.ending_point):
-                            doublet.left_neighbours.append([index - SECOND_NEXT_SENSOR, hit_index, doublet_index])
-                    else:
-                        break
+        event = context.event
+        sensor = event.sensors[index]
+        x0, y0, z0 = context.hit_x[sensor.hit_start_index:sensor.hit_end_index], \
+            context.hit_y[sensor.hit_start_index:sensor.hit_end_index], context.hit_z[sensor.hit_start_index:sensor.hit_end_index]
+        next_sensors = [index + NEXT_SENSOR]
+        if index < len(event.sensors) - SECOND_NEXT_SENSOR:
+            next_sensors.append(index + SECOND_NEXT_SENSOR)
+        layer = []
+        for next_index in next_sensors:
+            next_sensor = event.sensors[next_index]
+            x1, y1, z1 = context.hit_x[next_sensor.hit_start_index:next_sensor.hit_end_index], \
+                context.hit_y[next_sensor.hit_start_index:next_sensor.hit_end_index], context.hit_z[next_sensor.hit_start_index:next_sensor.hit_end_index]
+            compatible = layer_kernels.compatible(x0, z0, x1, z1, self.__max_slopes[0]) & \
+                layer_kernels.compatible(y0, z0, y1, z1, self.__max_slopes[1])
+            if self.pointing_cut():
+                # only the pairs compatible in slope are extrapolated to the beamline
+                rows, columns = np.nonzero(compatible)
+                missing = ~self.points_to_beamline(context.hit_x, context.hit_y, context.hit_z,
+                                                   columns + sensor.hit_start_index, rows + next_sensor.hit_start_index)
+                compatible[rows[missing], columns[missing]] = False
+            layer.append((next_sensor, compatible))
+        return layer
+
+    def make_doublets(self, context):
+        """
+        makes all doublets between all sensors, given that the two hits are compatible, depending on the angle with respect to z
+        also makes all doublets when a sensor is skipped.
+        the compatibility of each sensor layer is computed at once, and the doublets are grouped by their ending hit.
+        context.doublet_arrays keeps, per sensor, the start and end hit, group and position in group of every doublet.
+        """
+        event = context.event
+        context.doublets = []
+        context.doublet_arrays = []
+        context.hit_x, context.hit_y, context.hit_z = layer_kernels.hit_arrays(event.hits)
+
+        layers = layer_kernels.run_layers(lambda index: self.doublet_layer(context, index),
+                                          range(len(event.sensors) - NEXT_SENSOR), self.__executor)
+        if context.deadline is not None:
+            n_doublets = sum(int(np.count_nonzero(compatible)) for layer in layers for _, compatible in layer)
+            if self.projected_end(context, "neighbours", n_doublets) > context.deadline:
+                # only the doublets to the next sensor, which also leaves out the long neighbours
+                context.skip_sensor_doublets = context.long_neighbours = False
+                context.degradations.append("skip_sensor_doublets")
+                layers = [layer[:1] for layer in layers]
+        for index, layer in enumerate(layers): #for each sensor
+            sensor = event.sensors[index]
+            starts, ends, groups = [], [], []
+            n_groups = 0
+            for next_sensor, compatible in layer: #normal and skipped sensors
+                rows, columns = np.nonzero(compatible)
+                starts.append(columns + sensor.hit_start_index)
+                ends.append(rows + next_sensor.hit_start_index)
+                groups.append(rows + n_groups)
+                n_groups += next_sensor.hit_end_index - next_sensor.hit_start_index
+            starts, ends, groups = np.concatenate(starts), np.concatenate(ends), np.concatenate(groups)
+            if self.__max_doublets_per_hit is not None:
+                keep = self.doublet_cap(context.hit_x, context.hit_y, context.hit_z, starts, ends)
+                context.overflows["doublets"] += len(keep) - int(np.count_nonzero(keep))
+                starts, ends, groups = starts[keep], ends[keep], groups[keep]
+            self.add_doublets(context, starts, ends, groups, layer_kernels.group_positions(groups), n_groups)
+
+    def add_doublets(self, context, starts, ends, groups, positions, n_groups):
+        """
+        appends the doublets of the next sensor to the context, given the start and end hit and the group of each doublet
+        there is a group (list of doublets) per right neighbour hit, n_groups in all
+        """
+        hits = context.event.hits
+        starts_list, ends_list = starts.tolist(), ends.tolist()
+        group_starts = np.searchsorted(groups, np.arange(n_groups + 1)).tolist()
+        if context.pool is None:
+            doublets = [event_model.doublets(hits[start], hits[end]) for start, end in zip(starts_list, ends_list)]
+        else:
+            doublets = context.pool.take(hits, starts_list, ends_list)
+        context.doublet_arrays.append((starts, ends, groups, positions))
+        context.doublets.append([doublets[first:last] for first, last in zip(group_starts[:-1], group_starts[1:])])
 
-    def make_left_neighbours(self):
+    def neighbour_layer(self, context, index):
+        """
+        finds the left neighbours of all doublets of sensor index
+        returns a list of (left sensor index, doublet, left group, left position) arrays
+        context can also be a ca_batch, then the layer of all events is done at once
+        """
+        starts, ends = context.doublet_arrays[index][0:2]
+        layer = []
+        left_indices = [index - NEXT_SENSOR]
+        if index >= SECOND_NEXT_SENSOR and context.long_neighbours: #also find long left neighbours not only short ones
+            left_indices.append(index - SECOND_NEXT_SENSOR)
+        for left_index in left_indices:
+            left_starts, left_ends, left_groups, left_positions = context.doublet_arrays[left_index]
+            left, right = layer_kernels.matching_pairs(left_ends, starts)
+            h0, h1, h2 = left_starts[left], left_ends[left], ends[right]
+            compatible = layer_kernels.triplet_tolerance(context.hit_x, context.hit_y, context.hit_z, h0, h1, h2,
+                                                         self.__max_tolerance, self.__max_scatter)
+            layer.append((left_index, right[compatible], left_groups[left[compatible]], left_positions[left[compatible]]))
+        return layer
+
+    def make_left_neighbours(self, context):
         """
         loop over all doublets and find all left neighbours
+        the neighbours of each sensor layer are found at once; each doublet gets those of sensor index - NEXT_SENSOR
+        first, then those of index - SECOND_NEXT_SENSOR, each in the order of the left doublets
         """
-        for index, sensor in enumerate(self.doublets[NEXT_SENSOR:], NEXT_SENSOR):
-            for doublets in sensor:
-                for doublet in doublets:
-                    self.find_left_neighbours(doublet, index)
+        layers = layer_kernels.run_layers(lambda index: self.neighbour_layer(context, index), range(NEXT_SENSOR, len(context.doublets)), self.__executor)
+        for index, layer in enumerate(layers, NEXT_SENSOR):
+            self.add_left_neighbours(context, index, layer)
 
-    def check_neighbour(self, doublet, index):
+    def neighbour_cap(self, context, index, layer):
+        """
+        the left neighbours of layer (see neighbour_layer) kept by max_neighbours: those of smallest scatter of each doublet
+        """
+        if context.hit_x is None:
+            context.hit_x, context.hit_y, context.hit_z = layer_kernels.hit_arrays(context.event.hits)
+        ends = context.doublet_arrays[index][1]
+        rights, scatters = [], []
+        for left_index, right, left_groups, left_positions in layer:
+            left_starts, left_ends, all_left_groups, _ = context.doublet_arrays[left_index]
+            left = np.searchsorted(all_left_groups, left_groups) + left_positions
+            h0, h1, h2 = left_starts[left], left_ends[left], ends[right]
+            rights.append(right)
+            scatters.append(layer_kernels.extrapolation(context.hit_x[h0], context.hit_y[h0], context.hit_z[h0],
+                                                        context.hit_x[h1], context.hit_y[h1], context.hit_z[h1],
+                                                        context.hit_x[h2], context.hit_y[h2], context.hit_z[h2])[2])
+        right = np.concatenate(rights)
+        order = np.lexsort((np.concatenate(scatters), right))
+        rank = np.empty(len(order), dtype=int)
+        rank[order] = layer_kernels.group_positions(right[order])
+        keep = rank < self.__max_neighbours
+        context.overflows["neighbours"] += len(keep) - int(np.count_nonzero(keep))
+        bounds = np.cumsum([0] + [len(r) for r in rights]).tolist()
+        return [(left_index, right[k], left_groups[k], left_positions[k])
+                for (left_index, right, left_groups, left_positions), k in
+                zip(layer, [keep[first:last] for first, last in zip(bounds[:-1], bounds[1:])])]
+
+    def add_left_neighbours(self, context, index, layer):
+        """
+        appends the left neighbours found by neighbour_layer to the doublets of sensor index
+        """
+        if self.__max_neighbours is not None and len(layer) > 0:
+            layer = self.neighbour_cap(context, index, layer)
+        doublets = [doublet for doublets in context.doublets[index] for doublet in doublets]
+        for left_index, right, left_groups, left_positions in layer:
+            for doublet_index, hit_index, left_doublet_index in zip(right.tolist(), left_groups.tolist(), left_positions.tolist()):
+                doublets[doublet_index].left_neighbours.append([left_index, hit_index, left_doublet_index])
+
+    def batch_doublet_layer(self, batch, index):
+        """
+        compatibility of the hits of sensor index with the hits of its right neighbours, for all events of the batch at once
+        returns the event, start and end hit (batch indices) and group of the doublets, ordered by event,
+        and the number of groups of each event
+        """
+        starts_0, counts_0 = batch.sensor_hits(index)
+        blocks, starts, ends, groups = [], [], [], []
+        n_groups = np.zeros(len(batch.contexts), dtype=int)
+        next_sensors = [index + NEXT_SENSOR]
+        if index < batch.n_sensors - SECOND_NEXT_SENSOR:
+            next_sensors.append(index + SECOND_NEXT_SENSOR)
+        for next_index in next_sensors:
+            starts_1, counts_1 = batch.sensor_hits(next_index)
+            block, h0, h1 = layer_kernels.block_pairs(starts_0, counts_0, starts_1, counts_1)
+            compatible = layer_kernels.compatible_pairs(batch.hit_x[h0], batch.hit_z[h0], batch.hit_x[h1], batch.hit_z[h1], self.__max_slopes[0]) & \
+                layer_kernels.compatible_pairs(batch.hit_y[h0], batch.hit_z[h0], batch.hit_y[h1], batch.hit_z[h1], self.__max_slopes[1])
+            block, h0, h1 = block[compatible], h0[compatible], h1[compatible]
+            if self.pointing_cut():
+                compatible = self.points_to_beamline(batch.hit_x, batch.hit_y, batch.hit_z, h0, h1)
+                block, h0, h1 = block[compatible], h0[compatible], h1[compatible]
+            blocks.append(block)
+            starts.append(h0)
+            ends.append(h1)
+            groups.append(n_groups[block] + h1 - starts_1[block])
+            n_groups = n_groups + counts_1
+        block = np.concatenate(blocks)
+        order = np.argsort(block, kind='stable')
+        return block[order], np.concatenate(starts)[order], np.concatenate(ends)[order], np.concatenate(groups)[order], n_groups
+
+    def make_batch_doublets(self, batch):
+        """
+        make_doublets for all events of the batch, each sensor layer of all events in single kernel calls
+        batch.doublet_arrays keeps the doublets of all events per sensor, batch.doublet_offsets where each event starts
+        """
+        layers = layer_kernels.run_layers(lambda index: self.batch_doublet_layer(batch, index),
+                                          range(batch.n_sensors - NEXT_SENSOR), self.__executor)
+        for block, starts, ends, groups, n_groups in layers:
+            if self.__max_doublets_per_hit is not None:
+                keep = self.doublet_cap(batch.hit_x, batch.hit_y, batch.hit_z, starts, ends)
+                for context, dropped in zip(batch.contexts, np.bincount(block[~keep], minlength=len(batch.contexts)).tolist()):
+                    context.overflows["doublets"] += dropped
+                block, starts, ends, groups = block[keep], starts[keep], ends[keep], groups[keep]
+            group_offsets = np.cumsum(n_groups) - n_groups
+            positions = layer_kernels.group_positions(group_offsets[block] + groups)
+            offsets = np.searchsorted(block, np.arange(len(batch.contexts) + 1))
+            batch.doublet_arrays.append((starts, ends, groups, positions))
+            batch.doublet_offsets.append(offsets)
+            for event_index, context in enumerate(batch.contexts):
+                first, last = offsets[event_index], offsets[event_index + 1]
+                hit_offset = batch.hit_offsets[event_index]
+                self.add_doublets(context, starts[first:last] - hit_offset, ends[first:last] - hit_offset,
+                                  groups[first:last], positions[first:last], n_groups[event_index])
+
+    def make_batch_left_neighbours(self, batch):
+        """
+        make_left_neighbours for all events of the batch, each sensor layer of all events in single kernel calls
+        doublets only share hits with doublets of the same event, so neighbours never cross events
+        """
+        layers = layer_kernels.run_layers(lambda index: self.neighbour_layer(batch, index),
+                                          range(NEXT_SENSOR, len(batch.doublet_arrays)), self.__executor)
+        for index, layer in enumerate(layers, NEXT_SENSOR):
+            offsets = batch.doublet_offsets[index]
+            bounds = [np.searchsorted(right, offsets) for _, right, _, _ in layer]
+            for event_index, context in enumerate(batch.contexts):
+                self.add_left_neighbours(context, index, [
+                    (left_index, right[b[event_index]:b[event_index + 1]] - offsets[event_index],
+                     left_groups[b[event_index]:b[event_index + 1]], left_positions[b[event_index]:b[event_index + 1]])
+                    for (left_index, right, left_groups, left_positions), b in zip(layer, bounds)])
+
+    def check_neighbour(self, context, doublet, index):
         """
         check if any left neighbour has the same state as the current doublet
         """
         for index2, neighbour in enumerate(doublet.left_neighbours):
-            state_equality = int(self.doublets[neighbour[0]][neighbour[1]][neighbour[2]].state == doublet.state)
+            state_equality = int(context.doublets[neighbour[0]][neighbour[1]][neighbour[2]].state == doublet.state)
             doublet.new_state += state_equality
             if state_equality:
                 return state_equality
 
         return 0
 
-    def Ca(self):
+    def Ca(self, context):
         """
         does the actual cellular automaton calculation, looping over all doublets, check the neighbours and update the status
         then copies the new state over to the state
         """
         while True:
             changes = int(0)
-            for index, sensor in enumerate(self.doublets[NEXT_SENSOR:], NEXT_SENSOR):
+            for index, sensor in enumerate(context.doublets[NEXT_SENSOR:], NEXT_SENSOR):
                 for doublets in sensor:
                     for doublet in doublets:
-                        changes += self.check_neighbour(doublet, index)
+                        changes += self.check_neighbour(context, doublet, index)
             # print(changes, file=sys.stderr)
 
-            for index, sensor in enumerate(self.doublets[NEXT_SENSOR:]):
+            for index, sensor in enumerate(context.doublets[NEXT_SENSOR:]):
                 for doublets in sensor:
                     for doublet in doublets:
                         doublet.state = doublet.new_state
@@ -203,7 +595,7 @@ class CellularAutomaton(object):
             if changes == 0:
                 break
 
-    def extract_next_segment(self, right_doublet, index, track):
+    def extract_next_segment(self, context, right_doublet, index, track):
         """
         extract the next segment of the track.
         1. loops over the previous doublets and checks if they are neighbours
@@ -218,56 +610,104 @@ class CellularAutomaton(object):
         local_track = copy.deepcopy(track)
         local_tracks = []
         in_loop = False
+        dropped = False
 
         #only goes to the second doublet and not the first
         for n_doublet in right_doublet.left_neighbours:
-            neighbour_doublet = self.doublets[n_doublet[0]][n_doublet[1]][n_doublet[2]]
+            neighbour_doublet = context.doublets[n_doublet[0]][n_doublet[1]][n_doublet[2]]
             # if neighbour_doublet.state < right_doublet.state and not neighbour_doublet.used:
             if (neighbour_doublet.state + 1 == right_doublet.state) and not neighbour_doublet.used:
             # if (neighbour_doublet.state + 1 == right_doublet.state or neighbour_doublet.state + 2 == right_doublet.state) and not neighbour_doublet.used:
+                if context.path_budget is not None and context.path_budget <= 0:
+                    # max_paths candidate tracks of this seed are out already: the branches left are dropped
+                    context.overflows["paths"] += 1
+                    dropped = True
+                    continue
                 in_loop = True
                 chi2 = self.calculate_chi2(neighbour_doublet.starting_point, neighbour_doublet.ending_point, right_doublet.ending_point)
                 local_track.add_hit(neighbour_doublet.starting_point, chi2)
-                local_tracks += self.extract_next_segment(neighbour_doublet, index, local_track)
+                local_tracks += self.extract_next_segment(context, neighbour_doublet, index, local_track)
 
         if in_loop:
             return local_tracks
+        elif dropped:
+            # the track goes on, but past the budget: it is not returned cut short
+            return []
         else:
+            if context.path_budget is not None:
+                context.path_budget -= 1
             return [local_track]
 
-    def extract_tracks(self):
+    def extract_tracks(self, context):
         """
         extract the tracks from the Cellular automaton doublets
         1. starts at the most right doublet and creates all possible tracks for all starting doublets
         2. chooses the doublet with the lowest chi2 and appends it to the list of tracks
         3. moves one layer to the left and makes all possible tracks with those starting segments
         """
-        self.collected_tracks = []
-        for index, sensor in reversed(list(enumerate(self.doublets[2:],2))):
+        context.collected_tracks = []
+        max_paths = context.max_paths if context.max_paths is not None else self.__max_paths
+        seeds = []
+        for index, sensor in reversed(list(enumerate(context.doublets[2:],2))):
             for doublets in sensor:
                 # sorted_doublets = sorted(doublets, key=lambda x: x.state) #probably only finds one track per sensor
                 for doublet in doublets:
                     if doublet.state > 1 and not doublet.used:
-                        hits=[]
-                        hits.append(doublet.ending_point)
-                        hits.append(doublet.starting_point)
-                        track = event_model.track(hits, len(hits))
-
-                        track = self.extract_next_segment(doublet, index, track)
-                        track = sorted(track, key=lambda x: x.new_x, reverse=True)
-
-                        self.collected_tracks.append(track[0])
-
-    def remove_shorttracks(self, length):
+                        seeds.append((index, doublet))
+        order = range(len(seeds))
+        if context.deadline is not None:
+            # the seeds that start a candidate first, longest first, and the seeds inside a longer candidate (that only
+            # give its clones) last: a truncated extraction then drops the shortest candidates and the clones rather
+            # than all the candidates of the first sensors
+            heads = self.candidate_heads(context)
+            order = sorted(order, key=lambda i: (id(seeds[i][1]) not in heads, -seeds[i][1].state))
+        tracks = {}
+        for i in order:
+            if context.deadline is not None and time.perf_counter() > context.deadline:
+                # out of time: the tracks extracted so far are all there is
+                context.degradations.append("extraction_truncated")
+                break
+            index, doublet = seeds[i]
+            context.path_budget = max_paths
+            hits=[]
+            hits.append(doublet.ending_point)
+            hits.append(doublet.starting_point)
+            track = event_model.track(hits, len(hits))
+
+            track = self.extract_next_segment(context, doublet, index, track)
+            if len(track) == 0:
+                continue
+            track = sorted(track, key=lambda x: x.new_x, reverse=True)
+
+            tracks[i] = track[0]
+        context.collected_tracks = [tracks[i] for i in sorted(tracks)]
+
+    def candidate_heads(self, context):
+        """
+        the ids of the doublets that are not the left neighbour, one state lower, of another doublet:
+        those an extracted candidate track starts from
+        """
+        inner = set()
+        for sensor in context.doublets:
+            for doublets in sensor:
+                for doublet in doublets:
+                    for n_doublet in doublet.left_neighbours:
+                        neighbour_doublet = context.doublets[n_doublet[0]][n_doublet[1]][n_doublet[2]]
+                        if neighbour_doublet.state + 1 == doublet.state:
+                            inner.add(id(neighbour_doublet))
+        return set(id(doublet) for sensor in context.doublets for doublets in sensor for doublet in doublets
+                   if id(doublet) not in inner)
+
+    def remove_shorttracks(self, context, length):
         """
         removes all tracks that are shorter than the length indicates
         """
-        self.long_tracks = []
-        for tracks in self.collected_tracks:
+        context.long_tracks = []
+        for tracks in context.collected_tracks:
             if len(tracks.hits) > length:
-                self.long_tracks.append(tracks)
+                context.long_tracks.append(tracks)
 
-    def remove_ghosts_clones(self):
+    def remove_ghosts_clones(self, context):
         """
         removes possible ghosts and clones
         sorts the created tracks by length and chi2;
@@ -283,30 +723,32 @@ class CellularAutomaton(object):
 
         #PCA trial
         # x=[]
-        # for track in self.long_tracks:
+        # for track in context.long_tracks:
         #     x.append([track.length, track.chi2])
         #
         # pca = PCA(n_components=1)
         # x_new = pca.fit_transform(x)
         #
-        # for index, track in enumerate(self.long_tracks):
+        # for index, track in enumerate(context.long_tracks):
         #     track.new_x = x_new[index]
-        # self.all_collected_tracks = sorted(self.long_tracks, key=lambda x: x.new_x, reverse=True)
+        # context.all_collected_tracks = sorted(context.long_tracks, key=lambda x: x.new_x, reverse=True)
+
+        tracks = context.long_tracks
+        hits = context.event.hits
+        collection = event_model.track_collection.from_tracks(tracks, [h.id for h in hits])
+        lengths = np.array([track.length for track in tracks], dtype=int)
+        if self.__rank_by_fit:
+            order = track_fit.track_fits(collection, *layer_kernels.hit_arrays(hits)).ranking()
+        else:
+            #normal sorting: longest first, then smallest chi2
+            order = track_selection.ranking(lengths, [track.chi2 for track in tracks])
+        context.all_collected_tracks = [tracks[i] for i in order.tolist()]
 
-        #normal sorting
-        self.all_collected_tracks = sorted(self.long_tracks, key=lambda x: (x.length, 1/x.chi2), reverse=True)
-        self.long_tracks = []
-        self.used_hits = []
-
-        for index, track in enumerate(self.all_collected_tracks):
-            counter = 0
-            for hits in track:
-                if hits.id in self.used_hits:
-                    counter += 1
-            if counter/track.length < 0.3:
-                for hits in track:
-                    self.used_hits.append(hits.id)
-                self.long_tracks.append(track)
+        # the hits of the accepted tracks are flagged in a bitmap, a track with 30% or more flagged hits is dropped
+        context.used_hits = track_selection.hit_bitmap(len(hits))
+        accepted = track_selection.select_shared(collection.offsets, collection.hit_indices, order, lengths,
+                                                 context.used_hits, 0.3)
+        context.long_tracks = [tracks[i] for i in accepted]
 
     def solve_without_Profiling(self, event):
 
@@ -326,43 +768,48 @@ class CellularAutomaton(object):
         6. Removes Clones and Ghost Tracks
         """
 
+        context = ca_context(event, self.doublet_pool())
+
         # 1. Creates all possible and applicable doublets
         # start = time.clock()
-        self.make_doublets(event)
+        self.make_doublets(context)
         # print("making doublets took: ", time.clock()-start)
 
         #2. searches for all the left neighbours of these doublets
         # start = time.clock()
-        self.make_left_neighbours()
+        self.make_left_neighbours(context)
         # print("making neighbours took: ", time.clock() - start)
 
         #3. Runs the Cellular Automaton (CA)
         # start = time.clock()
-        self.Ca()
+        self.Ca(context)
         # print("ca took: ", time.clock() - start)
 
         #4. Extract all possible tracks of the CA
         # start = time.clock()
-        self.extract_tracks()
-        # print(self.collected_tracks)
+        self.extract_tracks(context)
+        # print(context.collected_tracks)
         # print("extracting took: ", time.clock() - start)
 
         # 5. remove short tracks
         # start = time.clock()
-        self.remove_shorttracks(2) #keeps everything longer than 2
+        self.remove_shorttracks(context, 2) #keeps everything longer than 2
         # print("removing shorttracks took: ", time.clock() - start)
 
         #6. Removes Clones and Ghost Tracks
         # start = time.clock()
-        self.remove_ghosts_clones()  # keeps everything longer than 2
+        self.remove_ghosts_clones(context)  # keeps everything longer than 2
         # print("removing ghost_clones took: ", time.clock() - start)
 
 
         #Possible visualisation of the segments and the tracks found
-        # vis = CaVisualizer(self.doublets, self.long_tracks)
+        # vis = CaVisualizer(context.doublets, context.long_tracks)
         # vis.visualize_segments()
         # vis.visualize_found_tracks()
-        return (self.long_tracks, [])
+        self.record_solve([context])
+        if self.__keep_intermediates:
+            self.context = context
+        return (context.long_tracks, [])
 
     def solve_with_profiling(self,event):
 
@@ -382,47 +829,250 @@ class CellularAutomaton(object):
         6. Removes Clones and Ghost Tracks
         """
         part_times = []
+        context = ca_context(event, self.doublet_pool())
 
         # 1. Creates all possible and applicable doublets
-        start = time.clock()
-        self.make_doublets(event)
-        # print("making doublets took: ", time.clock()-start)
-        part_times.append(time.clock()-start)
+        start = time.perf_counter()
+        self.make_doublets(context)
+        # print("making doublets took: ", time.perf_counter()-start)
+        part_times.append(time.perf_counter()-start)
 
         #2. searches for all the left neighbours of these doublets
-        start = time.clock()
-        self.make_left_neighbours()
-        # print("making neighbours took: ", time.clock() - start)
-        part_times.append(time.clock() - start)
+        start = time.perf_counter()
+        self.make_left_neighbours(context)
+        # print("making neighbours took: ", time.perf_counter() - start)
+        part_times.append(time.perf_counter() - start)
 
         #3. Runs the Cellular Automaton (CA)
-        start = time.clock()
-        self.Ca()
-        # print("ca took: ", time.clock() - start)
-        part_times.append(time.clock() - start)
+        start = time.perf_counter()
+        self.Ca(context)
+        # print("ca took: ", time.perf_counter() - start)
+        part_times.append(time.perf_counter() - start)
 
         #4. Extract all possible tracks of the CA
-        start = time.clock()
-        self.extract_tracks()
-        # print(self.collected_tracks)
-        # print("extracting took: ", time.clock() - start)
-        part_times.append(time.clock() - start)
+        start = time.perf_counter()
+        self.extract_tracks(context)
+        # print(context.collected_tracks)
+        # print("extracting took: ", time.perf_counter() - start)
+        part_times.append(time.perf_counter() - start)
 
         # 5. remove short tracks
-        start = time.clock()
-        self.remove_shorttracks(2) #keeps everything longer than 2
-        # print("removing shorttracks took: ", time.clock() - start)
-        part_times.append(time.clock() - start)
+        start = time.perf_counter()
+        self.remove_shorttracks(context, 2) #keeps everything longer than 2
+        # print("removing shorttracks took: ", time.perf_counter() - start)
+        part_times.append(time.perf_counter() - start)
 
         #6. Removes Clones and Ghost Tracks
-        start = time.clock()
-        self.remove_ghosts_clones()  # keeps everything longer than 2
-        # print("removing ghost_clones took: ", time.clock() - start)
-        part_times.append(time.clock() - start)
+        start = time.perf_counter()
+        self.remove_ghosts_clones(context)  # keeps everything longer than 2
+        # print("removing ghost_clones took: ", time.perf_counter() - start)
+        part_times.append(time.perf_counter() - start)
 
 
         #Possible visualisation of the segments and the tracks found
-        # vis = CaVisualizer(self.doublets, self.long_tracks)
+        # vis = CaVisualizer(context.doublets, context.long_tracks)
         # vis.visualize_segments()
         # vis.visualize_found_tracks()
-        return (self.long_tracks, part_times)
\ No newline at end of file
+        self.record_solve([context])
+        if self.__keep_intermediates:
+            self.context = context
+        return (context.long_tracks, part_times)
+
+    def solve(self, event):
+        """Solves the event and returns the list of tracks,
+        the same interface as the other solvers.
+        """
+        return self.solve_without_Profiling(event)[0]
+
+    def projected_end(self, context, stage, n_doublets=None):
+        """
+        the time the solve of context is projected to end, if it starts stage now:
+        its n_doublets (by default those of context) times the time per doublet of stage and of the stages after it
+        """
+        if n_doublets is None:
+            n_doublets = sum(len(starts) for starts, _, _, _ in context.doublet_arrays)
+        seconds = sum(self.__stage_seconds[s] for s in STAGES[STAGES.index(stage):])
+        return time.perf_counter() + n_doublets * seconds
+
+    def refine_stage_seconds(self, context, stage_times):
+        """
+        averages the time per doublet of each stage with the one measured by a solve, stage_times: {stage: seconds}
+        a stage whose work was shed ran faster than the full stage would have, so its time can only raise the estimate
+        """
+        n_doublets = sum(len(starts) for starts, _, _, _ in context.doublet_arrays)
+        if n_doublets == 0:
+            return
+        shed = set(stage for degradation in context.degradations for stage in SHED_STAGES[degradation])
+        for stage, elapsed in stage_times.items():
+            refined = (self.__stage_seconds[stage] + elapsed / n_doublets) / 2
+            if stage not in shed or refined > self.__stage_seconds[stage]:
+                self.__stage_seconds[stage] = refined
+
+    def stage_seconds(self):
+        """
+        the current estimate of the time per doublet of each stage, used by solve_with_deadline
+        """
+        return dict(self.__stage_seconds)
+
+    def solve_with_deadline(self, event, deadline):
+        """Solves the event like solve, by deadline (a time.perf_counter() time) if possible.
+        Whenever the solve is projected to end after the deadline, optional work is shed, in this order:
+        1. skip_sensor_doublets: only doublets to the next sensor (SECOND_NEXT_SENSOR is skipped),
+        2. long_neighbours: no left neighbours on the second next sensor,
+        3. multi_path_extraction: a single candidate path per seed in the extraction,
+        4. extraction_truncated: the extraction stops at the deadline, and the tracks extracted so far are returned;
+           the seeds of the longest candidates are extracted first, so this drops the shortest ones.
+        degradations() gives the ones applied. Projections count the time per doublet of each stage in stage_seconds(),
+        STAGE_SHARES of SECONDS_PER_DOUBLET at first, then averaged with the time measured by every solve.
+        """
+        context = ca_context(event, self.doublet_pool())
+        context.deadline = deadline
+        stage_times = {}
+        start = time.perf_counter()
+        self.make_doublets(context)
+        stage_times["doublets"], start = time.perf_counter() - start, time.perf_counter()
+        if context.long_neighbours and self.projected_end(context, "neighbours") > deadline:
+            context.long_neighbours = False
+            context.degradations.append("long_neighbours")
+        self.make_left_neighbours(context)
+        stage_times["neighbours"], start = time.perf_counter() - start, time.perf_counter()
+        self.Ca(context)
+        stage_times["ca"], start = time.perf_counter() - start, time.perf_counter()
+        if self.projected_end(context, "tracks") > deadline:
+            context.max_paths = 1
+            context.degradations.append("multi_path_extraction")
+        self.extract_tracks(context)
+        self.remove_shorttracks(context, 2)
+        self.remove_ghosts_clones(context)
+        stage_times["tracks"] = time.perf_counter() - start
+        self.refine_stage_seconds(context, stage_times)
+        self.record_solve([context])
+        if self.__keep_intermediates:
+            self.context = context
+        return context.long_tracks
+
+    def solve_batch(self, events):
+        """Solves a batch of events, returns the list of tracks of each event.
+        The hits of all events are concatenated, and the doublets and their neighbours are
+        made for all events at once, which saves most of the per event overhead of small events.
+        """
+        if len(events) == 0:
+            return []
+        if len(set(len(event.sensors) for event in events)) > 1:
+            tracks, overflows, degradations = [], [], []
+            for event in events:
+                tracks.append(self.solve(event))
+                overflows.append(self.overflow_stats())
+                degradations.append(self.degradations())
+            self.__last_solve.overflows, self.__last_solve.degradations = overflows, degradations
+            return tracks
+        batch = ca_batch(events, self.doublet_pool())
+        self.make_batch_doublets(batch)
+        self.make_batch_left_neighbours(batch)
+        for context in batch.contexts:
+            self.Ca(context)
+            self.extract_tracks(context)
+            self.remove_shorttracks(context, 2)
+            self.remove_ghosts_clones(context)
+        self.record_solve(batch.contexts, batch=True)
+        if self.__keep_intermediates:
+            self.contexts = batch.contexts
+            self.context = batch.contexts[-1]
+        return [context.long_tracks for context in batch.contexts]
+
+    def stage_arrays(self, context, stage):
+        """
+        the state of context after stage, as arrays to checkpoint
+        doublets: the doublet arrays of all sensors, neighbours: also the left neighbours of every doublet,
+        ca: also the state of every doublet, tracks: the collected tracks only
+        """
+        if stage == "tracks":
+            return checkpoint.tracks_arrays(context.collected_tracks, context.event.hits)
+        arrays = {"doublet_offsets": checkpoint.flatten([starts for starts, _, _, _ in context.doublet_arrays])[0],
+                  "n_groups": np.array([len(sensor) for sensor in context.doublets], dtype=np.int32)}
+        for i, name in enumerate(("starts", "ends", "groups", "positions")):
+            arrays[name] = np.concatenate([a[i] for a in context.doublet_arrays]).astype(np.int32)
+        doublets = [doublet for sensor in context.doublets for doublets in sensor for doublet in doublets]
+        if stage in ("neighbours", "ca"):
+            offsets, neighbours = checkpoint.flatten([doublet.left_neighbours for doublet in doublets])
+            arrays["neighbour_offsets"] = offsets
+            arrays["neighbours"] = neighbours.reshape(-1, 3)
+        if stage == "ca":
+            arrays["states"] = np.array([doublet.state for doublet in doublets], dtype=np.int32)
+        return arrays
+
+    def restore_stage(self, event, stage, arrays):
+        """
+        the context of event after stage, from its checkpointed arrays
+        """
+        context = ca_context(event, self.doublet_pool())
+        if stage == "tracks":
+            context.collected_tracks = checkpoint.arrays_tracks(arrays, event.hits)
+            return context
+        context.hit_x, context.hit_y, context.hit_z = layer_kernels.hit_arrays(event.hits)
+        offsets = arrays["doublet_offsets"].tolist()
+        for index, (first, last) in enumerate(zip(offsets[:-1], offsets[1:])):
+            self.add_doublets(context, *[np.array(arrays[name][first:last], dtype=np.int64)
+                                         for name in ("starts", "ends", "groups", "positions")],
+                              int(arrays["n_groups"][index]))
+        doublets = [doublet for sensor in context.doublets for doublets in sensor for doublet in doublets]
+        if stage in ("neighbours", "ca"):
+            neighbours = checkpoint.unflatten(arrays["neighbour_offsets"] * 3, arrays["neighbours"].reshape(-1))
+            for doublet, flat in zip(doublets, neighbours):
+                doublet.left_neighbours = [flat[i:i + 3] for i in range(0, len(flat), 3)]
+        if stage == "ca":
+            for doublet, state in zip(doublets, arrays["states"].tolist()):
+                doublet.state = doublet.new_state = state
+        return context
+
+    def solve_checkpointed(self, event, directory, save=(), resume=None):
+        """Solves the event like solve, saving a checkpoint of the state in directory after each stage in save,
+        and, if resume is the name of a stage, starting from its checkpoint rather than from the beginning.
+        Changing the parameters of the later stages only (LATER_PARAMETERS), eg. the clone killing, and resuming gives
+        their new output without rebuilding the doublets; a checkpoint taken with other earlier cuts raises ValueError.
+        """
+        steps = [("doublets", self.make_doublets), ("neighbours", self.make_left_neighbours),
+                 ("ca", self.Ca), ("tracks", self.extract_tracks)]
+        if resume is None:
+            context = ca_context(event, self.doublet_pool())
+            first = 0
+        else:
+            arrays = checkpoint.load(directory, resume, event, self, LATER_PARAMETERS[resume] + RESULT_NEUTRAL_PARAMETERS)
+            context = self.restore_stage(event, resume, arrays)
+            first = STAGES.index(resume) + 1
+        for stage, step in steps[first:]:
+            step(context)
+            if stage in save:
+                checkpoint.save(directory, stage, event, self.stage_arrays(context, stage), self)
+        self.remove_shorttracks(context, 2)
+        self.remove_ghosts_clones(context)
+        self.record_solve([context])
+        if self.__keep_intermediates:
+            self.context = context
+        return context.long_tracks
+
+    def graph_doublets(self, context, graph):
+        """
+        makes the doublets and their left neighbours by cutting a doublet_graph, built at the same or looser cuts
+        """
+        doublets, neighbours = graph.cut(self.__max_slopes, self.__max_tolerance, self.__max_scatter,
+                                         self.__max_doca, self.__z_range)
+        for starts, ends, groups, positions, n_groups in doublets:
+            self.add_doublets(context, starts, ends, groups, positions, n_groups)
+        for index, layer in enumerate(neighbours, NEXT_SENSOR):
+            self.add_left_neighbours(context, index, layer)
+
+    def solve_graph(self, graph):
+        """Solves the event of graph (a doublet_graph.doublet_graph), returns the list of tracks.
+        The result is the same as solve(graph.event).
+        """
+        context = ca_context(graph.event, self.doublet_pool())
+        self.graph_doublets(context, graph)
+        self.Ca(context)
+        self.extract_tracks(context)
+        self.remove_shorttracks(context, 2)
+        self.remove_ghosts_clones(context)
+        self.record_solve([context])
+        if self.__keep_intermediates:
+            self.context = context
+        return context.long_tracks
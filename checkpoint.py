@@ -0,0 +1,98 @@
+"""Checkpoints of the intermediate state of the solvers, to resume a solve at a later stage.
+
+A checkpoint is a directory named after the stage it was taken after, with
+one .npy file per array and a meta.json naming the stage, the arrays, the
+hash of the event it belongs to and the solver class and parameters
+(solver_cache.solver_parameters) that took it. A checkpoint is only resumed
+on the same event, by the same solver class, with the same parameters but
+for those only used by the later stages. Hits are stored as indices into the hit list
+of the event, so the event itself is needed to resume. Arrays are loaded
+memory-mapped, so resuming only reads what the later stages touch.
+
+Lists of lists (eg. the left neighbours of every doublet) are stored flat,
+as offsets and values (see flatten).
+"""
+import event_model as em
+from shared_event import event_buffer
+from solver_cache import solver_parameters
+import numpy as np
+import hashlib
+import json
+import os
+
+
+META_FILENAME = "meta.json"
+
+
+def event_digest(event):
+    return hashlib.sha256(event_buffer.pack(event)).hexdigest()
+
+
+def solver_name(solver):
+    return "%s.%s" % (type(solver).__module__, type(solver).__qualname__)
+
+
+def parameters(solver):
+    """The parameters of solver by name (without the name mangling prefix), as they read back from json."""
+    return json.loads(json.dumps({name.split("__")[-1]: value for name, value in solver_parameters(solver)}))
+
+
+def save(directory, stage, event, arrays, solver):
+    """Saves arrays, a dict of name -> array, as the checkpoint of stage in directory, taken by solver."""
+    path = os.path.join(directory, stage)
+    os.makedirs(path, exist_ok=True)
+    for name, array in arrays.items():
+        np.save(os.path.join(path, name + ".npy"), array)
+    with open(os.path.join(path, META_FILENAME), 'w') as f:
+        json.dump({"stage": stage, "event": event_digest(event), "arrays": sorted(arrays),
+                   "solver": solver_name(solver), "parameters": parameters(solver)}, f)
+
+
+def load(directory, stage, event, solver, later_parameters=()):
+    """Returns the arrays of the checkpoint of stage in directory, memory-mapped.
+    Raises ValueError if it was taken on another event, by another solver class, or with other parameters
+    than those of solver; later_parameters, the parameters only used by the stages after stage, may differ.
+    """
+    path = os.path.join(directory, stage)
+    with open(os.path.join(path, META_FILENAME)) as f:
+        meta = json.load(f)
+    if meta["event"] != event_digest(event):
+        raise ValueError("Checkpoint %s was taken on another event" % path)
+    if meta.get("solver") != solver_name(solver):
+        raise ValueError("Checkpoint %s was taken by another solver: %s" % (path, meta.get("solver")))
+    saved, current = meta["parameters"], parameters(solver)
+    different = sorted(name for name in set(saved) | set(current)
+                       if name not in later_parameters and saved.get(name) != current.get(name))
+    if len(different) > 0:
+        raise ValueError("Checkpoint %s was taken with other parameters: %s" % (path, ", ".join(different)))
+    return {name: np.load(os.path.join(path, name + ".npy"), mmap_mode='r') for name in meta["arrays"]}
+
+
+def flatten(lists, dtype=np.int32):
+    """Offsets and values of a list of lists: lists[i] is values[offsets[i]:offsets[i + 1]]."""
+    offsets = np.zeros(len(lists) + 1, dtype=np.int64)
+    offsets[1:] = np.cumsum([len(l) for l in lists])
+    return offsets, np.array([v for l in lists for v in l], dtype=dtype)
+
+
+def unflatten(offsets, values):
+    values = values.tolist()
+    return [values[start:end] for start, end in zip(offsets[:-1].tolist(), offsets[1:].tolist())]
+
+
+def tracks_arrays(tracks, hits):
+    """Hits (as indices into hits), length and chi2 of tracks."""
+    collection = em.track_collection.from_tracks(tracks, [h.id for h in hits])
+    return {"track_offsets": collection.offsets, "track_hits": collection.hit_indices.astype(np.int32),
+            "track_length": np.array([t.length for t in tracks], dtype=np.int32),
+            "track_chi2": np.array([t.chi2 for t in tracks], dtype=np.float64)}
+
+
+def arrays_tracks(arrays, hits):
+    """The tracks saved by tracks_arrays."""
+    tracks = em.track_collection(arrays["track_offsets"], arrays["track_hits"]).to_tracks(hits)
+    # chi2 stays a NumPy float, as it is in the solvers
+    for t, length, chi2 in zip(tracks, arrays["track_length"].tolist(), np.array(arrays["track_chi2"])):
+        t.length = length
+        t.chi2 = chi2
+    return tracks
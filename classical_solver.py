@@ -1,4 +1,5 @@
 from event_model import *
+import track_selection
 
 class classical_solver:
   '''The classical solver.
@@ -47,15 +48,15 @@ class classical_solver:
           (self.__max_slopes, self.__max_tolerance, self.__max_scatter))
 
     # We are searching for tracks
-    # We will keep a list of used hits to avoid clones
+    # We will flag the used hits to avoid clones
     weak_tracks = []
     tracks      = []
-    used_hits   = []
+    used_hits   = track_selection.hit_bitmap(len(event.hits))
 
     # Start from the last sensor, create seeds and forward them
     for s0, s1, starting_sensor_index in zip(reversed(event.sensors[3:]), reversed(event.sensors[1:-2]), reversed(range(0, len(event.sensors) - 3))):
-      for h0 in [h0 for h0 in s0 if h0.id not in used_hits]:
-        for h1 in [h1 for h1 in s1 if h1.id not in used_hits]:
+      for h0 in [h0 for h0 in s0 if not used_hits[h0.hit_number]]:
+        for h1 in [h1 for h1 in s1 if not used_hits[h1.hit_number]]:
 
           if self.are_compatible(h0, h1):
             # We have a seed, let's attempt to form a track
@@ -94,7 +95,8 @@ class classical_solver:
               elif len(forming_track.hits) >= 4:
                 # There is strong evidence it's a good track
                 tracks.append(forming_track)
-                used_hits += [h.id for h in forming_track.hits]
+                for h in forming_track.hits:
+                  used_hits[h.hit_number] = 1
                 strong_track_found = True
 
             if strong_track_found:
@@ -102,9 +104,9 @@ class classical_solver:
 
     # Process weak tracks
     for t in weak_tracks:
-      used_hits_in_weak_track = [h for h in t.hits if h.id in used_hits]
-      if len(used_hits_in_weak_track) == 0:
-        used_hits += [h.id for h in t.hits]
+      if not any(used_hits[h.hit_number] for h in t.hits):
+        for h in t.hits:
+          used_hits[h.hit_number] = 1
         tracks.append(t)
 
     return tracks
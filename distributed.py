@@ -0,0 +1,235 @@
+"""Coordinator/worker distribution of event batches over TCP.
+
+The coordinator holds the list of json event files and hands them out one at
+a time to any number of workers, which solve them with the existing solvers
+and send back the tracks (binary track_collection) and the solve time.
+
+Workers send a heartbeat every heartbeat_interval seconds, also while they
+are solving. The work of a worker that disconnects, or is not heard of for
+heartbeat_timeout seconds, goes back to the front of the queue. Delivery is
+therefore at least once: an event may be solved twice, and results are
+collected idempotently by task id (the first one is kept).
+
+Frames are the ones of server.py: one kind byte, a 4 byte length, the payload.
+
+  worker -> coordinator                 coordinator -> worker
+  H  hello, worker name                 T  task: 8 byte task id + event json
+  R  request a task                     W  no task right now, ask again
+  P  heartbeat                          D  all done
+  O  result: 8 byte task id, 8 byte
+     solve time, track_collection
+"""
+from server import send_frame, receive_frame, make_solver
+from shared_event import pack_tracks, read_track_collection
+import event_model as em
+import multiprocessing
+import socketserver
+import collections
+import threading
+import socket
+import struct
+import json
+import time
+
+
+TASK = struct.Struct(">q")
+RESULT = struct.Struct(">qd")
+
+
+class coordinator_handler(socketserver.BaseRequestHandler):
+    def handle(self):
+        self.server.coordinator.serve_worker(self.request)
+
+
+class tcp_server(socketserver.ThreadingTCPServer):
+    allow_reuse_address = True
+    daemon_threads = True
+
+
+class worker_state(object):
+    def __init__(self, sock):
+        self.sock = sock
+        self.name = None
+        self.last_seen = time.perf_counter()
+        self.tasks = set()
+        self.alive = True
+        self.lock = threading.Lock()
+
+    def send(self, kind, payload=b""):
+        with self.lock:
+            send_frame(self.sock, kind, payload)
+
+
+class coordinator(object):
+    """Hands out the json event files in paths to the workers that connect to address.
+
+    run returns, for each path, its tracks as a track_collection of json hit
+    indices, and a report with the wall time, the worker count and the
+    utilisation of the workers: total solve time / (wall time * workers).
+    How well the work scales with the workers is measured by scaling.
+    """
+    def __init__(self, paths, address=("localhost", 0), heartbeat_timeout=10.0):
+        self.paths = list(paths)
+        self.heartbeat_timeout = heartbeat_timeout
+        self.pending = collections.deque(range(len(self.paths)))
+        self.results = {}
+        self.times = {}
+        self.workers = []
+        self.reassigned = 0
+        self.wall_time = None
+        self.lock = threading.Lock()
+        self.done = threading.Event()
+        if len(self.paths) == 0:
+            self.done.set()
+        self.server = tcp_server(address, coordinator_handler)
+        self.server.coordinator = self
+
+    @property
+    def address(self):
+        return self.server.server_address
+
+    def serve_worker(self, sock):
+        worker = worker_state(sock)
+        with self.lock:
+            self.workers.append(worker)
+        try:
+            while True:
+                kind, payload = receive_frame(sock)
+                worker.last_seen = time.perf_counter()
+                if kind == b"H":
+                    worker.name = payload.decode()
+                elif kind == b"R":
+                    self.send_task(worker)
+                elif kind == b"O":
+                    task, elapsed = RESULT.unpack(payload[:RESULT.size])
+                    self.add_result(worker, task, elapsed, read_track_collection(payload[RESULT.size:]))
+        except (EOFError, OSError):
+            pass
+        finally:
+            self.lose_worker(worker)
+
+    def send_task(self, worker):
+        with self.lock:
+            task = self.pending.popleft() if len(self.pending) > 0 and worker.alive else None
+            if task is not None:
+                worker.tasks.add(task)
+        if task is not None:
+            with open(self.paths[task], 'rb') as f:
+                worker.send(b"T", TASK.pack(task) + f.read())
+        elif self.done.is_set():
+            worker.send(b"D")
+        else:
+            worker.send(b"W")
+
+    def add_result(self, worker, task, elapsed, collection):
+        with self.lock:
+            worker.tasks.discard(task)
+            if task not in self.results:
+                self.results[task] = collection
+                self.times[task] = elapsed
+            if len(self.results) == len(self.paths):
+                self.done.set()
+
+    def lose_worker(self, worker):
+        """Puts the unfinished tasks of worker back at the front of the queue."""
+        with self.lock:
+            worker.alive = False
+            for task in worker.tasks:
+                if task not in self.results:
+                    self.pending.appendleft(task)
+                    self.reassigned += 1
+            worker.tasks = set()
+
+    def monitor(self):
+        while not self.done.wait(self.heartbeat_timeout / 4):
+            now = time.perf_counter()
+            for worker in list(self.workers):
+                if worker.alive and now - worker.last_seen > self.heartbeat_timeout:
+                    self.lose_worker(worker)
+                    try:
+                        worker.sock.shutdown(socket.SHUT_RDWR)
+                    except OSError:
+                        pass
+
+    def run(self):
+        start = time.perf_counter()
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        threading.Thread(target=self.monitor, daemon=True).start()
+        self.done.wait()
+        wall_time = self.wall_time = time.perf_counter() - start
+        # Give the workers the chance to hear they are done
+        time.sleep(0.2)
+        self.server.shutdown()
+        self.server.server_close()
+        n_workers = len(set(w.name for w in self.workers))
+        total = sum(self.times.values())
+        report = "%d events on %d workers in %.2fs, %.2f events/s, total solve time %.2fs, " \
+                 "utilisation %.1f%%, %d tasks reassigned" % \
+                 (len(self.paths), n_workers, wall_time, len(self.paths) / wall_time if wall_time > 0 else 0.,
+                  total, 100. * total / (wall_time * n_workers) if n_workers > 0 and wall_time > 0 else 0.,
+                  self.reassigned)
+        return [self.results[task] for task in range(len(self.paths))], report
+
+
+def run_worker(address, solver, name=None, heartbeat_interval=1.0):
+    """Connects to the coordinator at address and solves tasks until it is done."""
+    sock = socket.create_connection(address)
+    worker = worker_state(sock)
+    stop = threading.Event()
+
+    def heartbeat():
+        while not stop.wait(heartbeat_interval):
+            try:
+                worker.send(b"P")
+            except OSError:
+                return
+
+    threading.Thread(target=heartbeat, daemon=True).start()
+    try:
+        worker.send(b"H", (name or "%s:%d" % (socket.gethostname(), multiprocessing.current_process().pid)).encode())
+        while True:
+            worker.send(b"R")
+            kind, payload = receive_frame(sock)
+            if kind == b"D":
+                break
+            if kind == b"W":
+                time.sleep(heartbeat_interval / 4)
+                continue
+            task, = TASK.unpack(payload[:TASK.size])
+            json_data = json.loads(payload[TASK.size:].decode())
+            event = em.event(json_data)
+            start = time.perf_counter()
+            tracks = solver.solve(event)
+            elapsed = time.perf_counter() - start
+            collection = em.track_collection.from_tracks(tracks, json_data["event"]["hit_id"])
+            worker.send(b"O", RESULT.pack(task, elapsed) + pack_tracks(collection))
+    except (EOFError, OSError):
+        pass
+    finally:
+        stop.set()
+        sock.close()
+
+
+def scaling(paths, solver_name, worker_counts, heartbeat_timeout=10.0):
+    """Runs a coordinator and n local worker processes for each n in worker_counts.
+    Returns the report of each run, with its scaling efficiency T1 / (n * Tn) from the
+    wall times Tn of the runs; T1 is taken as m * Tm if the fewest workers run is m > 1.
+    """
+    reports = []
+    wall_times = []
+    for n in worker_counts:
+        c = coordinator(paths, heartbeat_timeout=heartbeat_timeout)
+        workers = [multiprocessing.Process(target=run_worker, args=(c.address, make_solver(solver_name), "worker%d" % i))
+                   for i in range(n)]
+        for w in workers:
+            w.start()
+        _, report = c.run()
+        for w in workers:
+            w.join()
+        reports.append(report)
+        wall_times.append(c.wall_time)
+    if len(reports) == 0:
+        return reports
+    n_base, t_base = min(zip(worker_counts, wall_times))
+    return ["%s, scaling efficiency %.1f%%" % (report, 100. * n_base * t_base / (n * t) if t > 0 else 0.)
+            for report, n, t in zip(reports, worker_counts, wall_times)]
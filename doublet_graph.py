@@ -0,0 +1,200 @@
+"""The doublet graph of an event, built once at loose cuts and cut tighter by thresholding.
+
+A looser slope window gives a superset of the doublets, and the tolerance
+and scatter cuts only filter triplets (pairs of doublets sharing a hit). So
+doublet_graph keeps, next to every doublet and triplet of the loosest cuts,
+the values these cuts are applied to: |dx|, |dy| and |dz| of each doublet,
+and the extrapolation dx, dy and scatter of each triplet. cut then selects
+the doublets and triplets of any tighter cuts by comparing them, with the
+same floating point operations as the solver kernels, so the result is
+identical to building the graph at those cuts.
+
+The graph keeps the hit pairs compatible in x between each sensor and the
+sensors steps further on. Both solvers take their doublets from them:
+CellularAutomaton (solve_graph) the ones to the next two sensors of the same
+side, grouped by their ending hit, and graph_dfs (solve_graph) its segments,
+in the first run of x compatible hits of each candidate sensor. So comparing
+or combining the two pays for pair building once. Their triplet checks
+extrapolate in opposite directions, so each has its own triplets.
+"""
+import layer_kernels
+import numpy as np
+
+
+NEXT_SENSOR = 2
+SECOND_NEXT_SENSOR = 4
+
+
+class doublet_graph(object):
+    """Hit pairs and CellularAutomaton triplets of event at the cuts max_slopes, max_tolerance and max_scatter.
+
+    pairs[(sensor index, step)]: (starts, ends, ax, ay, az)
+      the pairs compatible in x of a hit of the sensor (start) and a hit of the sensor step further (end),
+      ordered by end and then start hit, with the absolute x, y and z distance between the two hits.
+    steps: the sensor steps of the pairs; CellularAutomaton needs NEXT_SENSOR and SECOND_NEXT_SENSOR,
+      graph_dfs 1 and 2 (allow_cross_track) or 2 and 4 (by default skipping one sensor).
+    """
+    def __init__(self, event, max_slopes=(0.7, 0.7), max_tolerance=(0.4, 0.4), max_scatter=0.4,
+                 steps=(NEXT_SENSOR, SECOND_NEXT_SENSOR), executor=None):
+        self.event = event
+        self.max_slopes = tuple(max_slopes)
+        self.max_tolerance = tuple(max_tolerance)
+        self.max_scatter = max_scatter
+        self.steps = tuple(sorted(set(steps)))
+        self.executor = executor
+        self.hit_x, self.hit_y, self.hit_z = layer_kernels.hit_arrays(event.hits)
+        keys = [(index, step) for index in range(len(event.sensors)) for step in self.steps
+                if index + step < len(event.sensors)]
+        self.pairs = dict(zip(keys, layer_kernels.run_layers(lambda key: self.pair_layer(*key), keys, executor)))
+        self.doublets = None
+        self.triplets = None
+
+    def hit_range(self, index):
+        sensor = self.event.sensors[index]
+        return slice(sensor.hit_start_index, sensor.hit_end_index)
+
+    def pair_layer(self, index, step):
+        x0, z0 = self.hit_x[self.hit_range(index)], self.hit_z[self.hit_range(index)]
+        next_range = self.hit_range(index + step)
+        rows, columns = np.nonzero(layer_kernels.compatible(x0, z0, self.hit_x[next_range], self.hit_z[next_range],
+                                                            self.max_slopes[0]))
+        starts, ends = columns + self.hit_range(index).start, rows + next_range.start
+        return (starts, ends, np.abs(self.hit_x[ends] - self.hit_x[starts]),
+                np.abs(self.hit_y[ends] - self.hit_y[starts]), np.abs(self.hit_z[ends] - self.hit_z[starts]))
+
+    def require_steps(self, steps):
+        if any(step not in self.steps for step in steps):
+            raise ValueError("The graph has the sensor steps %s, %s are needed" % (self.steps, tuple(steps)))
+
+    def check_cuts(self, max_slopes, max_tolerance, max_scatter):
+        if any(s > loose for s, loose in zip(max_slopes, self.max_slopes)) or \
+                any(t > loose for t, loose in zip(max_tolerance, self.max_tolerance)) or max_scatter > self.max_scatter:
+            raise ValueError("Cuts (%s, %s, %s) are looser than the ones of the graph (%s, %s, %s)" %
+                             (max_slopes, max_tolerance, max_scatter, self.max_slopes, self.max_tolerance, self.max_scatter))
+
+    def doublet_layer(self, index):
+        """CellularAutomaton doublets of sensor index at the graph cuts: (starts, ends, groups, n_groups, ax, ay, az)."""
+        starts, ends, groups, ax, ay, az = [], [], [], [], [], []
+        n_groups = 0
+        for step in (NEXT_SENSOR, SECOND_NEXT_SENSOR):
+            if index + step >= len(self.event.sensors):
+                continue
+            pair_starts, pair_ends, pair_ax, pair_ay, pair_az = self.pairs[(index, step)]
+            keep = pair_ay < self.max_slopes[1] * pair_az
+            starts.append(pair_starts[keep])
+            ends.append(pair_ends[keep])
+            groups.append(pair_ends[keep] - self.hit_range(index + step).start + n_groups)
+            ax.append(pair_ax[keep])
+            ay.append(pair_ay[keep])
+            az.append(pair_az[keep])
+            n_groups += self.hit_range(index + step).stop - self.hit_range(index + step).start
+        return (np.concatenate(starts), np.concatenate(ends), np.concatenate(groups), n_groups,
+                np.concatenate(ax), np.concatenate(ay), np.concatenate(az))
+
+    def triplet_layer(self, index):
+        """CellularAutomaton triplets ending in a doublet of sensor index at the graph cuts:
+        a list of (left sensor index, left, right, dx, dy, scatter), ordered by right doublet.
+        """
+        starts, ends = self.doublets[index][0:2]
+        layer = []
+        left_indices = [index - NEXT_SENSOR]
+        if index >= SECOND_NEXT_SENSOR:
+            left_indices.append(index - SECOND_NEXT_SENSOR)
+        for left_index in left_indices:
+            left_starts, left_ends = self.doublets[left_index][0:2]
+            left, right = layer_kernels.matching_pairs(left_ends, starts)
+            selected, dx, dy, scatter = layer_kernels.triplet_extrapolation(
+                self.hit_x, self.hit_y, self.hit_z, left_starts[left], left_ends[left], ends[right],
+                self.max_tolerance, self.max_scatter)
+            layer.append((left_index, left[selected], right[selected], dx, dy, scatter))
+        return layer
+
+    def build_triplets(self):
+        """Builds the CellularAutomaton doublets and triplets, on first use."""
+        if self.triplets is None:
+            self.require_steps((NEXT_SENSOR, SECOND_NEXT_SENSOR))
+            self.doublets = layer_kernels.run_layers(self.doublet_layer, range(len(self.event.sensors) - NEXT_SENSOR),
+                                                     self.executor)
+            self.triplets = layer_kernels.run_layers(self.triplet_layer, range(NEXT_SENSOR, len(self.doublets)),
+                                                     self.executor)
+
+    def cut(self, max_slopes, max_tolerance, max_scatter, max_doca=None, z_range=None):
+        """The CellularAutomaton graph at cuts at least as tight as the ones it was built with,
+        and the CellularAutomaton pointing cut max_doca, z_range if given.
+
+        Returns the doublets of each sensor, as (starts, ends, groups, positions in group, n_groups),
+        and the left neighbours of the doublets of each sensor from NEXT_SENSOR on,
+        as lists of (left sensor index, doublet, left group, left position in group).
+        """
+        self.check_cuts(max_slopes, max_tolerance, max_scatter)
+        self.build_triplets()
+        kept, indices, doublets = [], [], []
+        for starts, ends, groups, n_groups, ax, ay, az in self.doublets:
+            keep = (ax < max_slopes[0] * az) & (ay < max_slopes[1] * az)
+            if max_doca is not None or z_range is not None:
+                keep &= layer_kernels.pointing(self.hit_x, self.hit_y, self.hit_z, starts, ends, max_doca, z_range)
+            kept.append(keep)
+            indices.append(np.cumsum(keep) - 1)
+            doublets.append((starts[keep], ends[keep], groups[keep], layer_kernels.group_positions(groups[keep]), n_groups))
+        neighbours = []
+        for index, layer in enumerate(self.triplets, NEXT_SENSOR):
+            neighbour_layer = []
+            for left_index, left, right, dx, dy, scatter in layer:
+                keep = kept[left_index][left] & kept[index][right] & \
+                    (dx < max_tolerance[0]) & (dy < max_tolerance[1]) & (scatter < max_scatter)
+                left_doublets = indices[left_index][left[keep]]
+                neighbour_layer.append((left_index, indices[index][right[keep]],
+                                        doublets[left_index][2][left_doublets], doublets[left_index][3][left_doublets]))
+            neighbours.append(neighbour_layer)
+        return doublets, neighbours
+
+    def x_positions(self):
+        """Position of each hit in the event once the hits of each sensor are ordered by x (graph_dfs.order_hits)."""
+        positions = np.zeros(len(self.event.hits), dtype=int)
+        for sensor in self.event.sensors:
+            order = np.argsort(self.hit_x[sensor.hit_start_index:sensor.hit_end_index], kind='stable')
+            positions[order + sensor.hit_start_index] = np.arange(sensor.hit_start_index, sensor.hit_end_index)
+        return positions
+
+    def dfs_segments(self, steps, first_sensor, max_slopes, max_tolerance, max_scatter):
+        """The graph_dfs segments and their compatible segments, at cuts at least as tight as the graph ones.
+
+        steps: the candidate sensor steps, in the order graph_dfs searches them.
+        first_sensor: the first sensor whose hits get candidates.
+        Returns h0 and h1 of every segment, in the graph_dfs order, and the compatible segments of each segment
+        as offsets and values. Hits are positions among the hits ordered by x (see x_positions).
+        """
+        self.check_cuts(max_slopes, max_tolerance, max_scatter)
+        self.require_steps(steps)
+        positions = self.x_positions()
+        h0, step_order, h1, dy_compatible = [], [], [], []
+        for order, step in enumerate(steps):
+            for index in range(first_sensor, len(self.event.sensors)):
+                if index - step < 0:
+                    continue
+                starts, ends, ax, ay, az = self.pairs[(index - step, step)]
+                keep = ax < max_slopes[0] * az
+                h0.append(positions[ends[keep]])
+                h1.append(positions[starts[keep]])
+                step_order.append(np.full(np.count_nonzero(keep), order))
+                dy_compatible.append(ay[keep] < max_slopes[1] * az[keep])
+        h0, h1, step_order, dy_compatible = [np.concatenate(a) for a in (h0, h1, step_order, dy_compatible)]
+        order = np.lexsort((h1, step_order, h0))
+        h0, h1, step_order, dy_compatible = h0[order], h1[order], step_order[order], dy_compatible[order]
+
+        # Keep the first run of consecutive (by x) compatible hits of each candidate sensor
+        window = h0 * len(steps) + step_order
+        window_positions = layer_kernels.group_positions(window)
+        first = np.repeat(h1[window_positions == 0], np.diff(np.r_[np.flatnonzero(window_positions == 0), len(window)]))
+        keep = (h1 - first == window_positions) & dy_compatible
+        h0, h1 = h0[keep], h1[keep]
+
+        ordered_x, ordered_y, ordered_z = [np.empty(len(self.event.hits)) for _ in range(3)]
+        ordered_x[positions], ordered_y[positions], ordered_z[positions] = self.hit_x, self.hit_y, self.hit_z
+        seg0, seg1 = layer_kernels.matching_pairs(h1, h0)
+        compatible = layer_kernels.triplet_tolerance(ordered_x, ordered_y, ordered_z, h0[seg0], h1[seg0], h1[seg1],
+                                                     max_tolerance, max_scatter)
+        seg0, seg1 = seg0[compatible], seg1[compatible]
+        order = np.argsort(seg0, kind='stable')
+        offsets = np.searchsorted(seg0[order], np.arange(len(h0) + 1))
+        return h0, h1, offsets, seg1[order]
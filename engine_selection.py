@@ -0,0 +1,242 @@
+"""Choice of the solver of each event from its occupancy.
+
+The engines (classical_solver, graph_dfs, CellularAutomaton, with their
+parameter sets) trade speed for physics: on the profiled event the classical
+solver takes ~0.14s, the DFS ~0.73s and the CA ~3.4s
+(Profiling/time_measure.csv), and the gap grows with the occupancy. Each
+engine gets a cost and quality model calibrated from benchmark runs: a
+scheduler.cost_model of its solve time, and a linear fit of its efficiency
+against the number of hits and the maximum number of hits in a sensor. Both
+only need the cheap event features of scheduler.event_features.
+
+engine_selector routes every event to the engine of highest predicted
+efficiency among those predicted to meet the target latency (the fastest one
+if none does), and logs each decision with its predictions, measured time and,
+for events with montecarlo data, measured efficiency. With audit, the events
+routed elsewhere are also solved with the engine of highest predicted
+efficiency, so that the throughput gained can be audited against the
+efficiency actually lost by not always running it.
+"""
+from classical_solver import classical_solver
+from graph_dfs import graph_dfs
+from CellularAutomaton.CellularAutomaton import CellularAutomaton
+from scheduler import cost_model, event_features
+import event_model as em
+import validator_lite as vl
+import numpy as np
+import json
+import csv
+import time
+
+
+LOG_FIELDS = ("event", "hits", "max_sensor_hits", "engine", "reason", "predicted_time", "predicted_efficiency", "time",
+              "particles", "reconstructed", "efficiency", "best_engine", "best_reconstructed", "best_efficiency")
+
+
+def default_engines():
+    """The engines to choose from, as (name, solver), fastest first."""
+    return [("classical", classical_solver()),
+            ("dfs", graph_dfs()),
+            ("ca_pointing", CellularAutomaton(max_doca=10., z_range=(-400., 400.))),
+            ("ca", CellularAutomaton())]
+
+
+class engine_model(object):
+    """Cost and quality model of an engine: solve time (cost_model) and efficiency of an event as functions
+    of its features, fitted to measured samples. The efficiency (in %) is linear in the features,
+
+        efficiency = a + b * hits + c * max_sensor_hits
+    """
+    def __init__(self):
+        self.cost = cost_model()
+        self.efficiency_features = []
+        self.efficiencies = []
+        self.efficiency_coefficients = np.array([100., 0., 0.])
+
+    def add(self, features, elapsed, efficiency=None):
+        """Adds a measured sample; efficiency is None for events without particles of the validated type."""
+        self.cost.features.append(tuple(features))
+        self.cost.times.append(elapsed)
+        if efficiency is not None:
+            self.efficiency_features.append(tuple(features))
+            self.efficiencies.append(efficiency)
+
+    def fit(self):
+        self.cost.fit()
+        if len(self.efficiencies) > len(self.efficiency_coefficients):
+            a = np.column_stack([np.ones(len(self.efficiency_features)), np.array(self.efficiency_features, dtype=float)])
+            self.efficiency_coefficients = np.linalg.lstsq(a, np.array(self.efficiencies), rcond=None)[0]
+        elif len(self.efficiencies) > 0:
+            self.efficiency_coefficients = np.array([np.mean(self.efficiencies), 0., 0.])
+
+    def predict(self, features):
+        """Predicted solve time and efficiency of an event."""
+        hits, max_sensor_hits = features
+        a, b, c = self.efficiency_coefficients
+        efficiency = float(a + b * hits + c * max_sensor_hits)
+        return self.cost.predict(features), min(max(efficiency, 0.), 100.)
+
+    def samples(self):
+        return {"features": self.cost.features, "times": self.cost.times,
+                "efficiency_features": self.efficiency_features, "efficiencies": self.efficiencies}
+
+    @staticmethod
+    def from_samples(samples):
+        model = engine_model()
+        for features, elapsed in zip(samples["features"], samples["times"]):
+            model.add(features, elapsed)
+        model.efficiency_features = [tuple(f) for f in samples["efficiency_features"]]
+        model.efficiencies = list(samples["efficiencies"])
+        model.fit()
+        return model
+
+
+def measure_efficiency(validator_event, tracks, particle_type):
+    """The Efficiency of tracks on the particles of particle_type of validator_event, None if it has none."""
+    accumulator = vl.ValidationAccumulator([particle_type])
+    accumulator.add_validator_event(validator_event, tracks)
+    efficiency = accumulator.efficiency(particle_type)
+    return efficiency if efficiency is not None and efficiency.n_particles > 0 else None
+
+
+def best_engine(predictions):
+    """The engine of highest predicted efficiency, the fastest of those if several, given the predictions by name."""
+    return max(predictions, key=lambda n: (predictions[n][1], -predictions[n][0]))
+
+
+def calibrate(engines, paths, particle_type="long>5GeV"):
+    """Solves the json event files in paths with every engine, and returns the engine_model of each,
+    by name, fitted to the measured solve times and particle_type efficiencies.
+    """
+    models = {name: engine_model() for name, _ in engines}
+    for path in paths:
+        with open(path) as f:
+            json_data = json.load(f)
+        features = event_features(json_data)
+        validator_event = vl.parse_json_data(json_data)
+        for name, solver in engines:
+            event = em.event(json_data)
+            start = time.perf_counter()
+            tracks = solver.solve(event)
+            elapsed = time.perf_counter() - start
+            efficiency = measure_efficiency(validator_event, tracks, particle_type)
+            models[name].add(features, elapsed, efficiency.recoeffT if efficiency is not None else None)
+    for model in models.values():
+        model.fit()
+    return models
+
+
+def save_calibration(models, filename):
+    """Writes the samples of the engine models, to be read back with load_calibration."""
+    with open(filename, 'w') as f:
+        json.dump({name: model.samples() for name, model in models.items()}, f, indent=1, sort_keys=True)
+
+
+def load_calibration(filename):
+    with open(filename) as f:
+        return {name: engine_model.from_samples(samples) for name, samples in json.load(f).items()}
+
+
+class engine_selector(object):
+    """Solves each event with the engine of highest predicted efficiency among those predicted to take
+    at most target_latency seconds, or with the fastest one if none does.
+    models: the engine_model of each engine, by name (see calibrate).
+    learn: adds the measured solve times to the cost models of the engines.
+    Events with montecarlo data are validated, and the particle_type efficiency is logged.
+    audit: such events are also solved with the engine of highest predicted efficiency when routed to another one
+    (not counted in the time), to measure the efficiency lost by the routing.
+    """
+    def __init__(self, engines, models, target_latency, learn=True, particle_type="long>5GeV", audit=False):
+        self.engines = dict(engines)
+        self.models = models
+        self.target_latency = target_latency
+        self.learn = learn
+        self.particle_type = particle_type
+        self.audit = audit
+        self.log = []
+
+    def choose(self, features):
+        """Returns the engine name for an event of these features, the reason for the choice,
+        and the predicted time and efficiency of every engine, by name.
+        """
+        predictions = {name: self.models[name].predict(features) for name in self.engines}
+        within = [name for name in self.engines if predictions[name][0] <= self.target_latency]
+        if len(within) > 0:
+            # highest efficiency first, then fastest
+            return min(within, key=lambda n: (-predictions[n][1], predictions[n][0])), "within target", predictions
+        return min(self.engines, key=lambda n: predictions[n][0]), "fastest, none within target", predictions
+
+    def solve(self, event):
+        features = event_features({"event": event.event})
+        name, reason, predictions = self.choose(features)
+        start = time.perf_counter()
+        tracks = self.engines[name].solve(event)
+        elapsed = time.perf_counter() - start
+        if self.learn:
+            self.models[name].cost.update(features, elapsed)
+        decision = {"event": len(self.log), "hits": features[0], "max_sensor_hits": features[1],
+                    "engine": name, "reason": reason, "predicted_time": predictions[name][0],
+                    "predicted_efficiency": predictions[name][1], "time": elapsed, "predictions": predictions,
+                    "particles": None, "reconstructed": None, "efficiency": None,
+                    "best_engine": best_engine(predictions), "best_reconstructed": None, "best_efficiency": None}
+        if event.montecarlo:
+            self.validate(decision, event, tracks)
+        self.log.append(decision)
+        return tracks
+
+    def validate(self, decision, event, tracks):
+        """Adds the measured efficiency of the tracks of event to its decision, and that of the best engine if audited."""
+        validator_event = vl.parse_json_data({"event": event.event, "montecarlo": event.montecarlo})
+        efficiency = measure_efficiency(validator_event, tracks, self.particle_type)
+        if efficiency is None:
+            return
+        decision["particles"], decision["reconstructed"], decision["efficiency"] = \
+            efficiency.n_particles, efficiency.n_reco, efficiency.recoeffT
+        best = decision["best_engine"]
+        if best == decision["engine"]:
+            decision["best_reconstructed"], decision["best_efficiency"] = efficiency.n_reco, efficiency.recoeffT
+        elif self.audit:
+            best_efficiency = measure_efficiency(validator_event, self.engines[best].solve(event.copy()), self.particle_type)
+            decision["best_reconstructed"], decision["best_efficiency"] = best_efficiency.n_reco, best_efficiency.recoeffT
+
+    def write_log(self, filename):
+        """Writes the decisions, one row per event."""
+        with open(filename, 'w') as f:
+            writer = csv.writer(f)
+            writer.writerow(LOG_FIELDS)
+            for decision in self.log:
+                writer.writerow([decision[field] for field in LOG_FIELDS])
+
+    def report(self):
+        """Summary of the decisions: the events given to each engine, the time taken against that predicted for always
+        running the engine of highest predicted efficiency, and the measured efficiency (over the validated events)
+        against that of the best engines: measured if audited, else predicted.
+        """
+        if len(self.log) == 0:
+            return "no events"
+        counts = {name: 0 for name in self.engines}
+        for decision in self.log:
+            counts[decision["engine"]] += 1
+        elapsed = sum(d["time"] for d in self.log)
+        best_time = sum(d["predictions"][d["best_engine"]][0] for d in self.log)
+        lines = ["%d events, target latency %.3fs: %s" %
+                 (len(self.log), self.target_latency, ", ".join("%s %d" % (n, c) for n, c in counts.items())),
+                 " time %.3fs (%.1f events/s), %d over target; best efficiency engines predicted %.3fs (%.1f events/s)" %
+                 (elapsed, len(self.log) / elapsed if elapsed > 0 else 0., sum(1 for d in self.log if d["time"] > self.target_latency),
+                  best_time, len(self.log) / best_time if best_time > 0 else 0.)]
+        validated = [d for d in self.log if d["efficiency"] is not None]
+        if len(validated) == 0:
+            lines.append(" no validated events, predicted efficiency %.1f%%" % np.mean([d["predicted_efficiency"] for d in self.log]))
+            return "\n".join(lines)
+        particles = sum(d["particles"] for d in validated)
+        efficiency = 100. * sum(d["reconstructed"] for d in validated) / particles
+        predicted = np.mean([d["predicted_efficiency"] for d in validated])
+        if all(d["best_efficiency"] is not None for d in validated):
+            best_efficiency = 100. * sum(d["best_reconstructed"] for d in validated) / particles
+            best_source = "measured"
+        else:
+            best_efficiency = np.mean([d["predictions"][d["best_engine"]][1] for d in validated])
+            best_source = "predicted"
+        lines.append(" %s efficiency %.1f%% on %d validated events (predicted %.1f%%), best efficiency engines %s %.1f%% (%.1f%% lost)" %
+                     (self.particle_type, efficiency, len(validated), predicted, best_source, best_efficiency, best_efficiency - efficiency))
+        return "\n".join(lines)
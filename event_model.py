@@ -133,4 +133,34 @@ class doublets(object):
         self.state = 1
         self.new_state = 1
         self.used = False
-        self.left_neighbours = []
\ No newline at end of file
+        self.left_neighbours = []
+
+class track_collection(object):
+    """Compact form of a list of tracks, as two integer arrays.
+    The hits of track i are hits[hit_indices[offsets[i]:offsets[i + 1]]],
+    where hits is the hit list of the event.
+    """
+    def __init__(self, offsets, hit_indices):
+        self.offsets = offsets
+        self.hit_indices = hit_indices
+
+    @staticmethod
+    def from_tracks(tracks, hit_ids):
+        """Builds the collection of tracks, made of hits of the event whose
+        hit list has the given hit ids.
+        """
+        index = {hit_id: i for i, hit_id in enumerate(hit_ids)}
+        offsets = np.zeros(len(tracks) + 1, dtype=np.int64)
+        offsets[1:] = np.cumsum([len(t.hits) for t in tracks])
+        hit_indices = np.array([index[h.id] for t in tracks for h in t.hits], dtype=np.int64)
+        return track_collection(offsets, hit_indices)
+
+    def to_tracks(self, hits):
+        tracks = []
+        for start, end in zip(self.offsets[:-1], self.offsets[1:]):
+            track_hits = [hits[i] for i in self.hit_indices[start:end]]
+            tracks.append(track(track_hits, len(track_hits)))
+        return tracks
+
+    def __len__(self):
+        return len(self.offsets) - 1
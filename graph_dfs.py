@@ -1,4 +1,17 @@
 from event_model import *
+import layer_kernels
+import checkpoint
+import track_selection
+import numpy as np
+
+
+# Stages after which solve_checkpointed can save (and later resume from) the state of the solve
+STAGES = ("candidates", "segments", "weights", "tracks")
+# Parameters only used by the stages after each one, which may change when resuming from its checkpoint
+LATER_PARAMETERS = {"candidates": ("max_tolerance", "max_scatter", "weight_assignment_iterations", "minimum_root_weight",
+                                   "clone_ghost_killing"),
+                    "segments": ("weight_assignment_iterations", "minimum_root_weight", "clone_ghost_killing"),
+                    "weights": ("minimum_root_weight", "clone_ghost_killing"), "tracks": ("clone_ghost_killing",)}
 
 
 class segment(object):
@@ -42,7 +55,10 @@ class graph_dfs(object):
 
     def __init__(self, max_slopes=(0.7, 0.7), max_tolerance=(0.4, 0.4), max_scatter=0.4,
                  minimum_root_weight=1, weight_assignment_iterations=2, allowed_skip_sensors=1,
-                 allow_cross_track=True, clone_ghost_killing=True):
+                 allow_cross_track=True, clone_ghost_killing=True, executor=None):
+        """executor: optional concurrent.futures executor (eg. a ThreadPoolExecutor)
+        the candidate search of each sensor is spread over.
+        """
         self.__max_slopes = max_slopes
         self.__max_tolerance = max_tolerance
         self.__max_scatter = max_scatter
@@ -51,6 +67,7 @@ class graph_dfs(object):
         self.__allow_cross_track = allow_cross_track
         self.__allowed_skip_sensors = allowed_skip_sensors
         self.__clone_ghost_killing = clone_ghost_killing
+        self.__executor = executor
 
     def are_compatible_in_x(self, hit_0, hit_1):
         """Checks if two hits are compatible according
@@ -127,6 +144,47 @@ class graph_dfs(object):
         for h in range(0, len(event.hits)):
             event.hits[h].hit_number = h
 
+    def candidate_sensors(self, event, starting_sensor_index):
+        """Sensors in which candidates are searched, for the hits of the sensor
+        following starting_sensor_index.
+        """
+        sensor_indices = []
+        for missing_sensors in range(0, self.__allowed_skip_sensors + 1):
+            sensor_index = starting_sensor_index - missing_sensors * 2
+            if self.__allow_cross_track:
+                sensor_index = starting_sensor_index - missing_sensors
+            if sensor_index >= 0:
+                sensor_indices.append(sensor_index)
+        return sensor_indices
+
+    def candidate_layer(self, event, hit_x, hit_z, s0, starting_sensor_index):
+        """Candidate windows of all hits of s0, for each candidate sensor.
+        The window of a hit is the first run of hits compatible in x
+        (hits are ordered by x). Returns a list of (sensor index, window starts, window ends).
+        """
+        x0, z0 = hit_x[s0.hit_start_index:s0.hit_end_index], hit_z[s0.hit_start_index:s0.hit_end_index]
+        layer = []
+        for sensor_index in self.candidate_sensors(event, starting_sensor_index):
+            s1 = event.sensors[sensor_index]
+            x1, z1 = hit_x[s1.hit_start_index:s1.hit_end_index], hit_z[s1.hit_start_index:s1.hit_end_index]
+            if len(x1) == 0:
+                layer.append((sensor_index, np.full(len(x0), -1), np.full(len(x0), -1)))
+                continue
+            compatible = layer_kernels.compatible(x1, z1, x0, z0, self.__max_slopes[0])
+            found = compatible.any(axis=1)
+            begin = np.argmax(compatible, axis=1)
+            after = ~compatible & (np.arange(len(x1))[None, :] > begin[:, None])
+            end = np.where(after.any(axis=1), np.argmax(after, axis=1), len(x1))
+            layer.append((sensor_index, np.where(found, begin + s1.hit_start_index, -1),
+                          np.where(found, end + s1.hit_start_index, -1)))
+        return layer
+
+    def candidate_steps(self):
+        """Distances from a sensor to its candidate sensors, in the order candidate_sensors gives them."""
+        if self.__allow_cross_track:
+            return [1 + missing_sensors for missing_sensors in range(0, self.__allowed_skip_sensors + 1)]
+        return [2 + missing_sensors * 2 for missing_sensors in range(0, self.__allowed_skip_sensors + 1)]
+
     def fill_candidates(self, event):
         """Fill candidates
         index: hit index
@@ -136,28 +194,14 @@ class graph_dfs(object):
         substraction_starting_sensor = 2
         if self.__allow_cross_track:
             substraction_starting_sensor = 1
-        for s0, starting_sensor_index in zip(reversed(event.sensors[2:]), reversed(range(0, len(event.sensors) - substraction_starting_sensor))):
-            for h0 in s0.hits():
-                for missing_sensors in range(0, self.__allowed_skip_sensors + 1):
-                    sensor_index = starting_sensor_index - missing_sensors * 2
-                    if self.__allow_cross_track:
-                        sensor_index = starting_sensor_index - missing_sensors
-                    if sensor_index >= 0:
-                        s1 = event.sensors[sensor_index]
-                        begin_found = False
-                        end_found = False
-                        candidates[h0.hit_number][sensor_index] = [-1, -1]
-                        for h1 in s1.hits():
-                            if not begin_found and self.are_compatible_in_x(h0, h1):
-                                candidates[h0.hit_number][sensor_index][0] = h1.hit_number
-                                candidates[h0.hit_number][sensor_index][1] = h1.hit_number + 1
-                                begin_found = True
-                            elif begin_found and not self.are_compatible_in_x(h0, h1):
-                                candidates[h0.hit_number][sensor_index][1] = h1.hit_number
-                                end_found = True
-                                break
-                        if begin_found and not end_found:
-                            candidates[h0.hit_number][sensor_index][1] = s1.hits()[-1].hit_number+1
+        hit_x, _, hit_z = layer_kernels.hit_arrays(event.hits)
+        sensors = list(zip(reversed(event.sensors[2:]), reversed(range(0, len(event.sensors) - substraction_starting_sensor))))
+        layers = layer_kernels.run_layers(lambda sensor: self.candidate_layer(event, hit_x, hit_z, *sensor),
+                                          sensors, self.__executor)
+        for (s0, _), layer in zip(sensors, layers):
+            for sensor_index, begins, ends in layer:
+                for h0_number, begin, end in zip(range(s0.hit_start_index, s0.hit_end_index), begins.tolist(), ends.tolist()):
+                    candidates[h0_number][sensor_index] = [begin, end]
         return candidates
 
     def populate_segments(self, event, candidates):
@@ -228,16 +272,12 @@ class graph_dfs(object):
         """Kills clones and weak tracks with
         three hits and a shared hit.
         """
-        used_hits = []
-        for t in tracks:
-            if len(t.hits) > 3:
-                for h in t.hits:
-                    used_hits.append(h.hit_number)
-
-        return [t for t in tracks if \
-                len(t.hits) > 3 or \
-                all(h.hit_number not in used_hits for h in t.hits)
-                ]
+        hit_numbers = [h.hit_number for t in tracks for h in t.hits]
+        offsets = np.zeros(len(tracks) + 1, dtype=int)
+        offsets[1:] = np.cumsum([len(t.hits) for t in tracks])
+        selected = track_selection.select_weak(offsets, np.array(hit_numbers, dtype=int),
+                                               max(hit_numbers, default=-1) + 1, 4)
+        return [tracks[i] for i in selected.tolist()]
 
     def print_compatible_segments(self, segments, compatible_segments, populated_compatible_segments):
         """Prints all compatible segments."""
@@ -257,6 +297,87 @@ class graph_dfs(object):
                self.__minimum_root_weight, self.__allow_cross_track, self.__allowed_skip_sensors, \
                self.__clone_ghost_killing))
 
+        return self.solve_checkpointed(event)
+
+    def find_tracks(self, segments, compatible_segments, populated_compatible_segments):
+        """Depth first search from every root segment."""
+        root_segments = [segid for segid in populated_compatible_segments \
+                         if segments[segid].root_segment == True and \
+                         segments[segid].weight >= self.__minimum_root_weight]
+
+        # print("Found %d root segments" % (len(root_segments)))
+
+        tracks = []
+        for segment_id in root_segments:
+            root_segment = segments[segment_id]
+            tracks += [track([root_segment.h0] + dfs_segments) for dfs_segments in self.dfs(root_segment, segments, compatible_segments)]
+        return tracks
+
+    def stage_arrays(self, event, stage, state):
+        """The state of the solve after stage, as arrays to checkpoint.
+        candidates: the candidate windows of every hit, segments: the segments and their compatible segments,
+        weights: also their weight and root flag, tracks: the tracks found by the dfs only.
+        Hits are indices into the hits of event, ordered by order_hits.
+        """
+        if stage == "tracks":
+            return checkpoint.tracks_arrays(state["tracks"], event.hits)
+        if stage == "candidates":
+            offsets, windows = checkpoint.flatten([[v for sensor_index, (begin, end) in candidates.items()
+                                                    for v in (sensor_index, begin, end)] for candidates in state["candidates"]])
+            return {"candidate_offsets": offsets // 3, "candidates": windows.reshape(-1, 3)}
+        segments = state["segments"]
+        offsets, compatible = checkpoint.flatten(state["compatible_segments"])
+        arrays = {"segment_hits": np.array([[seg.h0.hit_number, seg.h1.hit_number] for seg in segments],
+                                           dtype=np.int32).reshape(-1, 2),
+                  "compatible_offsets": offsets, "compatible": compatible}
+        if stage == "weights":
+            arrays["weights"] = np.array([seg.weight for seg in segments], dtype=np.int32)
+            arrays["roots"] = np.array([seg.root_segment for seg in segments], dtype=np.int8)
+        return arrays
+
+    def restore_stage(self, event, stage, arrays):
+        """The state of the solve of event (ordered by order_hits) after stage, from its checkpointed arrays."""
+        if stage == "tracks":
+            return {"tracks": checkpoint.arrays_tracks(arrays, event.hits)}
+        if stage == "candidates":
+            windows = checkpoint.unflatten(arrays["candidate_offsets"] * 3, arrays["candidates"].reshape(-1))
+            return {"candidates": [{w[i]: [w[i + 1], w[i + 2]] for i in range(0, len(w), 3)} for w in windows]}
+        segments = [segment(event.hits[h0], event.hits[h1], number)
+                    for number, (h0, h1) in enumerate(arrays["segment_hits"].tolist())]
+        compatible_segments = checkpoint.unflatten(arrays["compatible_offsets"], arrays["compatible"])
+        if stage == "weights":
+            for seg, weight, root in zip(segments, arrays["weights"].tolist(), arrays["roots"].tolist()):
+                seg.weight = weight
+                seg.root_segment = bool(root)
+        return {"segments": segments, "compatible_segments": compatible_segments,
+                "populated_compatible_segments": [seg_index for seg_index in range(0, len(compatible_segments))
+                                                  if len(compatible_segments[seg_index]) > 0]}
+
+    def graph_segments(self, event, graph):
+        """The segments of event (ordered by order_hits) and their compatible segments,
+        from a doublet_graph.doublet_graph of the event built with the candidate steps.
+        """
+        h0, h1, offsets, compatible = graph.dfs_segments(self.candidate_steps(), 2, self.__max_slopes,
+                                                         self.__max_tolerance, self.__max_scatter)
+        segments = [segment(event.hits[h0_number], event.hits[h1_number], number)
+                    for number, (h0_number, h1_number) in enumerate(zip(h0.tolist(), h1.tolist()))]
+        compatible_segments = checkpoint.unflatten(offsets, compatible)
+        return {"segments": segments, "compatible_segments": compatible_segments,
+                "populated_compatible_segments": [seg_index for seg_index in range(0, len(compatible_segments))
+                                                  if len(compatible_segments[seg_index]) > 0]}
+
+    def solve_graph(self, graph):
+        """Solves the event of graph (a doublet_graph.doublet_graph built with the steps of candidate_steps),
+        taking the segments from it. The result is the same as solve(graph.event).
+        """
+        return self.solve_checkpointed(graph.event, graph=graph)
+
+    def solve_checkpointed(self, event, directory=None, save=(), resume=None, graph=None):
+        """Solves the event like solve, saving a checkpoint of the state in directory after each stage in save,
+        and, if resume is the name of a stage, starting from its checkpoint rather than from the beginning.
+        The checkpoint must have been taken with the same parameters, but for the LATER_PARAMETERS of its stage.
+        With a doublet graph of the event, the segments are taken from it.
+        """
         # 0. Preorder all hits in each sensor by x,
         #    and update their hit_number.
 
@@ -264,34 +385,49 @@ class graph_dfs(object):
         event_copy = event.copy()
         self.order_hits(event_copy)
 
+        if graph is not None:
+            first, state = STAGES.index("segments") + 1, self.graph_segments(event_copy, graph)
+        elif resume is None:
+            first, state = 0, {}
+        else:
+            first = STAGES.index(resume) + 1
+            arrays = checkpoint.load(directory, resume, event, self, LATER_PARAMETERS[resume])
+            state = self.restore_stage(event_copy, resume, arrays)
+
+        def stage_done(stage):
+            if stage in save:
+                checkpoint.save(directory, stage, event, self.stage_arrays(event_copy, stage, state), self)
+
         # 1. Fill candidates
         #     index: hit index
         #     contents: [candidate start, candidate end]
-        candidates = self.fill_candidates(event_copy)
+        if first <= 0:
+            state["candidates"] = self.fill_candidates(event_copy)
+            stage_done("candidates")
 
         # 2. Create all segments, indexed by outer hit number
-        (segments, outer_hit_segment_list, compatible_segments, populated_compatible_segments) = \
-            self.populate_segments(event_copy, candidates)
+        if first <= 1:
+            state["segments"], _, state["compatible_segments"], state["populated_compatible_segments"] = \
+                self.populate_segments(event_copy, state["candidates"])
+            stage_done("segments")
 
         # self.print_compatible_segments(segments, compatible_segments, populated_compatible_segments)
 
         # 3. Assign weights and get roots
-        self.assign_weights_and_populate_roots(segments, compatible_segments, populated_compatible_segments)
-
-        root_segments = [segid for segid in populated_compatible_segments \
-                         if segments[segid].root_segment == True and \
-                         segments[segid].weight >= self.__minimum_root_weight]
-
-        # print("Found %d root segments" % (len(root_segments)))
+        if first <= 2:
+            self.assign_weights_and_populate_roots(state["segments"], state["compatible_segments"],
+                                                   state["populated_compatible_segments"])
+            stage_done("weights")
 
         # 4. Depth first search
-        tracks = []
-        for segment_id in root_segments:
-            root_segment = segments[segment_id]
-            tracks += [track([root_segment.h0] + dfs_segments) for dfs_segments in self.dfs(root_segment, segments, compatible_segments)]
+        if first <= 3:
+            state["tracks"] = self.find_tracks(state["segments"], state["compatible_segments"],
+                                               state["populated_compatible_segments"])
+            stage_done("tracks")
 
         # 5. Clone and ghost killing
         # Note: For now, just short track killing
+        tracks = state["tracks"]
         if self.__clone_ghost_killing:
             tracks = self.prune_short_tracks(tracks)
 
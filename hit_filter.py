@@ -0,0 +1,182 @@
+"""Pre-filter that drops isolated hits before the solvers see the event.
+
+A hit that is not slope compatible (in x and y) with any hit of the sensors
+steps away, on either side, cannot be part of any doublet, segment or seed
+built with these steps. The mask of connected hits is computed a sensor pair
+at a time with the layer kernels, and the event is rebuilt without the other
+hits (unless there are none).
+
+The filter is not a performance change. At the solvers' own slope cut (0.7)
+no hit is isolated, and the filter only adds its pairwise pass. A tighter
+window is a heuristic: max_slopes (0.15, 0.15) removes 2.8% of the hits of
+events 0, 16, 18, 23 and 25 and 2.9% of their doublets, and keeps the
+long>5GeV efficiency of the three solvers, but the wall time including the
+filter is +14% for classical_solver and within 4% of the unfiltered one for
+graph_dfs and CellularAutomaton. Noise does not help it: with as many
+uniformly random hits added (add_noise, noise 1) the doublets quadruple, but
+the filter removes only 1.5% of the hits (a random hit almost always has a
+compatible hit on one of the 8 sensors it is checked against) and 1.2% of
+the doublets, and the wall times stay within 3% (run_hit_filter.py, fastest
+of 3 runs). compare reports, for any data, the wall time, the doublets
+(count_doublets) and the efficiency with and without the filter, and the
+time spent filtering.
+
+prefiltered_solver wraps any solver, and counts the hits it removed and the
+time it took.
+"""
+from doublet_graph import doublet_graph
+import event_model as em
+import validator_lite as vl
+import layer_kernels
+import numpy as np
+import json
+import time
+
+
+# Sensor distances covering the candidate sensors of all the solvers:
+# classical_solver and graph_dfs look 1 to 3 sensors ahead, CellularAutomaton 2 and 4
+STEPS = (1, 2, 3, 4)
+
+
+def connected_hits(event, max_slopes=(0.7, 0.7), steps=STEPS, executor=None):
+    """Boolean mask of the hits of event with a compatible hit on a sensor steps away, either side."""
+    hit_x, hit_y, hit_z = layer_kernels.hit_arrays(event.hits)
+    pairs = [(index, index + step) for step in steps for index in range(len(event.sensors) - step)]
+
+    def partners(pair):
+        s0, s1 = [slice(event.sensors[i].hit_start_index, event.sensors[i].hit_end_index) for i in pair]
+        compatible = layer_kernels.compatible(hit_x[s0], hit_z[s0], hit_x[s1], hit_z[s1], max_slopes[0]) & \
+            layer_kernels.compatible(hit_y[s0], hit_z[s0], hit_y[s1], hit_z[s1], max_slopes[1])
+        return s0, compatible.any(axis=0), s1, compatible.any(axis=1)
+
+    connected = np.zeros(len(event.hits), dtype=bool)
+    for s0, found_0, s1, found_1 in layer_kernels.run_layers(partners, pairs, executor):
+        connected[s0] |= found_0
+        connected[s1] |= found_1
+    return connected
+
+
+def filter_event(event, keep):
+    """A new event with only the hits where keep is set. Hit ids and Monte Carlo information are unchanged."""
+    hits = [h for h, k in zip(event.hits, keep.tolist()) if k]
+    counts = np.array([np.count_nonzero(keep[s.hit_start_index:s.hit_end_index]) for s in event.sensors], dtype=int)
+    description = dict(event.event)
+    description.update({
+        "number_of_hits": len(hits),
+        "sensor_hits_starting_index": (np.cumsum(counts) - counts).tolist(),
+        "sensor_number_of_hits": counts.tolist(),
+        "hit_x": [h.x for h in hits], "hit_y": [h.y for h in hits], "hit_z": [h.z for h in hits],
+        "hit_id": [h.id for h in hits]})
+    return em.event({"event": description, "montecarlo": event.montecarlo})
+
+
+def add_noise(json_data, noise, seed=0):
+    """A copy of the json event json_data with noise times as many hits on each sensor, drawn uniformly
+    over the x, y and z range of the sensor's hits. The noise hits get new ids, and belong to no particle.
+    """
+    rng = np.random.RandomState(seed)
+    description = json_data["event"]
+    next_id = max(description["hit_id"]) + 1
+    hit_x, hit_y, hit_z, hit_id, counts = [], [], [], [], []
+    for start, count in zip(description["sensor_hits_starting_index"], description["sensor_number_of_hits"]):
+        sensor_hits = [description[coordinate][start:start + count] for coordinate in ("hit_x", "hit_y", "hit_z")]
+        n_noise = int(round(noise * count))
+        for coordinates, values in zip((hit_x, hit_y, hit_z), sensor_hits):
+            coordinates.extend(values)
+            if n_noise > 0:
+                coordinates.extend(rng.uniform(min(values), max(values), n_noise).tolist())
+        hit_id.extend(description["hit_id"][start:start + count])
+        hit_id.extend(range(next_id, next_id + n_noise))
+        next_id += n_noise
+        counts.append(count + n_noise)
+    noisy = dict(description)
+    noisy.update({
+        "number_of_hits": len(hit_id),
+        "sensor_hits_starting_index": (np.cumsum(counts) - counts).tolist(),
+        "sensor_number_of_hits": counts,
+        "hit_x": hit_x, "hit_y": hit_y, "hit_z": hit_z, "hit_id": hit_id})
+    return dict(json_data, event=noisy)
+
+
+def count_doublets(event, max_slopes=(0.7, 0.7)):
+    """The number of CellularAutomaton doublets of event, the hit pairs the solvers' pair stages go through."""
+    graph = doublet_graph(event, max_slopes)
+    return sum(int(np.count_nonzero(ay < max_slopes[1] * az)) for _, _, _, ay, az in graph.pairs.values())
+
+
+class prefiltered_solver(object):
+    """Wraps solver, which then solves events without their isolated hits."""
+    def __init__(self, solver, max_slopes=(0.7, 0.7), steps=STEPS, executor=None):
+        self.solver = solver
+        self.max_slopes = max_slopes
+        self.steps = steps
+        self.executor = executor
+        self.events = 0
+        self.hits = 0
+        self.removed = 0
+        self.filter_time = 0.
+
+    def solve(self, event):
+        start = time.perf_counter()
+        keep = connected_hits(event, self.max_slopes, self.steps, self.executor)
+        removed = len(keep) - int(np.count_nonzero(keep))
+        if removed > 0:
+            event = filter_event(event, keep)
+        self.filter_time += time.perf_counter() - start
+        self.events += 1
+        self.hits += len(keep)
+        self.removed += removed
+        return self.solver.solve(event)
+
+    def report(self):
+        return "hit filter: %d of %d hits removed (%.1f%%) in %d events, %.3fs" % \
+               (self.removed, self.hits, 100. * self.removed / self.hits if self.hits > 0 else 0., self.events,
+                self.filter_time)
+
+
+def compare(paths, solver, particle_type="long>5GeV", noise=0., seed=0, repeats=1, **filter_parameters):
+    """Solves and validates the json event files in paths with solver, without and with the pre-filter.
+    With noise, the events first get noise times as many random hits (add_noise). Each event is solved
+    repeats times, alternating without and with the filter, and its fastest time is kept; the filter counters
+    and time are the ones of the first repeat.
+    Returns the two ValidationAccumulators and the report: for each, the wall time (with the filter, including
+    the time it took), the doublets left (count_doublets), the ghost fraction and the efficiency.
+    """
+    filtered = prefiltered_solver(solver, **filter_parameters)
+    accumulators = [vl.ValidationAccumulator([particle_type]) for _ in range(2)]
+    times = [0., 0.]
+    doublets = [0, 0]
+    for path in paths:
+        with open(path) as f:
+            json_data = json.load(f)
+        if noise > 0:
+            json_data = add_noise(json_data, noise, seed)
+        validator_event = vl.parse_json_data(json_data)
+        fastest = [None, None]
+        tracks = [None, None]
+        for repeat in range(repeats):
+            # The counters of filtered are the ones of the first repeat
+            solvers = (solver, filtered if repeat == 0 else prefiltered_solver(solver, **filter_parameters))
+            for i, s in enumerate(solvers):
+                event = em.event(json_data)
+                start = time.perf_counter()
+                tracks[i] = s.solve(event)
+                elapsed = time.perf_counter() - start
+                fastest[i] = elapsed if fastest[i] is None else min(fastest[i], elapsed)
+        for i in range(2):
+            times[i] += fastest[i]
+            accumulators[i].add_validator_event(validator_event, tracks[i])
+        # Counted apart, so that the counting is not in the wall times
+        event = em.event(json_data)
+        doublets[0] += count_doublets(event)
+        doublets[1] += count_doublets(filter_event(event, connected_hits(event, filtered.max_slopes, filtered.steps)))
+    lines = [filtered.report()]
+    for name, accumulator, elapsed, n_doublets in zip(("unfiltered", "filtered"), accumulators, times, doublets):
+        efficiency = accumulator.efficiency(particle_type)
+        lines.append("%10s : %.3fs, %d doublets, %s %.1f%%, %5.1f%% ghosts" % (name, elapsed, n_doublets,
+                     particle_type, efficiency.recoeffT if efficiency is not None else 0.,
+                     100. * accumulator.ghost_fraction()))
+    lines.append("%10s : %+.3fs (%+.1f%%), of which filtering %.3fs, %+d doublets" % ("difference",
+                 times[1] - times[0], 100. * (times[1] - times[0]) / times[0] if times[0] > 0 else 0.,
+                 filtered.filter_time, doublets[1] - doublets[0]))
+    return accumulators, "\n".join(lines)
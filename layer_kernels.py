@@ -0,0 +1,155 @@
+"""NumPy kernels for the per-sensor-layer stages of the solvers.
+
+Each kernel evaluates one sensor layer at once, with exactly the same
+floating point operations as the scalar are_compatible and check_tolerance
+of the solvers, so the results are identical. Layers are independent, so
+run_layers can spread them over an executor (eg. a ThreadPoolExecutor;
+NumPy releases the GIL inside its loops).
+
+The block_pairs and compatible_pairs kernels do the same for a batch of
+events at once, with the hits of all events concatenated into one array:
+every pair is made within one block (the hits of a sensor of one event), so
+no pair ever crosses an event boundary.
+"""
+import numpy as np
+
+
+# Number of elements the kernels over long arrays work on at a time, so that
+# their temporaries stay in the cache
+CHUNK = 16384
+
+
+def hit_arrays(hits):
+    """Returns the x, y and z coordinates of hits as arrays."""
+    return (np.array([h.x for h in hits], dtype=float),
+            np.array([h.y for h in hits], dtype=float),
+            np.array([h.z for h in hits], dtype=float))
+
+
+def compatible(a0, z0, a1, z1, max_slope):
+    """Slope compatibility in one coordinate of every pair of hits.
+    Returns a boolean matrix with a row per hit 1 and a column per hit 0.
+    """
+    return np.abs(a1[:, None] - a0[None, :]) < max_slope * np.abs(z1[:, None] - z0[None, :])
+
+
+def compatible_pairs(a0, z0, a1, z1, max_slope):
+    """Elementwise compatible of the pairs (hit_0, hit_1)."""
+    return np.abs(a1 - a0) < max_slope * np.abs(z1 - z0)
+
+
+def block_pairs(starts_0, counts_0, starts_1, counts_1):
+    """All pairs of an index of block i of ranges 0 with an index of block i of ranges 1,
+    ordered by block, then by index 1 and then by index 0 (like np.nonzero of the
+    compatible matrix of each block). Returns the arrays (block, index_0, index_1).
+    """
+    sizes = counts_0 * counts_1
+    block = np.repeat(np.arange(len(sizes)), sizes)
+    local = np.arange(len(block)) - np.repeat(np.cumsum(sizes) - sizes, sizes)
+    n0 = counts_0[block]
+    return block, starts_0[block] + local % n0, starts_1[block] + local // n0
+
+
+def extrapolation(x0, y0, z0, x1, y1, z1, x2, y2, z2):
+    """dx, dy and scatter of check_tolerance, elementwise for the hit triplets (hit_0, hit_1, hit_2)."""
+    td = 1.0 / (z1 - z0)
+    tx = (x1 - x0) * td
+    ty = (y1 - y0) * td
+    dz = z2 - z0
+    dx = np.abs(x0 + tx * dz - x2)
+    dy = np.abs(y0 + ty * dz - y2)
+    scatter_denom = 1.0 / (z2 - z1)
+    scatter = ((dx * dx) + (dy * dy)) * scatter_denom * scatter_denom
+    return dx, dy, scatter
+
+
+def tolerance(x0, y0, z0, x1, y1, z1, x2, y2, z2, max_tolerance, max_scatter):
+    """Elementwise check_tolerance of the hit triplets (hit_0, hit_1, hit_2)."""
+    dx, dy, scatter = extrapolation(x0, y0, z0, x1, y1, z1, x2, y2, z2)
+    return (dx < max_tolerance[0]) & (dy < max_tolerance[1]) & (scatter < max_scatter)
+
+
+def triplet_tolerance(x, y, z, h0, h1, h2, max_tolerance, max_scatter):
+    """tolerance of the hit triplets with hit indices (h0, h1, h2) into the x, y and z arrays,
+    gathered and checked CHUNK triplets at a time.
+    """
+    result = np.empty(len(h0), dtype=bool)
+    for start in range(0, len(h0), CHUNK):
+        i0, i1, i2 = h0[start:start + CHUNK], h1[start:start + CHUNK], h2[start:start + CHUNK]
+        result[start:start + CHUNK] = tolerance(x[i0], y[i0], z[i0], x[i1], y[i1], z[i1], x[i2], y[i2], z[i2],
+                                                max_tolerance, max_scatter)
+    return result
+
+
+def triplet_extrapolation(x, y, z, h0, h1, h2, max_tolerance, max_scatter):
+    """Like triplet_tolerance, but returns the indices of the triplets within the tolerance
+    together with their dx, dy and scatter.
+    """
+    selected, dxs, dys, scatters = [], [], [], []
+    for start in range(0, len(h0), CHUNK):
+        i0, i1, i2 = h0[start:start + CHUNK], h1[start:start + CHUNK], h2[start:start + CHUNK]
+        dx, dy, scatter = extrapolation(x[i0], y[i0], z[i0], x[i1], y[i1], z[i1], x[i2], y[i2], z[i2])
+        within = np.flatnonzero((dx < max_tolerance[0]) & (dy < max_tolerance[1]) & (scatter < max_scatter))
+        selected.append(within + start)
+        dxs.append(dx[within])
+        dys.append(dy[within])
+        scatters.append(scatter[within])
+    if len(selected) == 0:
+        return np.zeros(0, dtype=int), np.zeros(0), np.zeros(0), np.zeros(0)
+    return np.concatenate(selected), np.concatenate(dxs), np.concatenate(dys), np.concatenate(scatters)
+
+
+def beamline_pointing(x0, y0, z0, x1, y1, z1):
+    """Distance of closest approach to the z axis, and z at closest approach, of the lines through
+    the hit pairs (hit_0, hit_1), elementwise. A line parallel to the axis is taken at z0.
+    """
+    dx, dy = x1 - x0, y1 - y0
+    d2 = dx * dx + dy * dy
+    parallel = d2 == 0
+    d2 = np.where(parallel, 1., d2)
+    doca = np.where(parallel, np.sqrt(x0 * x0 + y0 * y0), np.abs(x0 * dy - y0 * dx) / np.sqrt(d2))
+    t = np.where(parallel, 0., -(x0 * dx + y0 * dy) / d2)
+    return doca, z0 + t * (z1 - z0)
+
+
+def pointing(x, y, z, h0, h1, max_doca, z_range):
+    """Whether the lines through the hit pairs with hit indices (h0, h1) into the x, y and z arrays
+    pass within max_doca of the z axis, with the z of closest approach in z_range (min, max).
+    Either cut is skipped if None.
+    """
+    doca, z_closest = beamline_pointing(x[h0], y[h0], z[h0], x[h1], y[h1], z[h1])
+    result = np.ones(len(doca), dtype=bool)
+    if max_doca is not None:
+        result &= doca < max_doca
+    if z_range is not None:
+        result &= (z_closest >= z_range[0]) & (z_closest <= z_range[1])
+    return result
+
+
+def matching_pairs(left_end, right_start):
+    """All pairs (left, right) with left_end[left] == right_start[right],
+    ordered by right and then by left.
+    """
+    order = np.argsort(left_end, kind='stable')
+    sorted_end = left_end[order]
+    lo = np.searchsorted(sorted_end, right_start, 'left')
+    counts = np.searchsorted(sorted_end, right_start, 'right') - lo
+    right = np.repeat(np.arange(len(right_start)), counts)
+    first = np.repeat(np.cumsum(counts) - counts, counts)
+    left = order[np.repeat(lo, counts) + np.arange(len(right)) - first]
+    return left, right
+
+
+def group_positions(groups):
+    """Position of each element within its run of equal (sorted) group numbers."""
+    if len(groups) == 0:
+        return groups
+    starts = np.flatnonzero(np.r_[True, groups[1:] != groups[:-1]])
+    return np.arange(len(groups)) - np.repeat(starts, np.diff(np.r_[starts, len(groups)]))
+
+
+def run_layers(function, layers, executor=None):
+    """Returns [function(layer) for layer in layers], run on executor if given."""
+    if executor is None:
+        return [function(layer) for layer in layers]
+    return list(executor.map(function, layers))
@@ -0,0 +1,77 @@
+#!/usr/bin/python3
+
+# Replays velojson events against a running reconstruction server
+import argparse
+import threading
+import json
+import time
+import os
+import numpy as np
+
+import event_model as em
+from server import client
+from shared_event import event_buffer
+
+
+def replay(address, payloads, binary, requests, connections, rate=None):
+    """Sends requests events, cycling over payloads, from connections concurrent
+    clients, optionally paced to rate requests per second in total.
+    Returns the client side latencies and the wall time.
+    """
+    latencies = []
+    lock = threading.Lock()
+    counter = [0]
+    start = time.perf_counter()
+
+    def run():
+        c = client(address)
+        while True:
+            with lock:
+                index = counter[0]
+                counter[0] += 1
+            if index >= requests:
+                break
+            if rate is not None:
+                time.sleep(max(0., start + index / rate - time.perf_counter()))
+            sent = time.perf_counter()
+            if binary:
+                c.solve_binary(payloads[index % len(payloads)])
+            else:
+                c.solve_json(payloads[index % len(payloads)])
+            with lock:
+                latencies.append(time.perf_counter() - sent)
+        c.close()
+
+    threads = [threading.Thread(target=run) for _ in range(connections)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    return latencies, time.perf_counter() - start
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Load generator for the reconstruction server")
+    parser.add_argument("--unix", default="/tmp/velopix.sock")
+    parser.add_argument("--port", type=int, default=None)
+    parser.add_argument("--binary", action="store_true", help="send events in the binary format")
+    parser.add_argument("--requests", type=int, default=100)
+    parser.add_argument("--connections", type=int, default=4)
+    parser.add_argument("--rate", type=float, default=None, help="requests per second, default as fast as possible")
+    args = parser.parse_args()
+
+    address = ("localhost", args.port) if args.port is not None else args.unix
+    payloads = []
+    for file in sorted(os.listdir("velojson")):
+        if file.endswith(".json") and file != "index.json":
+            with open(os.path.join("velojson", file)) as f:
+                text = f.read()
+            payloads.append(event_buffer.pack(em.event(json.loads(text))) if args.binary else text)
+
+    latencies, wall_time = replay(address, payloads, args.binary, args.requests, args.connections, args.rate)
+    p50, p99, p999 = np.percentile(latencies, [50, 99, 99.9])
+    print("%d requests in %.2fs, %.2f requests/s" % (len(latencies), wall_time, len(latencies) / wall_time))
+    print("client latency p50 %.4fs p99 %.4fs p999 %.4fs" % (p50, p99, p999))
+    c = client(address)
+    print("server:", c.stats())
+    c.close()
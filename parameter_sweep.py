@@ -0,0 +1,98 @@
+"""Sweeps the CellularAutomaton cuts over a set of events.
+
+Each event's doublet graph is built once, at the loosest cuts of all
+settings (doublet_graph), and every setting is solved from it by
+thresholding, instead of a full solve per setting. Events are spread over a
+pool of processes, and each one runs all the settings on its graph, so the
+graph is never rebuilt. (Spreading the settings instead would build the
+graph of an event in every process.)
+
+The report gives, per setting, the efficiency of particle_type, the ghost
+rate and the solve time from the graph. It also gives the graph building
+time, which is paid once for all the settings.
+"""
+from concurrent.futures import ProcessPoolExecutor
+from CellularAutomaton.CellularAutomaton import CellularAutomaton
+from doublet_graph import doublet_graph
+import event_model as em
+import validator_lite as vl
+import itertools
+import json
+import time
+
+
+DEFAULT_CUTS = {"max_slopes": (0.7, 0.7), "max_tolerance": (0.4, 0.4), "max_scatter": 0.4}
+
+
+def loosest_cuts(settings):
+    """The loosest max_slopes, max_tolerance and max_scatter of the settings
+    (dicts of CellularAutomaton parameters)."""
+    settings = [dict(DEFAULT_CUTS, **setting) for setting in settings]
+    return {"max_slopes": tuple(max(s["max_slopes"][i] for s in settings) for i in range(2)),
+            "max_tolerance": tuple(max(s["max_tolerance"][i] for s in settings) for i in range(2)),
+            "max_scatter": max(s["max_scatter"] for s in settings)}
+
+
+def grid(max_slopes, max_tolerance, max_scatter):
+    """All the settings combining the given values of each cut."""
+    return [{"max_slopes": slopes, "max_tolerance": tolerance, "max_scatter": scatter}
+            for slopes, tolerance, scatter in itertools.product(max_slopes, max_tolerance, max_scatter)]
+
+
+def sweep_event(path, settings, particle_types=None):
+    """Solves the event in the json file path with every setting.
+    Returns the graph building time, and a (ValidationAccumulator, solve time) per setting.
+    """
+    with open(path) as f:
+        json_data = json.load(f)
+    event = em.event(json_data)
+    start = time.perf_counter()
+    graph = doublet_graph(event, **loosest_cuts(settings))
+    graph_time = time.perf_counter() - start
+    validator_event = vl.parse_json_data(json_data)
+    results = []
+    for setting in settings:
+        solver = CellularAutomaton(**setting)
+        start = time.perf_counter()
+        tracks = solver.solve_graph(graph)
+        elapsed = time.perf_counter() - start
+        accumulator = vl.ValidationAccumulator(particle_types)
+        accumulator.add_validator_event(validator_event, tracks)
+        results.append((accumulator, elapsed))
+    return graph_time, results
+
+
+def _sweep_event(args):
+    return sweep_event(*args)
+
+
+def sweep(paths, settings, processes=None, particle_type="long>5GeV"):
+    """Runs the settings over the json event files in paths.
+    Returns, per setting, the merged ValidationAccumulator and the total solve time,
+    and the report.
+    """
+    paths = list(paths)
+    accumulators = [vl.ValidationAccumulator([particle_type]) for _ in settings]
+    times = [0.] * len(settings)
+    graph_time = 0.
+    start = time.perf_counter()
+    with ProcessPoolExecutor(processes) as executor:
+        for event_graph_time, results in executor.map(_sweep_event, [(path, settings, [particle_type]) for path in paths]):
+            graph_time += event_graph_time
+            for i, (accumulator, elapsed) in enumerate(results):
+                accumulators[i].merge(accumulator)
+                times[i] += elapsed
+    wall_time = time.perf_counter() - start
+
+    lines = ["%d settings on %d events in %.2fs, graph built once per event: %.3fs per event" %
+             (len(settings), len(paths), wall_time, graph_time / max(len(paths), 1)),
+             "%12s %13s %8s : %10s %10s %12s" % ("max_slopes", "max_tolerance", "scatter", particle_type, "ghosts", "s per event")]
+    for setting, accumulator, elapsed in zip(settings, accumulators, times):
+        setting = dict(DEFAULT_CUTS, **setting)
+        efficiency = accumulator.efficiency(particle_type)
+        lines.append("%12s %13s %8s : %9.1f%% %9.1f%% %12.3f" %
+                     ("%.2f,%.2f" % setting["max_slopes"], "%.2f,%.2f" % setting["max_tolerance"], "%.2f" % setting["max_scatter"],
+                      efficiency.recoeffT if efficiency is not None else 0.,
+                      100. * accumulator.ghost_fraction() if accumulator.n_tracks > 0 else 0.,
+                      elapsed / max(len(paths), 1)))
+    return list(zip(accumulators, times)), "\n".join(lines)
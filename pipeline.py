@@ -0,0 +1,183 @@
+"""Asynchronous read -> solve -> validate -> write pipeline.
+
+Each stage runs on its own threads and hands work to the next one through a
+bounded queue, so a fast stage blocks instead of running ahead (eg. I/O
+read-ahead is limited to a few events in memory) and the throughput is set
+by the slowest stage rather than by the sum of all of them. Solving and
+validation run on pools of processes; the stage threads only wait for them.
+
+  read:     reads the json text of each event file
+  solve:    parses and solves the event on a worker process, which sends back
+            the tracks as a track_collection of json hit indices
+  validate: validates the tracks on a worker process into a partial
+            ValidationAccumulator
+  write:    writes the tracks of each event as a json line, and merges the
+            partial accumulators in event order
+"""
+from concurrent.futures import ProcessPoolExecutor
+import event_model as em
+import validator_lite as vl
+import threading
+import queue
+import json
+import time
+
+
+STOP = None
+
+
+def solve_json(solver, text):
+    """Worker side of the solve stage. Returns the tracks as a track_collection
+    of indices into the json hit arrays, and the solve time.
+    """
+    json_data = json.loads(text)
+    event = em.event(json_data)
+    start = time.perf_counter()
+    tracks = solver.solve(event)
+    elapsed = time.perf_counter() - start
+    return em.track_collection.from_tracks(tracks, json_data["event"]["hit_id"]), elapsed
+
+
+def validate_json(text, collection):
+    """Worker side of the validate stage. Returns the partial ValidationAccumulator of the event."""
+    json_data = json.loads(text)
+    event = vl.parse_json_data(json_data)
+    accumulator = vl.ValidationAccumulator()
+    accumulator.add_validator_event(event, collection.to_tracks(event.hits))
+    return accumulator
+
+
+class stage(object):
+    """A pipeline stage: workers threads apply function to the items of inputs
+    and put the results on outputs. Keeps its busy time and samples the depth
+    of its input queue.
+    """
+    def __init__(self, name, function, inputs, outputs, workers=1):
+        self.name = name
+        self.function = function
+        self.inputs = inputs
+        self.outputs = outputs
+        self.workers = workers
+        self.items = 0
+        self.busy = 0.0
+        self.depths = []
+        self.errors = []
+        self.lock = threading.Lock()
+        self.threads = [threading.Thread(target=self.work) for _ in range(workers)]
+        self.closer = threading.Thread(target=self.close)
+
+    def start(self):
+        for thread in self.threads:
+            thread.start()
+        self.closer.start()
+
+    def work(self):
+        while True:
+            depth = self.inputs.qsize()
+            item = self.inputs.get()
+            if item is STOP:
+                # Let the sibling workers see it too
+                self.inputs.put(STOP)
+                return
+            start = time.perf_counter()
+            try:
+                result = self.function(item)
+            except Exception as e:
+                with self.lock:
+                    self.errors.append(e)
+                continue
+            with self.lock:
+                self.items += 1
+                self.busy += time.perf_counter() - start
+                self.depths.append(depth)
+            if self.outputs is not None:
+                self.outputs.put(result)
+
+    def close(self):
+        for thread in self.threads:
+            thread.join()
+        if self.outputs is not None:
+            self.outputs.put(STOP)
+
+    def join(self):
+        self.closer.join()
+
+    def report(self, wall_time):
+        utilization = 100. * self.busy / (wall_time * self.workers) if wall_time > 0 else 0.
+        mean_depth = sum(self.depths) / len(self.depths) if len(self.depths) > 0 else 0.
+        return "%10s : %6d items, %2d workers, busy %8.2fs, utilization %5.1f%%, input queue depth mean %5.2f max %3d" % \
+               (self.name, self.items, self.workers, self.busy, utilization, mean_depth, max(self.depths + [0]))
+
+
+class pipeline(object):
+    """Solves, validates and writes a list of json event files.
+
+    solvers and validators are the number of worker processes of these stages,
+    queue_size bounds every queue between stages (in events).
+    """
+    def __init__(self, solver, solvers=2, validators=1, queue_size=4):
+        self.solver = solver
+        self.solvers = solvers
+        self.validators = validators
+        self.queue_size = queue_size
+
+    def run(self, paths, output_filename):
+        """Runs the pipeline over paths. Returns the merged ValidationAccumulator
+        and the per stage report.
+        """
+        paths = list(paths)
+        read_queue, solve_queue, validate_queue = [queue.Queue(self.queue_size) for _ in range(3)]
+        partials = {}
+        merged = [vl.ValidationAccumulator(), 0]
+
+        def read(item):
+            index, path = item
+            with open(path) as f:
+                return index, path, f.read()
+
+        def solve(item):
+            index, path, text = item
+            collection, elapsed = solve_pool.submit(solve_json, self.solver, text).result()
+            return index, path, text, collection, elapsed
+
+        def validate(item):
+            index, path, text, collection, elapsed = item
+            return index, path, collection, elapsed, validate_pool.submit(validate_json, text, collection).result()
+
+        def write(item):
+            index, path, collection, elapsed, partial = item
+            output.write(json.dumps({"event": path, "solve_time": elapsed, "tracks":
+                [collection.hit_indices[start:end].tolist() for start, end in
+                 zip(collection.offsets[:-1], collection.offsets[1:])]}) + "\n")
+            # Partial accumulators are merged in event order
+            partials[index] = partial
+            while merged[1] in partials:
+                merged[0].merge(partials.pop(merged[1]))
+                merged[1] += 1
+
+        paths_queue = queue.Queue()
+        for item in enumerate(paths):
+            paths_queue.put(item)
+        paths_queue.put(STOP)
+
+        start = time.perf_counter()
+        with ProcessPoolExecutor(self.solvers) as solve_pool, ProcessPoolExecutor(self.validators) as validate_pool, \
+                open(output_filename, 'w') as output:
+            stages = [stage("read", read, paths_queue, read_queue),
+                      stage("solve", solve, read_queue, solve_queue, self.solvers),
+                      stage("validate", validate, solve_queue, validate_queue, self.validators),
+                      stage("write", write, validate_queue, None)]
+            for s in stages:
+                s.start()
+            for s in stages:
+                s.join()
+        wall_time = time.perf_counter() - start
+
+        for index in sorted(partials):
+            merged[0].merge(partials[index])
+        errors = [e for s in stages for e in s.errors]
+        report = ["%d events in %.2fs, %.2f events/s" % (len(paths), wall_time, len(paths) / wall_time)] + \
+                 [s.report(wall_time) for s in stages]
+        if len(errors) > 0:
+            report.append("%d events failed, first error: %r" % (len(errors), errors[0]))
+        return merged[0], "\n".join(report)
@@ -7,7 +7,9 @@ import json
 # Solvers
 from graph_dfs import graph_dfs
 from classical_solver import classical_solver
+from solver_cache import solver_cache, cached_solver
 solutions = {}
+cache = solver_cache()
 
 # Get an event
 f = open("velojson/0.json")
@@ -19,12 +21,13 @@ for s_number in range(0, event.number_of_sensors):
   event.sensors[s_number].z = event.sensors[s_number].hits()[0].z
 
 # Solve with the classic method
-classical = classical_solver()
+classical = cached_solver(classical_solver(), cache)
 solutions["classic"] = classical.solve(event)
 
 # Solve with the DFS method
-dfs = graph_dfs()
+dfs = cached_solver(graph_dfs(), cache)
 solutions["dfs"] = dfs.solve(event)
+print(cache.report())
 
 from visual.base import print_event_2d
 print_event_2d(event, solutions["classic"], filename="classic_solution_xz.png")
@@ -41,6 +41,8 @@ solutions = {}
 
 all_times = []
 index = 1
+# One solver for all the runs, so its doublet objects are reused from event to event
+ca = CellularAutomaton()
 for file in os.listdir("velojson"):
 
 
@@ -69,7 +71,6 @@ for file in os.listdir("velojson"):
             # current_run.append(time.clock() - start)
 
             # solve with CA
-            ca = CellularAutomaton()
             start = time.clock()
             # solutions["CA"], time_parts = ca.solve_with_profiling(event)
             solutions["CA"], time_parts = ca.solve_without_Profiling(event)
@@ -83,7 +84,8 @@ for file in os.listdir("velojson"):
             #     print("%s method validation" % (k))
             #     vl.validate_print([json_data], [v])
             #     # print()
-        print("File " + str(index) + " done", file=sys.stderr)
+        print("File " + str(index) + " done, doublets allocated/reused in the last run: %(allocated)d/%(reused)d" %
+              ca.allocation_stats() + ", dropped by the caps: %s" % ca.overflow_stats(), file=sys.stderr)
         index += 1
 
 # with open ("Profiling/DetailedMeasure-030518_5runs_per_file.csv", 'a') as output_file:
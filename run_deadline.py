@@ -0,0 +1,47 @@
+#!/usr/bin/python3
+
+# Efficiency versus deadline of the CellularAutomaton on the velojson events
+import event_model as em
+import validator_lite as vl
+import collections
+import json
+import sys
+import time
+
+from CellularAutomaton.CellularAutomaton import CellularAutomaton
+
+if __name__ == "__main__":
+  n_events = int(sys.argv[1]) if len(sys.argv) > 1 else 10
+  budgets = [None, 4., 2., 1., 0.5, 0.25, 0.1]
+  json_data = []
+  for i in range(n_events):
+    with open("velojson/%d.json" % i) as f:
+      json_data.append(json.load(f))
+
+  efficiencies = []
+  print("%8s : %10s %8s %10s %10s %8s  %s" % ("budget", "long>5GeV", "ghosts", "mean time", "worst time", "overruns", "degradations"))
+  for budget in budgets:
+    ca = CellularAutomaton()
+    accumulator = vl.ValidationAccumulator(["long>5GeV"])
+    times = []
+    degradations = collections.Counter()
+    for data in json_data:
+      event = em.event(data)
+      start = time.perf_counter()
+      if budget is None:
+        tracks = ca.solve(event)
+      else:
+        tracks = ca.solve_with_deadline(event, start + budget)
+        degradations.update(ca.degradations())
+      times.append(time.perf_counter() - start)
+      accumulator.add_event(data, tracks)
+    efficiencies.append(accumulator.efficiency("long>5GeV").recoeffT)
+    print("%8s : %9.1f%% %7.1f%% %9.3fs %9.3fs %8d  %s" %
+          ("none" if budget is None else "%.2fs" % budget, accumulator.efficiency("long>5GeV").recoeffT,
+           100. * accumulator.ghost_fraction(), sum(times) / len(times), max(times),
+           sum(1 for t in times if budget is not None and t > budget), dict(degradations)))
+
+  # the budgets go down, so the efficiency should never go up along them. The unbudgeted solve is left out: shedding
+  # the doublets to the second next sensor can find slightly more tracks than the full solve
+  decreases = [(budgets[i], budgets[i + 1]) for i in range(1, len(budgets) - 1) if efficiencies[i + 1] > efficiencies[i]]
+  print("efficiency never decreases as the budget grows: %s" % ("yes" if len(decreases) == 0 else "no, %s" % decreases))
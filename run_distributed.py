@@ -0,0 +1,35 @@
+#!/usr/bin/python3
+
+# Distributed solving of velojson over TCP:
+#   run_distributed.py coordinator --port 5555
+#   run_distributed.py worker --host <coordinator host> --port 5555 --solver dfs
+#   run_distributed.py scaling --solver dfs --workers 1 2 4
+import argparse
+import os
+
+from distributed import coordinator, run_worker, scaling
+from server import make_solver
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Coordinator/worker distribution of velojson events")
+    parser.add_argument("mode", choices=["coordinator", "worker", "scaling"])
+    parser.add_argument("--host", default="localhost")
+    parser.add_argument("--port", type=int, default=5555)
+    parser.add_argument("--solver", default="dfs", choices=["classic", "dfs", "ca"])
+    parser.add_argument("--workers", type=int, nargs="+", default=[1, 2, 4])
+    parser.add_argument("--heartbeat-timeout", type=float, default=10.0)
+    args = parser.parse_args()
+
+    paths = [os.path.join("velojson", file) for file in sorted(os.listdir("velojson"))
+             if file.endswith(".json") and file != "index.json"]
+
+    if args.mode == "coordinator":
+        c = coordinator(paths, ("0.0.0.0", args.port), args.heartbeat_timeout)
+        print("Coordinator with %d events on port %d" % (len(paths), args.port))
+        _, report = c.run()
+        print(report)
+    elif args.mode == "worker":
+        run_worker((args.host, args.port), make_solver(args.solver))
+    else:
+        for report in scaling(paths, args.solver, args.workers, args.heartbeat_timeout):
+            print(report)
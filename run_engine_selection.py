@@ -0,0 +1,38 @@
+#!/usr/bin/python3
+
+# Calibrates the engines on the even velojson events and routes the odd ones at several target latencies
+import event_model as em
+import validator_lite as vl
+import engine_selection
+from scheduler import read_features
+import json
+import os
+import sys
+
+if __name__ == "__main__":
+  # Optional: a directory for the decision logs of each target
+  log_directory = sys.argv[1] if len(sys.argv) > 1 else None
+  engines = engine_selection.default_engines()
+  paths = ["velojson/%d.json" % i for i in range(0, 30, 2)]
+  models = engine_selection.calibrate(engines, paths)
+  # Predictions at several occupancies, with the maximum hits in a sensor per hit of the calibration events
+  features = read_features(paths)
+  max_sensor_hits_per_hit = sum(m for _, m in features) / sum(h for h, _ in features)
+  print("%.4f max sensor hits per hit in the calibration events" % max_sensor_hits_per_hit)
+  for name, model in models.items():
+    predictions = [(h,) + model.predict((h, round(h * max_sensor_hits_per_hit))) for h in (500, 1000, 2000, 4000)]
+    print("%s: %s" % (name, ", ".join("%d hits %.3fs %.1f%%" % p for p in predictions)))
+
+  json_data = []
+  for i in range(1, 30, 2):
+    with open("velojson/%d.json" % i) as f:
+      json_data.append(json.load(f))
+  for target in (10., 2., 1., 0.5, 0.2):
+    selector = engine_selection.engine_selector(engines, models, target, learn=False, audit=True)
+    accumulator = vl.ValidationAccumulator(["long>5GeV"])
+    for data in json_data:
+      accumulator.add_event(data, selector.solve(em.event(data)))
+    print(selector.report())
+    print(" %.1f%% ghosts\n" % (100. * accumulator.ghost_fraction()))
+    if log_directory is not None:
+      selector.write_log(os.path.join(log_directory, "engine_selection_%gs.csv" % target))
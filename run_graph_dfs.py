@@ -7,6 +7,8 @@ import json
 # Solvers
 from graph_dfs import graph_dfs
 from classical_solver import classical_solver
+from CellularAutomaton.CellularAutomaton import CellularAutomaton
+from doublet_graph import doublet_graph
 solutions = {}
 
 # Get an event
@@ -19,11 +21,17 @@ f.close()
 classical = classical_solver()
 solutions["classic"] = classical.solve(event)
 
-# Solve with the DFS method
+# The doublet graph is built once, for both the DFS and the CA
 dfs = graph_dfs()
-solutions["dfs"] = dfs.solve(event)
+graph = doublet_graph(event, steps=dfs.candidate_steps() + [2, 4])
+
+# Solve with the DFS method
+solutions["dfs"] = dfs.solve_graph(graph)
 print(solutions["dfs"])
 
+# Solve with the CA
+solutions["ca"] = CellularAutomaton().solve_graph(graph)
+
 # Validate the solutions
 for k, v in iter(sorted(solutions.items())):
   print("%s method validation" % (k))
@@ -0,0 +1,16 @@
+#!/usr/bin/python3
+
+from hit_filter import compare
+from CellularAutomaton.CellularAutomaton import CellularAutomaton
+from classical_solver import classical_solver
+from graph_dfs import graph_dfs
+
+if __name__ == "__main__":
+  paths = ["velojson/%d.json" % i for i in (0, 16, 18, 23, 25)]
+
+  # Validate each solver with and without the isolated hits, on the events as they are
+  # and with as many uniformly random hits added (noise 1)
+  for noise in (0, 1):
+    for solver in (classical_solver(), graph_dfs(), CellularAutomaton()):
+      _, report = compare(paths, solver, noise=noise, repeats=3, max_slopes=(0.15, 0.15))
+      print("%s, noise %d\n%s\n" % (type(solver).__name__, noise, report))
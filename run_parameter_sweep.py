@@ -0,0 +1,16 @@
+#!/usr/bin/python3
+
+# Sweeps the CellularAutomaton cuts over the velojson events
+import os
+import sys
+
+from parameter_sweep import sweep, grid
+
+if __name__ == "__main__":
+    n_events = int(sys.argv[1]) if len(sys.argv) > 1 else 10
+    paths = [os.path.join("velojson", "%d.json" % i) for i in range(n_events)]
+    settings = grid(max_slopes=[(0.5, 0.5), (0.7, 0.7)],
+                    max_tolerance=[(0.3, 0.3), (0.4, 0.4)],
+                    max_scatter=[0.2, 0.4])
+    _, report = sweep(paths, settings)
+    print(report)
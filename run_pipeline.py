@@ -0,0 +1,18 @@
+#!/usr/bin/python3
+
+# Solves and validates all velojson events through the asynchronous pipeline
+import os
+import sys
+
+from graph_dfs import graph_dfs
+from pipeline import pipeline
+
+if __name__ == "__main__":
+    solvers = int(sys.argv[1]) if len(sys.argv) > 1 else max(1, os.cpu_count() - 1)
+    paths = [os.path.join("velojson", file) for file in sorted(os.listdir("velojson"))
+             if file.endswith(".json") and file != "index.json"]
+
+    accumulator, report = pipeline(graph_dfs(), solvers=solvers).run(paths, "pipeline_tracks.jsonl")
+    print(report)
+    print()
+    accumulator.print_report()
@@ -0,0 +1,36 @@
+#!/usr/bin/python3
+
+# Benchmarks the CellularAutomaton pointing cut: doublets, time per stage and efficiency, without and with it
+import event_model as em
+import validator_lite as vl
+import json
+import sys
+
+from CellularAutomaton.CellularAutomaton import CellularAutomaton
+
+STAGE_NAMES = ["doublets", "neighbours", "ca", "extract", "short tracks", "ghosts/clones"]
+
+if __name__ == "__main__":
+  n_events = int(sys.argv[1]) if len(sys.argv) > 1 else 10
+  settings = [("no pointing cut", {}),
+              ("doca < 10mm, |z| < 400mm", {"max_doca": 10., "z_range": (-400., 400.)}),
+              ("doca < 5mm, |z| < 300mm", {"max_doca": 5., "z_range": (-300., 300.)})]
+  events = []
+  for i in range(n_events):
+    with open("velojson/%d.json" % i) as f:
+      json_data = json.load(f)
+    events.append((em.event(json_data), vl.parse_json_data(json_data)))
+
+  for name, parameters in settings:
+    ca = CellularAutomaton(keep_intermediates=True, **parameters)
+    accumulator = vl.ValidationAccumulator(["long>5GeV"])
+    stage_times = [0.] * len(STAGE_NAMES)
+    n_doublets = 0
+    for event, validator_event in events:
+      tracks, times = ca.solve_with_profiling(event)
+      stage_times = [total + t for total, t in zip(stage_times, times)]
+      n_doublets += sum(len(starts) for starts, _, _, _ in ca.context.doublet_arrays)
+      accumulator.add_validator_event(validator_event, tracks)
+    print("%s: %d doublets, %.1f%% ghosts" % (name, n_doublets, 100. * accumulator.ghost_fraction()))
+    print("  " + ", ".join("%s %.3fs" % s for s in zip(STAGE_NAMES, stage_times)))
+    print(accumulator.efficiency("long>5GeV"))
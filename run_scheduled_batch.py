@@ -0,0 +1,23 @@
+#!/usr/bin/python3
+
+# Solves all velojson events on a pool of processes, scheduled by predicted cost
+import os
+import sys
+
+from CellularAutomaton.CellularAutomaton import CellularAutomaton
+from scheduler import work_stealing_scheduler, cost_model, build_index, read_features, solve_file, INDEX_FILENAME
+
+if __name__ == "__main__":
+    n_workers = int(sys.argv[1]) if len(sys.argv) > 1 else os.cpu_count()
+
+    if not os.path.exists(os.path.join("velojson", INDEX_FILENAME)):
+        build_index("velojson")
+    paths = [os.path.join("velojson", file) for file in sorted(os.listdir("velojson"))
+             if file.endswith(".json") and file != INDEX_FILENAME]
+    features = read_features(paths)
+
+    # Initial cost model from the CA profiling runs, refined while solving
+    scheduler = work_stealing_scheduler(solve_file, n_workers, cost_model.from_csv())
+    results, report = scheduler.run([(CellularAutomaton(), path) for path in paths], features)
+    print(report)
+    print("Refined cost model coefficients:", scheduler.model.coefficients)
@@ -0,0 +1,39 @@
+#!/usr/bin/python3
+
+# Benchmarks search_by_triplet against the other solvers: hits per second and validation
+import event_model as em
+import validator_lite as vl
+import json
+import sys
+import time
+
+from search_by_triplet import search_by_triplet
+from classical_solver import classical_solver
+from graph_dfs import graph_dfs
+from CellularAutomaton.CellularAutomaton import CellularAutomaton
+
+if __name__ == "__main__":
+  events = [int(i) for i in sys.argv[1].split(",")] if len(sys.argv) > 1 else [0, 9, 23]
+  json_data = []
+  for i in events:
+    with open("velojson/%d.json" % i) as f:
+      json_data.append(json.load(f))
+
+  results = []
+  for solver in (search_by_triplet(), classical_solver(), graph_dfs(), CellularAutomaton()):
+    accumulator = vl.ValidationAccumulator()
+    elapsed = 0.
+    n_hits = 0
+    for data in json_data:
+      event = em.event(data)
+      start = time.perf_counter()
+      tracks = solver.solve(event)
+      elapsed += time.perf_counter() - start
+      n_hits += event.number_of_hits
+      accumulator.add_event(data, tracks)
+    results.append((type(solver).__name__, elapsed, n_hits, accumulator))
+
+  for name, elapsed, n_hits, accumulator in results:
+    print("%s: %.2fs, %.0f hits/s" % (name, elapsed, n_hits / elapsed))
+    print(accumulator.report())
+    print()
@@ -0,0 +1,25 @@
+#!/usr/bin/python3
+
+# Runs the reconstruction server until interrupted
+import argparse
+
+from server import reconstruction_server, make_solver
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Reconstruction server")
+    parser.add_argument("--solver", default="dfs", choices=["classic", "dfs", "ca"])
+    parser.add_argument("--unix", default="/tmp/velopix.sock", help="Unix socket path")
+    parser.add_argument("--port", type=int, default=None, help="TCP port on localhost, instead of the Unix socket")
+    parser.add_argument("--workers", type=int, default=0, help="worker processes, 0 solves in the server")
+    parser.add_argument("--max-batch", type=int, default=16)
+    args = parser.parse_args()
+
+    address = ("localhost", args.port) if args.port is not None else args.unix
+    server = reconstruction_server(make_solver(args.solver), address, args.workers, args.max_batch)
+    print("Serving %s on %s" % (args.solver, address))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        print(server.counters.stats())
+    finally:
+        server.shutdown()
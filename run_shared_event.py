@@ -0,0 +1,43 @@
+#!/usr/bin/python3
+
+# Cost of handing the first n (default 10) velojson events to a worker: pickling the event_model.event, against the
+# shared memory block. Only the transport is compared, the worker builds the same event_model.event either way
+import event_model as em
+from shared_event import shared_event
+import json
+import pickle
+import sys
+import time
+
+if __name__ == "__main__":
+  n_events = int(sys.argv[1]) if len(sys.argv) > 1 else 10
+  events = []
+  for i in range(n_events):
+    with open("velojson/%d.json" % i) as f:
+      json_data = json.load(f)
+    events.append(em.event({"event": json_data["event"], "montecarlo": None}))
+
+  # plain pickling: the owner pickles the event, the worker unpickles it
+  pickle_sizes = [len(pickle.dumps(event)) for event in events]
+  start = time.perf_counter()
+  for event in events:
+    pickle.loads(pickle.dumps(event))
+  pickle_time = time.perf_counter() - start
+
+  # shared memory: the owner writes the block, the worker attaches and builds the event from its arrays
+  owner_time = worker_time = 0.
+  for event in events:
+    start = time.perf_counter()
+    block = shared_event.create(event)
+    middle = time.perf_counter()
+    with shared_event.attach(block.name) as shared:
+      shared.event()
+    worker_time += time.perf_counter() - middle
+    block.close()
+    block.unlink()
+    owner_time += middle - start
+
+  print("%d events, %d hits" % (len(events), sum(len(event.hits) for event in events)))
+  print("  pickle        : %.3fs, %d bytes" % (pickle_time, sum(pickle_sizes)))
+  print("  shared memory : %.3fs (owner %.3fs, worker %.3fs), %d bytes" %
+        (owner_time + worker_time, owner_time, worker_time, sum(shared_event.nbytes(event) for event in events)))
@@ -0,0 +1,14 @@
+#!/usr/bin/python3
+
+# Two pass reconstruction: tight classical forwarding, then the CA and the DFS on the hits left
+import sys
+
+from two_pass import compare
+from CellularAutomaton.CellularAutomaton import CellularAutomaton
+from graph_dfs import graph_dfs
+
+if __name__ == "__main__":
+  events = [int(i) for i in sys.argv[1].split(",")] if len(sys.argv) > 1 else [0, 9, 23]
+  paths = ["velojson/%d.json" % i for i in events]
+  for solver in (CellularAutomaton(), graph_dfs()):
+    print("%s\n%s\n" % (type(solver).__name__, compare(paths, solver)))
@@ -0,0 +1,223 @@
+"""Cost-model scheduling of event batches over a pool of worker processes.
+
+Each event's solve time is predicted from cheap metadata (number of hits and
+maximum number of hits in a sensor), taken from a sidecar index next to the
+json files. Events are handed out largest first from per-worker queues, idle
+workers steal pending work from the most loaded queue, and the cost model is
+refined with every measured runtime, after which the pending events are dealt
+again with the new predictions.
+"""
+from concurrent.futures import ProcessPoolExecutor
+import collections
+import threading
+import numpy as np
+import event_model as em
+import json
+import csv
+import os
+import time
+
+
+INDEX_FILENAME = "index.json"
+
+
+def event_features(json_data):
+    """Returns (number of hits, maximum number of hits in a sensor) of an event."""
+    return (json_data["event"]["number_of_hits"], max(json_data["event"]["sensor_number_of_hits"]))
+
+
+def build_index(directory, filename=INDEX_FILENAME):
+    """Writes a sidecar index with the features of every json event in directory."""
+    index = {}
+    for file in sorted(os.listdir(directory)):
+        if file.endswith(".json") and file != filename:
+            with open(os.path.join(directory, file)) as f:
+                index[file] = event_features(json.loads(f.read()))
+    with open(os.path.join(directory, filename), 'w') as f:
+        json.dump(index, f, indent=1, sort_keys=True)
+    return index
+
+
+def read_features(paths, filename=INDEX_FILENAME):
+    """Returns the features of each json event file in paths, from the sidecar
+    index of its directory when it has one, or else by parsing the event.
+    """
+    indexes = {}
+    features = []
+    for path in paths:
+        directory, file = os.path.split(path)
+        if directory not in indexes:
+            index_path = os.path.join(directory, filename)
+            indexes[directory] = {}
+            if os.path.exists(index_path):
+                with open(index_path) as f:
+                    indexes[directory] = json.loads(f.read())
+        if file in indexes[directory]:
+            features.append(tuple(indexes[directory][file]))
+        else:
+            with open(path) as f:
+                features.append(event_features(json.loads(f.read())))
+    return features
+
+
+class cost_model(object):
+    """Power law model of the solve time of an event,
+
+        time = exp(a) * hits^b * max_sensor_hits^c
+
+    fitted by least squares in log space to measured (features, time) samples.
+    """
+    def __init__(self, coefficients=(0.0, 1.0, 0.0)):
+        self.coefficients = np.array(coefficients, dtype=float)
+        self.features = []
+        self.times = []
+        # Incremented by every update, so that users of the predictions can tell they changed
+        self.version = 0
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def from_csv(filename="Profiling/GeneralMeasure-030518_5runs_per_file.csv"):
+        """Calibrates a model from a profiling csv with
+        (time, total hits in event, maximum number of hits in a sensor) rows.
+        """
+        model = cost_model()
+        with open(filename) as f:
+            rows = list(csv.reader(f))[1:]
+        for row in rows:
+            model.features.append((int(row[1]), int(row[2])))
+            model.times.append(float(row[0]))
+        model.fit()
+        return model
+
+    def fit(self):
+        if len(self.times) < 3:
+            return
+        a = np.column_stack([np.ones(len(self.features)), np.log(np.array(self.features, dtype=float))])
+        b = np.log(np.maximum(self.times, 1e-6))
+        self.coefficients = np.linalg.lstsq(a, b, rcond=None)[0]
+
+    def predict(self, features):
+        hits, max_sensor_hits = features
+        return float(np.exp(self.coefficients[0] + self.coefficients[1] * np.log(max(hits, 1)) +
+                            self.coefficients[2] * np.log(max(max_sensor_hits, 1))))
+
+    def update(self, features, time):
+        """Adds a measured runtime and refits the model."""
+        with self.lock:
+            self.features.append(tuple(features))
+            self.times.append(time)
+            self.fit()
+            self.version += 1
+
+
+class schedule_report(object):
+    """Outcome of a scheduled batch run.
+
+    makespan: wall time of the batch.
+    ideal: lower bound of the makespan, max(total work / workers, longest task).
+    """
+    def __init__(self, n_workers, makespan, times, busy, steals):
+        self.n_workers = n_workers
+        self.makespan = makespan
+        self.times = times
+        self.busy = busy
+        self.steals = steals
+        self.ideal = max(sum(times) / n_workers, max(times)) if len(times) > 0 else 0.0
+
+    def __repr__(self):
+        return "%d tasks on %d workers: makespan %.3fs, ideal %.3fs (%.1f%%), %d steals\n" \
+               " worker busy times: %s" % (len(self.times), self.n_workers, self.makespan, self.ideal,
+               100. * self.ideal / self.makespan if self.makespan > 0 else 100., self.steals,
+               ", ".join(["%.3fs" % b for b in self.busy]))
+
+
+def timed_call(function, payload):
+    start = time.perf_counter()
+    result = function(payload)
+    return result, time.perf_counter() - start
+
+
+class work_stealing_scheduler(object):
+    """Runs function(payload) for many tasks on n_workers processes.
+
+    Tasks are sorted by predicted cost and dealt largest first to per-worker
+    queues (LPT). Each worker takes the largest task of its own queue; when
+    that is empty it steals the largest pending task of the queue with the most
+    predicted work left. Measured runtimes refine the cost model as they come in,
+    and the next worker to take a task first re-plans the pending tasks with the
+    refined predictions, so the plan does not stay the one of the initial model.
+    """
+    def __init__(self, function, n_workers=None, model=None):
+        self.function = function
+        self.n_workers = n_workers or os.cpu_count()
+        self.model = model or cost_model()
+
+    def plan(self, features, indices=None):
+        """Returns the per-worker queues of task indices (all, or those in indices), largest predicted cost first."""
+        costs = {i: self.model.predict(features[i]) for i in (range(len(features)) if indices is None else indices)}
+        queues = [collections.deque() for _ in range(self.n_workers)]
+        loads = [0.0] * self.n_workers
+        for index in sorted(costs, key=lambda i: costs[i], reverse=True):
+            worker = loads.index(min(loads))
+            queues[worker].append(index)
+            loads[worker] += costs[index]
+        return queues
+
+    def run(self, payloads, features):
+        """Returns the results of all tasks, in the order of payloads, and a schedule_report."""
+        queues = self.plan(features)
+        planned = [self.model.version]
+        lock = threading.Lock()
+        results = [None] * len(payloads)
+        times = [None] * len(payloads)
+        busy = [0.0] * self.n_workers
+        steals = [0]
+        errors = []
+
+        def next_task(worker):
+            with lock:
+                if self.model.version != planned[0]:
+                    planned[0] = self.model.version
+                    queues[:] = self.plan(features, [i for q in queues for i in q])
+                if len(queues[worker]) > 0:
+                    return queues[worker].popleft()
+                remaining = [sum(self.model.predict(features[i]) for i in q) for q in queues]
+                victim = remaining.index(max(remaining))
+                if len(queues[victim]) > 0:
+                    steals[0] += 1
+                    return queues[victim].popleft()
+                return None
+
+        def worker_loop(worker, executor):
+            index = next_task(worker)
+            while index is not None and len(errors) == 0:
+                try:
+                    results[index], times[index] = executor.submit(timed_call, self.function, payloads[index]).result()
+                except Exception as e:
+                    errors.append(e)
+                    return
+                busy[worker] += times[index]
+                self.model.update(features[index], times[index])
+                index = next_task(worker)
+
+        start = time.perf_counter()
+        with ProcessPoolExecutor(self.n_workers) as executor:
+            threads = [threading.Thread(target=worker_loop, args=(w, executor)) for w in range(self.n_workers)]
+            for t in threads:
+                t.start()
+            for t in threads:
+                t.join()
+        makespan = time.perf_counter() - start
+        if len(errors) > 0:
+            raise errors[0]
+        return results, schedule_report(self.n_workers, makespan, times, busy, steals[0])
+
+
+def solve_file(task):
+    """Task function for solving json event files: task is (solver, path).
+    Returns the tracks as an event_model.track_collection.
+    """
+    solver, path = task
+    with open(path) as f:
+        event = em.event(json.loads(f.read()))
+    return em.track_collection.from_tracks(solver.solve(event), [h.id for h in event.hits])
@@ -0,0 +1,172 @@
+"""Search by triplet: the best triplet of each middle hit is seeded, and the triplets are forwarded sensor by sensor.
+
+The hits of each sensor are ordered by phi, and every search is a window on
+them. Sensors are processed from the last one to the first; at each sensor
+  - the tracks being followed are extrapolated to it and take the hit of the
+    prediction window that fits best (smallest scatter), if it is within the
+    tolerances. A track that finds nothing in max_missed sensors in a row is
+    finished.
+  - triplets are seeded with their third hit on it: the hits of the sensor
+    two sensors further on (the middle sensor) are paired with the hits of the
+    sensor two further on again within phi_tolerance in phi, each pair is
+    extrapolated to this sensor, and the best fitting triplet of each middle
+    hit is kept.
+Both steps flag the hits they take in a used-hit array, and only unused hits
+are taken. All the candidates of a sensor are handled at once with NumPy, so
+the cost grows with the number of candidates in the windows rather than
+with all the hit pairs of two sensors.
+"""
+import event_model as em
+import layer_kernels
+import numpy as np
+
+
+NEXT_SENSOR = 2
+
+
+def window_candidates(lo, hi):
+    """All the (query, position) pairs with lo[query] <= position < hi[query], ordered by query."""
+    counts = hi - lo
+    query = np.repeat(np.arange(len(lo)), counts)
+    first = np.repeat(np.cumsum(counts) - counts, counts)
+    return query, np.repeat(lo, counts) + np.arange(len(query)) - first
+
+
+def best_in_group(groups, scores):
+    """Index of the element with the smallest score of each group."""
+    order = np.lexsort((scores, groups))
+    return order[np.r_[True, groups[order][1:] != groups[order][:-1]]] if len(order) > 0 else order
+
+
+class search_by_triplet(object):
+    def __init__(self, max_slopes=(0.7, 0.7), max_tolerance=(0.4, 0.4), max_scatter=0.4, phi_tolerance=0.05,
+                 max_missed=3, min_length=3):
+        """phi_tolerance: the phi window (rad) around a middle hit its first hit is looked for in.
+        max_missed: number of sensors in a row without a hit after which a track is finished.
+        min_length: the shortest track kept.
+        """
+        self.__max_slopes = max_slopes
+        self.__max_tolerance = max_tolerance
+        self.__max_scatter = max_scatter
+        self.__phi_tolerance = phi_tolerance
+        self.__max_missed = max_missed
+        self.__min_length = min_length
+
+    def phi_windows(self, event, hit_x, hit_y):
+        """Per sensor, the phi of its hits in order, and the hits in that order, repeated a turn
+        before and after so that windows across +-pi are contiguous.
+        """
+        phi = np.arctan2(hit_y, hit_x)
+        windows = []
+        for sensor in event.sensors:
+            hits = np.arange(sensor.hit_start_index, sensor.hit_end_index)
+            hits = hits[np.argsort(phi[hits], kind='stable')]
+            windows.append((np.concatenate([phi[hits] - 2 * np.pi, phi[hits], phi[hits] + 2 * np.pi]),
+                            np.tile(hits, 3)))
+        return phi, windows
+
+    def window_hits(self, window, centers, half_widths):
+        """The (query, hit) pairs of the hits within half_widths of centers in phi."""
+        phis, hits = window
+        half_widths = np.minimum(half_widths, 0.999 * np.pi)
+        query, positions = window_candidates(np.searchsorted(phis, centers - half_widths),
+                                             np.searchsorted(phis, centers + half_widths, 'right'))
+        return query, hits[positions]
+
+    def prediction_hits(self, window, x, y, z, h0, h1, sensor_z):
+        """The (query, hit) pairs of the hits around the extrapolation of the lines (h0, h1) to sensor_z,
+        in a phi window as wide as the tolerances at the predicted radius.
+        """
+        t = (sensor_z - z[h0]) / (z[h1] - z[h0])
+        x_prediction = x[h0] + (x[h1] - x[h0]) * t
+        y_prediction = y[h0] + (y[h1] - y[h0]) * t
+        radius = np.sqrt(x_prediction * x_prediction + y_prediction * y_prediction)
+        ratio = np.hypot(*self.__max_tolerance) / np.maximum(radius, np.hypot(*self.__max_tolerance))
+        return self.window_hits(window, np.arctan2(y_prediction, x_prediction),
+                                np.where(ratio < 1, np.arcsin(ratio), np.pi))
+
+    def fits(self, x, y, z, h0, h1, h2):
+        """check_tolerance of the triplets (h0, h1, h2), and their scatter."""
+        dx, dy, scatter = layer_kernels.extrapolation(x[h0], y[h0], z[h0], x[h1], y[h1], z[h1], x[h2], y[h2], z[h2])
+        return (dx < self.__max_tolerance[0]) & (dy < self.__max_tolerance[1]) & (scatter < self.__max_scatter), scatter
+
+    def forward(self, state, sensor, window):
+        """Extends the followed tracks with their best fitting unused hit of sensor.
+        Returns the tracks that are finished.
+        """
+        x, y, z, used = state["x"], state["y"], state["z"], state["used"]
+        tracks, previous, last, missed = state["tracks"], state["previous"], state["last"], state["missed"]
+        query, hits = self.prediction_hits(window, x, y, z, previous[tracks], last[tracks], sensor.z)
+        fit, scatter = self.fits(x, y, z, previous[tracks[query]], last[tracks[query]], hits)
+        fit &= ~used[hits]
+        query, hits, scatter = query[fit], hits[fit], scatter[fit]
+        best = best_in_group(query, scatter)
+        # A hit wanted by several tracks goes to the one it fits best
+        best = best[best_in_group(hits[best], scatter[best])]
+        found = tracks[query[best]]
+        for track, hit in zip(found.tolist(), hits[best].tolist()):
+            state["track_hits"][track].append(hit)
+        state["chi2"][found] += scatter[best]
+        previous[found] = last[found]
+        last[found] = hits[best]
+        used[hits[best]] = True
+        missed[tracks] += 1
+        missed[found] = 0
+        state["tracks"] = tracks[missed[tracks] < self.__max_missed]
+        return tracks[missed[tracks] >= self.__max_missed]
+
+    def seed(self, state, windows, index):
+        """Seeds triplets with their first hit on sensor index + 2 * NEXT_SENSOR, their middle hit on
+        sensor index + NEXT_SENSOR and their last hit on sensor index. Returns the new tracks.
+        """
+        x, y, z, phi, used = state["x"], state["y"], state["z"], state["phi"], state["used"]
+        event = state["event"]
+        middle = event.sensors[index + NEXT_SENSOR]
+        h1 = np.arange(middle.hit_start_index, middle.hit_end_index)
+        h1 = h1[~used[h1]]
+        query, h0 = self.window_hits(windows[index + 2 * NEXT_SENSOR], phi[h1], np.full(len(h1), self.__phi_tolerance))
+        h1 = h1[query]
+        compatible = ~used[h0] & \
+            layer_kernels.compatible_pairs(x[h0], z[h0], x[h1], z[h1], self.__max_slopes[0]) & \
+            layer_kernels.compatible_pairs(y[h0], z[h0], y[h1], z[h1], self.__max_slopes[1])
+        h0, h1 = h0[compatible], h1[compatible]
+        query, h2 = self.prediction_hits(windows[index], x, y, z, h0, h1, event.sensors[index].z)
+        h0, h1 = h0[query], h1[query]
+        fit, scatter = self.fits(x, y, z, h0, h1, h2)
+        fit &= ~used[h2]
+        h0, h1, h2, scatter = h0[fit], h1[fit], h2[fit], scatter[fit]
+        # The best triplet of each middle hit, and of those, the best of each first and of each last hit
+        best = best_in_group(h1, scatter)
+        best = best[best_in_group(h0[best], scatter[best])]
+        best = best[best_in_group(h2[best], scatter[best])]
+        h0, h1, h2, scatter = h0[best], h1[best], h2[best], scatter[best]
+        used[h0] = used[h1] = used[h2] = True
+        first = len(state["track_hits"])
+        state["track_hits"] += [list(hits) for hits in zip(h0.tolist(), h1.tolist(), h2.tolist())]
+        for name, values in (("previous", h1), ("last", h2), ("missed", np.zeros(len(h2), dtype=int)), ("chi2", scatter)):
+            state[name] = np.concatenate([state[name], values])
+        return np.arange(first, len(state["track_hits"]))
+
+    def solve(self, event):
+        print("Invoking search by triplet with\n max slopes: %s\n max tolerance: %s\n max scatter: %s\n phi tolerance: %s\n" %
+              (self.__max_slopes, self.__max_tolerance, self.__max_scatter, self.__phi_tolerance))
+        x, y, z = layer_kernels.hit_arrays(event.hits)
+        phi, windows = self.phi_windows(event, x, y)
+        state = {"event": event, "x": x, "y": y, "z": z, "phi": phi, "used": np.zeros(len(event.hits), dtype=bool),
+                 "track_hits": [], "chi2": np.zeros(0), "previous": np.zeros(0, dtype=int), "last": np.zeros(0, dtype=int),
+                 "missed": np.zeros(0, dtype=int), "tracks": np.zeros(0, dtype=int)}
+        finished = []
+        for index in reversed(range(len(event.sensors))):
+            finished.append(self.forward(state, event.sensors[index], windows[index]))
+            if index + 2 * NEXT_SENSOR < len(event.sensors):
+                state["tracks"] = np.concatenate([state["tracks"], self.seed(state, windows, index)])
+        finished.append(state["tracks"])
+
+        tracks = []
+        for track_index in np.sort(np.concatenate(finished)).tolist():
+            hits = state["track_hits"][track_index]
+            if len(hits) >= self.__min_length:
+                t = em.track([event.hits[h] for h in hits], len(hits))
+                t.chi2 = state["chi2"][track_index]
+                tracks.append(t)
+        return tracks
@@ -0,0 +1,268 @@
+"""Long-running reconstruction server.
+
+Keeps a configured solver (and optionally a pool of worker processes, each
+holding its own copy of the solver) warm, and reconstructs events sent over
+a Unix socket or TCP. Requests that queue up while a batch is being solved
+are picked up together as the next micro-batch.
+
+Protocol: every message is a frame of one kind byte, a 4 byte big-endian
+payload length and the payload.
+
+  J  event in the velojson format       -> J  {"tracks": [[hit id, ...], ...]}
+  B  event in the binary format          -> B  track_collection in the binary
+     (shared_event.event_buffer)              format, hit indices into the event
+  S  empty                               -> S  json latency and throughput counters
+  E                                         E  error message (reply only)
+
+Frames of any other kind are answered with an E frame. If a worker process
+dies, the requests of its batch are answered with an E frame and the pool is
+started again.
+"""
+from concurrent.futures import ProcessPoolExecutor, Future
+from shared_event import event_buffer, pack_tracks, read_track_collection
+import event_model as em
+import numpy as np
+import socketserver
+import threading
+import socket
+import os
+import struct
+import queue
+import json
+import time
+
+
+HEADER = struct.Struct(">cI")
+REQUEST_KINDS = (b"J", b"B")
+LATENCY_SAMPLES = 100000
+
+
+def make_solver(name, **parameters):
+    """Returns a solver by name: classic, dfs or ca."""
+    if name == "classic":
+        from classical_solver import classical_solver
+        return classical_solver(**parameters)
+    if name == "dfs":
+        from graph_dfs import graph_dfs
+        return graph_dfs(**parameters)
+    if name == "ca":
+        from CellularAutomaton.CellularAutomaton import CellularAutomaton
+        return CellularAutomaton(**parameters)
+    raise ValueError("Unknown solver: %s" % name)
+
+
+def send_frame(sock, kind, payload):
+    sock.sendall(HEADER.pack(kind, len(payload)) + payload)
+
+
+def receive_exactly(sock, size):
+    data = bytearray()
+    while len(data) < size:
+        chunk = sock.recv(size - len(data))
+        if not chunk:
+            raise EOFError
+        data += chunk
+    return bytes(data)
+
+
+def receive_frame(sock):
+    kind, size = HEADER.unpack(receive_exactly(sock, HEADER.size))
+    return kind, receive_exactly(sock, size)
+
+
+def reconstruct(solver, kind, payload):
+    """Solves one request. Returns the (kind, payload) of the reply."""
+    try:
+        if kind == b"J":
+            event = em.event(json.loads(payload.decode()))
+            tracks = solver.solve(event)
+            return b"J", json.dumps({"tracks": [[h.id for h in t.hits] for t in tracks]}).encode()
+        if kind != b"B":
+            raise ValueError("Unknown frame kind: %r" % kind)
+        arrays = event_buffer(payload)
+        event = arrays.event()
+        hit_ids = arrays.hit_id.tolist()
+        arrays.release()
+        return b"B", pack_tracks(em.track_collection.from_tracks(solver.solve(event), hit_ids))
+    except Exception as e:
+        return b"E", repr(e).encode()
+
+
+_worker_solver = None
+
+
+def init_worker(solver):
+    global _worker_solver
+    _worker_solver = solver
+
+
+def reconstruct_batch(requests):
+    """Worker side: solves a list of (kind, payload) requests with the warm solver."""
+    return [reconstruct(_worker_solver, kind, payload) for kind, payload in requests]
+
+
+class counters(object):
+    """Latency (of the last LATENCY_SAMPLES requests) and throughput counters."""
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.requests = 0
+        self.batches = 0
+        self.errors = 0
+        self.latencies = np.zeros(LATENCY_SAMPLES)
+        self.lock = threading.Lock()
+
+    def add_batch(self, latencies, errors):
+        with self.lock:
+            for latency in latencies:
+                self.latencies[self.requests % LATENCY_SAMPLES] = latency
+                self.requests += 1
+            self.batches += 1
+            self.errors += errors
+
+    def stats(self):
+        with self.lock:
+            uptime = time.perf_counter() - self.start
+            latencies = self.latencies[:min(self.requests, LATENCY_SAMPLES)]
+            p50, p99, p999 = np.percentile(latencies, [50, 99, 99.9]) if len(latencies) > 0 else (0., 0., 0.)
+            return {"requests": self.requests, "errors": self.errors, "batches": self.batches,
+                    "mean_batch_size": self.requests / self.batches if self.batches > 0 else 0.,
+                    "uptime": uptime, "throughput": self.requests / uptime,
+                    "latency_p50": p50, "latency_p99": p99, "latency_p999": p999}
+
+
+class request_handler(socketserver.BaseRequestHandler):
+    """Reads frames from one connection and queues them; replies in order."""
+    def handle(self):
+        server = self.server.reconstruction_server
+        while True:
+            try:
+                kind, payload = receive_frame(self.request)
+            except (EOFError, ConnectionError):
+                return
+            if kind == b"S":
+                send_frame(self.request, b"S", json.dumps(server.counters.stats()).encode())
+                continue
+            if kind not in REQUEST_KINDS:
+                send_frame(self.request, b"E", ("Unknown frame kind: %r" % kind).encode())
+                continue
+            reply = Future()
+            server.requests.put((time.perf_counter(), kind, payload, reply))
+            reply_kind, reply_payload = reply.result()
+            send_frame(self.request, reply_kind, reply_payload)
+
+
+class tcp_server(socketserver.ThreadingTCPServer):
+    allow_reuse_address = True
+
+
+class reconstruction_server(object):
+    """Serves reconstruction requests with solver on address.
+
+    address: a path (Unix socket) or a (host, port) pair (TCP).
+    workers: number of worker processes; 0 solves on the server process.
+    max_batch: most requests picked up as one micro-batch.
+    """
+    def __init__(self, solver, address, workers=0, max_batch=16):
+        self.solver = solver
+        self.workers = workers
+        self.max_batch = max_batch
+        self.requests = queue.Queue()
+        self.counters = counters()
+        self.executor = None
+        self.pool_restarts = 0
+        if workers > 0:
+            self.start_workers()
+        if isinstance(address, str):
+            if os.path.exists(address):
+                os.unlink(address)
+            self.server = socketserver.ThreadingUnixStreamServer(address, request_handler)
+        else:
+            self.server = tcp_server(address, request_handler)
+        self.server.daemon_threads = True
+        self.server.reconstruction_server = self
+        self.dispatcher = threading.Thread(target=self.dispatch, daemon=True)
+
+    def start_workers(self):
+        self.executor = ProcessPoolExecutor(self.workers, initializer=init_worker, initargs=(self.solver,))
+        # Start the workers now, not on the first request
+        list(self.executor.map(reconstruct_batch, [[] for _ in range(self.workers)]))
+
+    def restart_workers(self):
+        """Replaces a pool that can no longer be used, eg. after a worker was killed."""
+        self.executor.shutdown(wait=False)
+        self.pool_restarts += 1
+        self.start_workers()
+
+    def solve_batch(self, requests):
+        """Replies to requests, using the worker processes. If the pool fails (a worker died), all replies are E."""
+        chunks = [requests[i::self.workers] for i in range(min(self.workers, len(requests)))]
+        replies = [None] * len(requests)
+        try:
+            for i, chunk_replies in enumerate(self.executor.map(reconstruct_batch, chunks)):
+                replies[i::self.workers] = chunk_replies
+        except Exception as e:
+            self.restart_workers()
+            return [(b"E", repr(e).encode())] * len(requests)
+        return replies
+
+    def next_batch(self):
+        batch = [self.requests.get()]
+        while len(batch) < self.max_batch:
+            try:
+                batch.append(self.requests.get_nowait())
+            except queue.Empty:
+                break
+        return batch
+
+    def dispatch(self):
+        while True:
+            batch = self.next_batch()
+            requests = [(kind, payload) for _, kind, payload, _ in batch]
+            if self.executor is None:
+                replies = [reconstruct(self.solver, kind, payload) for kind, payload in requests]
+            else:
+                replies = self.solve_batch(requests)
+            now = time.perf_counter()
+            for (_, _, _, future), reply in zip(batch, replies):
+                future.set_result(reply)
+            self.counters.add_batch([now - received for received, _, _, _ in batch],
+                                    sum(1 for kind, _ in replies if kind == b"E"))
+
+    def serve_forever(self):
+        self.dispatcher.start()
+        self.server.serve_forever()
+
+    def shutdown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        if self.executor is not None:
+            self.executor.shutdown()
+
+
+class client(object):
+    """Connection to a reconstruction_server."""
+    def __init__(self, address):
+        family = socket.AF_UNIX if isinstance(address, str) else socket.AF_INET
+        self.sock = socket.socket(family, socket.SOCK_STREAM)
+        self.sock.connect(address)
+
+    def request(self, kind, payload):
+        send_frame(self.sock, kind, payload)
+        reply_kind, reply_payload = receive_frame(self.sock)
+        if reply_kind == b"E":
+            raise RuntimeError(reply_payload.decode())
+        return reply_kind, reply_payload
+
+    def solve_json(self, json_text):
+        """Returns the tracks of the event, as lists of hit ids."""
+        return json.loads(self.request(b"J", json_text.encode())[1].decode())["tracks"]
+
+    def solve_binary(self, payload):
+        """Returns the tracks of the binary event, as a track_collection."""
+        return read_track_collection(self.request(b"B", payload)[1])
+
+    def stats(self):
+        return json.loads(self.request(b"S", b"")[1].decode())
+
+    def close(self):
+        self.sock.close()
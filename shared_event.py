@@ -0,0 +1,284 @@
+"""Zero-copy transport of events to worker processes, and of tracks back,
+through shared memory instead of pickling event_model objects.
+
+The owner places the hit and sensor arrays of an event in a shared memory
+block with shared_event.create; a worker attaches to it by name, solves,
+and writes its tracks as a track_collection (offsets + hit indices) to a
+result block whose name was chosen by the owner. The owner always unlinks
+both blocks, so nothing is left behind when a worker dies half way.
+
+Only the transport is zero-copy: attaching copies nothing, but the solvers
+work on event_model hits, so the worker still builds an event_model.event
+with one hit object per hit from the arrays (shared_event.event), and the
+solve itself is no faster. What is saved is pickling the objects on the
+owner side and unpickling them on the worker side: on the first 10 velojson
+events (run_shared_event.py), 0.06s (0.02s writing the blocks, 0.04s
+building the events) and 0.95MB of shared memory, against 0.09s and 2.7MB
+of pickles; on all 30 (run_shared_event.py 30), 0.10s and 2.4MB against
+0.16s and 6.7MB.
+"""
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from multiprocessing import shared_memory, resource_tracker
+import numpy as np
+import event_model as em
+import os
+import time
+import uuid
+
+
+class event_buffer(object):
+    """An event's hit and sensor arrays, as views on a buffer (the binary event format).
+
+    Layout, in 8 byte words: number of sensors, number of hits,
+    sensor z, sensor hit start, sensor number of hits,
+    hit x, hit y, hit z, hit id.
+    """
+    def __init__(self, buffer):
+        header = np.ndarray((2,), dtype=np.int64, buffer=buffer)
+        self.number_of_sensors = int(header[0])
+        self.number_of_hits = int(header[1])
+        offset = header.nbytes
+        arrays = []
+        for length, dtype in [(self.number_of_sensors, np.float64), (self.number_of_sensors, np.int64),
+                              (self.number_of_sensors, np.int64), (self.number_of_hits, np.float64),
+                              (self.number_of_hits, np.float64), (self.number_of_hits, np.float64),
+                              (self.number_of_hits, np.int64)]:
+            arrays.append(np.ndarray((length,), dtype=dtype, buffer=buffer, offset=offset))
+            offset += 8 * length
+        (self.sensor_z, self.sensor_hit_start, self.sensor_number_of_hits,
+         self.hit_x, self.hit_y, self.hit_z, self.hit_id) = arrays
+
+    @staticmethod
+    def nbytes(event):
+        return 8 * (2 + 3 * len(event.sensors) + 4 * len(event.hits))
+
+    @classmethod
+    def write(cls, event, buffer):
+        """Writes event into buffer, of at least nbytes(event) bytes."""
+        np.ndarray((2,), dtype=np.int64, buffer=buffer)[:] = [len(event.sensors), len(event.hits)]
+        arrays = cls(buffer)
+        arrays.sensor_z[:] = [s.z for s in event.sensors]
+        arrays.sensor_number_of_hits[:] = [s.hit_end_index - s.hit_start_index for s in event.sensors]
+        arrays.sensor_hit_start[:] = np.cumsum(arrays.sensor_number_of_hits) - arrays.sensor_number_of_hits
+        arrays.hit_x[:] = [h.x for h in event.hits]
+        arrays.hit_y[:] = [h.y for h in event.hits]
+        arrays.hit_z[:] = [h.z for h in event.hits]
+        arrays.hit_id[:] = [h.id for h in event.hits]
+        return arrays
+
+    @classmethod
+    def pack(cls, event):
+        """Returns event in the binary format, as bytes."""
+        buffer = bytearray(cls.nbytes(event))
+        cls.write(event, buffer).release()
+        return bytes(buffer)
+
+    def event(self, side=None):
+        """Builds the event_model.event the solvers work on from the shared arrays.
+        This copies the arrays into lists and makes a hit object per hit.
+        The event carries no montecarlo information.
+
+        If side is 0 or 1, only the hits of the even or odd sensors (one VELO half)
+        are kept, the sensors of the other half are left empty.
+        """
+        sensor_number_of_hits = self.sensor_number_of_hits
+        hit_mask = slice(None)
+        if side is not None:
+            keep = np.arange(self.number_of_sensors) % 2 == side
+            sensor_number_of_hits = np.where(keep, self.sensor_number_of_hits, 0)
+            hit_mask = np.repeat(keep, self.sensor_number_of_hits)
+        return em.event({"event": {
+            "number_of_sensors": self.number_of_sensors,
+            "number_of_hits": int(np.sum(sensor_number_of_hits)),
+            "sensor_module_z": self.sensor_z.tolist(),
+            "sensor_hits_starting_index": (np.cumsum(sensor_number_of_hits) - sensor_number_of_hits).tolist(),
+            "sensor_number_of_hits": sensor_number_of_hits.tolist(),
+            "hit_x": self.hit_x[hit_mask].tolist(),
+            "hit_y": self.hit_y[hit_mask].tolist(),
+            "hit_z": self.hit_z[hit_mask].tolist(),
+            "hit_id": self.hit_id[hit_mask].tolist()}, "montecarlo": None})
+
+    def release(self):
+        """Drops the views, so that the buffer can be released."""
+        self.sensor_z = self.sensor_hit_start = self.sensor_number_of_hits = None
+        self.hit_x = self.hit_y = self.hit_z = self.hit_id = None
+
+
+class shared_event(event_buffer):
+    """An event in the binary format in one shared memory block.
+    The arrays are views on the block, no copy is made when attaching.
+    """
+    def __init__(self, shm, owner=False):
+        event_buffer.__init__(self, shm.buf)
+        self.shm = shm
+        self.owner = owner
+
+    @classmethod
+    def create(cls, event, name=None):
+        """Copies event into a new shared memory block, owned by the caller."""
+        shm = shared_memory.SharedMemory(name=name, create=True, size=cls.nbytes(event))
+        event_buffer.write(event, shm.buf).release()
+        return cls(shm, owner=True)
+
+    @classmethod
+    def attach(cls, name):
+        return cls(shared_memory.SharedMemory(name=name))
+
+    @property
+    def name(self):
+        return self.shm.name
+
+    def close(self):
+        self.release()
+        self.shm.close()
+
+    def unlink(self):
+        self.shm.unlink()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+        if self.owner:
+            self.unlink()
+
+
+def tracks_nbytes(collection):
+    return 8 * (1 + len(collection.offsets) + len(collection.hit_indices))
+
+
+def write_track_collection(collection, buffer):
+    """Writes collection into buffer, of at least tracks_nbytes(collection) bytes.
+    Layout, in 8 byte words: number of tracks, offsets, hit indices.
+    """
+    words = np.ndarray((tracks_nbytes(collection) // 8,), dtype=np.int64, buffer=buffer)
+    words[0] = len(collection)
+    words[1:len(collection.offsets) + 1] = collection.offsets
+    words[len(collection.offsets) + 1:] = collection.hit_indices
+
+
+def read_track_collection(buffer):
+    """Reads (a copy of) the track_collection written by write_track_collection."""
+    words = np.ndarray((len(buffer) // 8,), dtype=np.int64, buffer=buffer)
+    number_of_tracks = int(words[0])
+    offsets = words[1:number_of_tracks + 2].copy()
+    hit_indices = words[number_of_tracks + 2:number_of_tracks + 2 + offsets[-1]].copy()
+    return em.track_collection(offsets, hit_indices)
+
+
+def pack_tracks(collection):
+    """Returns collection in the binary format, as bytes."""
+    buffer = bytearray(tracks_nbytes(collection))
+    write_track_collection(collection, buffer)
+    return bytes(buffer)
+
+
+def write_tracks(name, tracks, hit_ids):
+    """Writes tracks as a track_collection to a new shared memory block called name,
+    with hit indices into the hit list with ids hit_ids.
+    """
+    collection = em.track_collection.from_tracks(tracks, hit_ids)
+    shm = shared_memory.SharedMemory(name=name, create=True, size=tracks_nbytes(collection))
+    write_track_collection(collection, shm.buf)
+    shm.close()
+
+
+def read_tracks(name):
+    """Reads and unlinks the track_collection block written by write_tracks."""
+    shm = shared_memory.SharedMemory(name=name)
+    try:
+        return read_track_collection(shm.buf)
+    finally:
+        shm.close()
+        shm.unlink()
+
+
+def discard_block(name):
+    """Unlinks the block called name, if a worker got to create it."""
+    try:
+        shm = shared_memory.SharedMemory(name=name)
+    except FileNotFoundError:
+        return
+    shm.close()
+    shm.unlink()
+
+
+def solve_shared(solver, event_name, result_name, side=None):
+    """Worker side: solves the shared event event_name (or only one side of it)
+    and writes the tracks to result_name, as indices into the full event.
+    Returns the solve time.
+    """
+    with shared_event.attach(event_name) as shared:
+        event = shared.event(side)
+        hit_ids = shared.hit_id.tolist()
+    start = time.perf_counter()
+    tracks = solver.solve(event)
+    elapsed = time.perf_counter() - start
+    write_tracks(result_name, tracks, hit_ids)
+    return elapsed
+
+
+class shared_event_pool(object):
+    """Solves events on a pool of processes, handing them over in shared memory.
+
+    solve returns, for each event, a pair (tracks, solve time); the tracks
+    are made of the hits of the given event. If a worker dies or raises,
+    the pair is (None, None), its blocks are unlinked and the pool restarted.
+    """
+    def __init__(self, solver, processes=None):
+        self.solver = solver
+        self.processes = processes
+        # Workers must share the owner's resource tracker, otherwise blocks
+        # they attach to would be unlinked when they exit
+        resource_tracker.ensure_running()
+        self.executor = ProcessPoolExecutor(processes)
+
+    def solve(self, events):
+        events = list(events)
+        prefix = "velo%d_%s" % (os.getpid(), uuid.uuid4().hex[:8])
+        blocks = []
+        futures = []
+        results = []
+        broken = False
+        try:
+            for index, event in enumerate(events):
+                blocks.append(shared_event.create(event, "%s_e%d" % (prefix, index)))
+                try:
+                    futures.append(self.executor.submit(solve_shared, self.solver, blocks[-1].name,
+                                                        "%s_t%d" % (prefix, index)))
+                except BrokenProcessPool:
+                    broken = True
+                    futures.append(None)
+            for index, future in enumerate(futures):
+                result_name = "%s_t%d" % (prefix, index)
+                try:
+                    if future is None:
+                        raise BrokenProcessPool()
+                    elapsed = future.result()
+                    tracks = read_tracks(result_name).to_tracks(events[index].hits)
+                    results.append((tracks, elapsed))
+                except Exception as e:
+                    broken = broken or isinstance(e, BrokenProcessPool)
+                    discard_block(result_name)
+                    results.append((None, None))
+        finally:
+            for block in blocks:
+                block.close()
+                block.unlink()
+            for index in range(len(futures)):
+                discard_block("%s_t%d" % (prefix, index))
+        if broken:
+            self.executor.shutdown(wait=False)
+            self.executor = ProcessPoolExecutor(self.processes)
+        return results
+
+    def shutdown(self):
+        self.executor.shutdown()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.shutdown()
@@ -0,0 +1,197 @@
+"""Content-addressed on-disk cache of solver outputs.
+
+The key of a result is a hash of the event content (its binary form, see
+shared_event.event_buffer), the solver class, the solver parameters and the
+code version (the source of the solver's module and of every module of this
+repository it imports, directly or through other such modules). The tracks
+are stored as a binary track_collection, one file per key. Reading a result
+refreshes its modification time, and the least recently used files are
+evicted once the cache grows over max_bytes.
+
+  cache = solver_cache(".solver_cache")
+  solver = cached_solver(CellularAutomaton(), cache)
+  tracks = solver.solve(event)
+  print(cache.report())
+"""
+from shared_event import event_buffer, pack_tracks, read_track_collection
+import event_model as em
+import hashlib
+import inspect
+import os
+import sys
+import uuid
+
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+PARAMETER_TYPES = (type(None), bool, int, float, str, tuple, list)
+# Attributes that hold run time state rather than configuration, whatever their value
+STATE_ATTRIBUTES = ("executor", "context", "contexts")
+SUFFIX = ".tracks"
+
+
+def solver_parameters(solver):
+    """The configuration of solver: its attributes that are plain values (None included, as an unset cut),
+    which leaves out executors, cached intermediates and the like.
+    """
+    return sorted((name, value) for name, value in vars(solver).items()
+                  if isinstance(value, PARAMETER_TYPES) and name.split("__")[-1] not in STATE_ATTRIBUTES)
+
+
+def local_source(module):
+    """The source file of module if it is part of this repository, else None."""
+    try:
+        filename = inspect.getsourcefile(module)
+    except TypeError:
+        # built in modules
+        return None
+    if filename is None:
+        return None
+    filename = os.path.abspath(filename)
+    return filename if filename.startswith(ROOT + os.sep) else None
+
+
+def imported_modules(module):
+    """The modules module refers to: those it imports, and those of the functions and classes it imports."""
+    modules = set()
+    for value in list(vars(module).values()):
+        if inspect.ismodule(value):
+            modules.add(value)
+        elif getattr(value, "__module__", None) in sys.modules:
+            modules.add(sys.modules[value.__module__])
+    return modules
+
+
+def local_sources(module):
+    """The source files of module and of the modules of this repository it imports, transitively, sorted."""
+    sources = {}
+    pending = [module]
+    while pending:
+        module = pending.pop()
+        filename = local_source(module)
+        if filename is None or filename in sources:
+            continue
+        sources[filename] = module
+        pending.extend(imported_modules(module))
+    return sorted(sources)
+
+
+def code_version(solver):
+    """Hash of the source of the solver's module and of the modules of this repository it depends on."""
+    digest = hashlib.sha256()
+    for filename in local_sources(sys.modules[type(solver).__module__]):
+        digest.update(os.path.relpath(filename, ROOT).encode())
+        with open(filename, 'rb') as f:
+            digest.update(f.read())
+    return digest.hexdigest()
+
+
+class solver_cache(object):
+    """Tracks of solved events, in directory, using at most max_bytes."""
+    def __init__(self, directory=".solver_cache", max_bytes=256 * 1024 * 1024):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.versions = {}
+        os.makedirs(directory, exist_ok=True)
+        self.nbytes = sum(os.path.getsize(path) for path in self.paths())
+
+    def paths(self):
+        return [os.path.join(self.directory, f) for f in os.listdir(self.directory) if f.endswith(SUFFIX)]
+
+    def key(self, solver, event):
+        solver_class = type(solver)
+        if solver_class not in self.versions:
+            self.versions[solver_class] = code_version(solver)
+        digest = hashlib.sha256()
+        digest.update(("%s.%s" % (solver_class.__module__, solver_class.__qualname__)).encode())
+        digest.update(repr(solver_parameters(solver)).encode())
+        digest.update(self.versions[solver_class].encode())
+        digest.update(event_buffer.pack(event))
+        return digest.hexdigest()
+
+    def path(self, key):
+        return os.path.join(self.directory, key + SUFFIX)
+
+    def get(self, key):
+        """Returns the cached track_collection of key, or None."""
+        try:
+            with open(self.path(key), 'rb') as f:
+                collection = read_track_collection(f.read())
+            os.utime(self.path(key))
+        except FileNotFoundError:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return collection
+
+    def put(self, key, collection):
+        data = pack_tracks(collection)
+        # Written under a temporary name, so readers never see a partial file
+        temporary = self.path("%s.%s" % (key, uuid.uuid4().hex))
+        with open(temporary, 'wb') as f:
+            f.write(data)
+        if os.path.exists(self.path(key)):
+            self.nbytes -= os.path.getsize(self.path(key))
+        os.replace(temporary, self.path(key))
+        self.nbytes += len(data)
+        if self.nbytes > self.max_bytes:
+            self.evict()
+
+    def evict(self):
+        """Removes the least recently used results until the cache fits in max_bytes."""
+        entries = []
+        for path in self.paths():
+            try:
+                entries.append((os.path.getmtime(path), os.path.getsize(path), path))
+            except FileNotFoundError:
+                pass
+        entries.sort()
+        self.nbytes = sum(size for _, size, _ in entries)
+        for _, size, path in entries:
+            if self.nbytes <= self.max_bytes:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            self.nbytes -= size
+            self.evictions += 1
+
+    def solve(self, solver, event):
+        """The tracks of solver on event, from the cache if they are in it."""
+        key = self.key(solver, event)
+        collection = self.get(key)
+        if collection is None:
+            tracks = solver.solve(event)
+            self.put(key, em.track_collection.from_tracks(tracks, [h.id for h in event.hits]))
+            return tracks
+        return collection.to_tracks(event.hits)
+
+    def clear(self):
+        for path in self.paths():
+            os.remove(path)
+        self.nbytes = 0
+
+    def stats(self):
+        requests = self.hits + self.misses
+        return {"hits": self.hits, "misses": self.misses, "evictions": self.evictions,
+                "hit_rate": self.hits / requests if requests > 0 else 0.,
+                "entries": len(self.paths()), "bytes": self.nbytes}
+
+    def report(self):
+        stats = self.stats()
+        return "solver cache %s: %d hits, %d misses (hit rate %.1f%%), %d evictions, %d entries, %d bytes" % \
+               (self.directory, stats["hits"], stats["misses"], 100. * stats["hit_rate"], stats["evictions"],
+                stats["entries"], stats["bytes"])
+
+
+class cached_solver(object):
+    """Wraps solver, whose solve returns the cached tracks of events solved before."""
+    def __init__(self, solver, cache=None):
+        self.solver = solver
+        self.cache = cache if cache is not None else solver_cache()
+
+    def solve(self, event):
+        return self.cache.solve(self.solver, event)
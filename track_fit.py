@@ -0,0 +1,86 @@
+"""Straight line fits of many tracks at once.
+
+The tracks are given as a track_collection (offsets + hit indices) and the
+hit coordinate arrays of the event. Every track is fitted with
+x(z) = x + tx (z - z_ref), y(z) = y + ty (z - z_ref), z_ref being the mean
+z of its hits, by least squares in x and y separately. All the sums are
+segment sums (np.add.reduceat) over the flat hit arrays, so fitting
+thousands of candidates is a handful of array operations, and the quality of
+a track (chi2 / ndof) no longer depends on how it was built.
+"""
+import event_model as em
+import numpy as np
+
+
+# Hit resolution (mm) in x and y: the 55um pixel pitch over sqrt(12)
+HIT_ERROR = 0.055 / np.sqrt(12)
+
+
+class track_fits(object):
+    """Straight line fits of the tracks of collection, a track_collection of the hits with coordinates
+    hit_x, hit_y and hit_z.
+
+    n_hits, z (z_ref), x, y, tx, ty, chi2 and ndof are arrays with an element per track.
+    """
+    def __init__(self, collection, hit_x, hit_y, hit_z, hit_error=HIT_ERROR):
+        offsets = np.asarray(collection.offsets)
+        hit_indices = np.asarray(collection.hit_indices)
+        self.n_hits = np.diff(offsets)
+        self.ndof = 2 * self.n_hits - 4
+        n_tracks = len(self.n_hits)
+        self.z, self.x, self.y, self.tx, self.ty, self.chi2 = [np.zeros(n_tracks) for _ in range(6)]
+        fitted = self.n_hits > 0
+        if not fitted.any():
+            return
+
+        x, y, z = hit_x[hit_indices], hit_y[hit_indices], hit_z[hit_indices]
+        # reduceat over the first hit of the tracks with hits; empty tracks would repeat their neighbour
+        starts = offsets[:-1][fitted]
+        n = self.n_hits[fitted]
+        track = np.repeat(np.arange(len(n)), n)
+
+        def sums(values):
+            return np.add.reduceat(values, starts)
+
+        z_ref = sums(z) / n
+        dz = z - z_ref[track]
+        szz = sums(dz * dz)
+        # A track with all its hits at one z has no slope
+        szz_safe = np.where(szz > 0, szz, 1.)
+        chi2 = np.zeros(len(n))
+        for name, values in (("x", x), ("y", y)):
+            mean = sums(values) / n
+            slope = np.where(szz > 0, sums(dz * (values - mean[track])) / szz_safe, 0.)
+            residual = values - mean[track] - slope[track] * dz
+            chi2 += sums(residual * residual) / (hit_error * hit_error)
+            getattr(self, name)[fitted] = mean
+            getattr(self, "t" + name)[fitted] = slope
+        self.z[fitted] = z_ref
+        self.chi2[fitted] = chi2
+
+    @staticmethod
+    def from_tracks(tracks, hits, hit_error=HIT_ERROR):
+        """Fits of a list of tracks made of hits, the hit list of the event."""
+        hit_x, hit_y, hit_z = [np.array([getattr(h, c) for h in hits], dtype=float) for c in "xyz"]
+        return track_fits(em.track_collection.from_tracks(tracks, [h.id for h in hits]), hit_x, hit_y, hit_z, hit_error)
+
+    def __len__(self):
+        return len(self.n_hits)
+
+    def chi2_ndof(self):
+        """chi2 / ndof of each track, inf for the tracks of two hits or less (no degree of freedom)."""
+        return np.where(self.ndof > 0, self.chi2 / np.maximum(self.ndof, 1), np.inf)
+
+    def state_at(self, z):
+        """x, y, tx and ty of each track extrapolated to z (a scalar or an array with an element per track)."""
+        return self.x + self.tx * (z - self.z), self.y + self.ty * (z - self.z), self.tx, self.ty
+
+    def beamline_state(self):
+        """z of the closest approach of each track to the z axis, and its state there."""
+        t2 = self.tx * self.tx + self.ty * self.ty
+        dz = np.where(t2 > 0, -(self.x * self.tx + self.y * self.ty) / np.where(t2 > 0, t2, 1.), 0.)
+        return (self.z + dz,) + self.state_at(self.z + dz)
+
+    def ranking(self):
+        """Indices of the tracks from best to worst: longest first, then by chi2 / ndof."""
+        return np.lexsort((self.chi2_ndof(), -self.n_hits))
@@ -0,0 +1,51 @@
+"""Ghost and clone resolution of candidate tracks, shared by the solvers.
+
+Candidates are given as offsets and hit indices (like a track_collection),
+and the hits taken by accepted tracks are flagged in a dense used-hit bitmap
+indexed by hit, so checking a track costs one lookup per hit: the resolution
+is linear in the total number of hits, where the list membership tests it
+replaces were quadratic in the accepted hits.
+"""
+import numpy as np
+
+
+def hit_bitmap(n_hits):
+    """An empty used-hit bitmap of n_hits hits."""
+    return bytearray(n_hits)
+
+
+def ranking(lengths, chi2):
+    """Order of the tracks by decreasing length and then decreasing 1 / chi2, tracks that compare equal
+    keeping their order: the order of sorted(tracks, key=lambda t: (t.length, 1 / t.chi2), reverse=True).
+    """
+    lengths = np.asarray(lengths)
+    with np.errstate(divide='ignore', over='ignore'):
+        inverse = 1 / np.asarray(chi2, dtype=float)
+    return np.lexsort((np.arange(len(lengths)), -inverse, -lengths))
+
+
+def select_shared(offsets, hit_indices, order, lengths, used, max_shared=0.3):
+    """Goes through the tracks in order and accepts a track unless max_shared or more of its length
+    are hits already used, flagging the hits of the accepted tracks in used (a bitmap, see hit_bitmap).
+    Returns the accepted tracks, in order.
+    """
+    offsets, hits, lengths = np.asarray(offsets).tolist(), np.asarray(hit_indices).tolist(), np.asarray(lengths).tolist()
+    accepted = []
+    for t in np.asarray(order).tolist():
+        track_hits = hits[offsets[t]:offsets[t + 1]]
+        if sum(used[h] for h in track_hits) / lengths[t] < max_shared:
+            for h in track_hits:
+                used[h] = 1
+            accepted.append(t)
+    return accepted
+
+
+def select_weak(offsets, hit_indices, n_hits, min_length=4):
+    """The tracks of at least min_length hits, and the shorter ones that share no hit with them."""
+    offsets, hit_indices = np.asarray(offsets), np.asarray(hit_indices)
+    lengths = np.diff(offsets)
+    strong = lengths >= min_length
+    used = np.zeros(n_hits, dtype=bool)
+    used[hit_indices[np.repeat(strong, lengths)]] = True
+    shared = np.bincount(np.repeat(np.arange(len(lengths)), lengths), weights=used[hit_indices], minlength=len(lengths))
+    return np.flatnonzero(strong | (shared == 0))
@@ -0,0 +1,100 @@
+"""Two pass reconstruction: the straight tracks first, with tight windows, and the full solver on the hits left.
+
+Most high momentum tracks are nearly straight, and a classical_solver
+forwarding pass with tight tolerances finds them cheaply. Its tracks of at
+least min_length hits are kept and their hits marked as used; the second
+solver (CellularAutomaton or graph_dfs) then only sees the remaining hits
+(hit_filter.filter_event), which cuts its doublets and neighbours on busy
+events. The tracks of the two passes are returned together.
+
+compare validates both passes, their combination and the second solver on
+its own, with timing, and counts the doublets and neighbours of the hits
+the second pass is given against those of the whole event.
+"""
+from classical_solver import classical_solver
+from doublet_graph import doublet_graph
+from hit_filter import filter_event
+import event_model as em
+import validator_lite as vl
+import numpy as np
+import json
+import time
+
+
+TIGHT_CUTS = {"max_slopes": (0.4, 0.4), "max_tolerance": (0.1, 0.1), "max_scatter": 0.01}
+
+
+class two_pass_solver(object):
+    """Solves with first_pass (by default a classical_solver at TIGHT_CUTS), and solver on the hits
+    not used by the first pass tracks of at least min_length hits.
+    """
+    def __init__(self, solver, first_pass=None, min_length=4):
+        self.solver = solver
+        self.first_pass = first_pass if first_pass is not None else classical_solver(**TIGHT_CUTS)
+        self.min_length = min_length
+
+    def passes(self, event):
+        """Returns the tracks of the first pass, the tracks of the second pass, the event of the
+        hits left for the second pass and the time taken by each pass.
+        """
+        start = time.perf_counter()
+        first_tracks = [t for t in self.first_pass.solve(event) if len(t.hits) >= self.min_length]
+        used_hits = set(h.id for t in first_tracks for h in t.hits)
+        remaining = filter_event(event, np.array([h.id not in used_hits for h in event.hits], dtype=bool))
+        first_time = time.perf_counter() - start
+        start = time.perf_counter()
+        second_tracks = self.solver.solve(remaining)
+        return first_tracks, second_tracks, remaining, (first_time, time.perf_counter() - start)
+
+    def solve(self, event):
+        first_tracks, second_tracks, _, _ = self.passes(event)
+        return first_tracks + second_tracks
+
+
+def graph_size(event):
+    """The number of CellularAutomaton doublets and neighbours of event (doublet_graph, at the default cuts
+    of CellularAutomaton and graph_dfs), the work of the pair and triplet stages of the second solvers.
+    """
+    graph = doublet_graph(event)
+    doublets, neighbours = graph.cut(graph.max_slopes, graph.max_tolerance, graph.max_scatter)
+    return (sum(len(starts) for starts, _, _, _, _ in doublets),
+            sum(len(right) for layer in neighbours for _, right, _, _ in layer))
+
+
+def compare(paths, solver, particle_types=None, **parameters):
+    """Solves and validates the json event files in paths with a two_pass_solver of solver
+    and with solver alone. Returns the report, with all particle categories (or particle_types),
+    and the doublets and neighbours (graph_size) of the hits of the second pass and of the single pass.
+    """
+    two_pass = two_pass_solver(solver, **parameters)
+    names = ("first pass", "second pass", "two passes", "single pass")
+    accumulators = [vl.ValidationAccumulator(particle_types) for _ in names]
+    times = [0.] * len(names)
+    n_hits = n_remaining = 0
+    sizes = np.zeros((2, 2), dtype=int)
+    for path in paths:
+        with open(path) as f:
+            json_data = json.load(f)
+        validator_event = vl.parse_json_data(json_data)
+        event = em.event(json_data)
+        first_tracks, second_tracks, remaining, (first_time, second_time) = two_pass.passes(event)
+        n_hits += event.number_of_hits
+        n_remaining += remaining.number_of_hits
+        # Counted apart, so that the counting is not in the pass times
+        sizes += [graph_size(remaining), graph_size(em.event(json_data))]
+        start = time.perf_counter()
+        single_tracks = solver.solve(em.event(json_data))
+        for i, (tracks, elapsed) in enumerate(((first_tracks, first_time), (second_tracks, second_time),
+                                               (first_tracks + second_tracks, first_time + second_time),
+                                               (single_tracks, time.perf_counter() - start))):
+            accumulators[i].add_validator_event(validator_event, tracks)
+            times[i] += elapsed
+    lines = ["%d events, %d of %d hits left for the second pass (%.1f%%)" %
+             (len(paths), n_remaining, n_hits, 100. * n_remaining / n_hits if n_hits > 0 else 0.)]
+    for name, (n_doublets, n_neighbours) in zip(("second pass", "single pass"), sizes):
+        lines.append("%s: %d doublets, %d neighbours" % (name, n_doublets, n_neighbours))
+    lines.append("second pass / single pass: %.1f%% of the doublets, %.1f%% of the neighbours" %
+                 tuple(100. * second / single if single > 0 else 0. for second, single in zip(*sizes)))
+    for name, accumulator, elapsed in zip(names, accumulators, times):
+        lines.append("%s: %.2fs\n%s" % (name, elapsed, accumulator.report()))
+    return "\n".join(lines)
@@ -4,6 +4,21 @@ import errno
 import os
 import numpy as np
 import itertools
+import copy
+import json
+import multiprocessing
+
+
+particle_categories = [
+    ('velo', lambda p: p.isvelo and (abs(p.pid) != 11)),
+    ('long', lambda p: p.islong and (abs(p.pid) != 11)),
+    ('long>5GeV', lambda p: p.islong and p.over5 and (abs(p.pid) != 11)),
+    ('long_strange', lambda p: p.islong and p.strangelong and (abs(p.pid) != 11)),
+    ('long_strange>5GeV', lambda p: p.islong and p.over5 and p.strangelong and (abs(p.pid) != 11)),
+    ('long_fromb', lambda p: p.islong and p.fromb and (abs(p.pid) != 11)),
+    ('long_fromb>5GeV', lambda p: p.islong and p.over5 and p.fromb and (abs(p.pid) != 11))
+]
+particle_lambda = dict(particle_categories)
 
 
 class validator_event(object):
@@ -113,9 +128,14 @@ class Efficiency(object):
         self.n_events = 0
         self.n_heff = 0
         self.n_hits = 0
-        self.recoeff = []
-        self.purity = []
-        self.hiteff = []
+        # (# particles, # reconstructed) of each event: the event average efficiency averages the running
+        # efficiency after each event, which depends on the events before it, so merge has to replay them
+        self.event_counts = []
+        self.recoeff_sum = 0.0
+        self.purity_sum = 0.0
+        self.purity_events = 0
+        self.hiteff_sum = 0.0
+        self.hiteff_events = 0
         self.recoeffT= 0.0
         self.purityT = 0.0
         self.hiteffT = 0.0
@@ -125,26 +145,57 @@ class Efficiency(object):
         self.add_event(t2p, p2t, particles, event)
 
     def add_event(self, t2p, p2t, particles, event):
+        self.add_record(efficiency_record(t2p, p2t, particles, event))
+
+    def add_record(self, record):
+        """Adds the contribution of one event, as returned by efficiency_record."""
+        n_particles, n_reco, n_clones, pure, purity, heff, n_hits, hiteff = record
+        self.add_counts(n_particles, n_reco)
+        self.n_clones += n_clones
+        self.n_pure += pure
+        self.n_heff += heff
+        self.n_hits += n_hits
+        if hiteff is not None:
+            self.hiteff_sum += hiteff
+            self.hiteff_events += 1
+        if purity is not None:
+            self.purity_sum += purity
+            self.purity_events += 1
+        self.update()
+
+    def add_counts(self, n_particles, n_reco):
+        """Adds the particles and reconstructed particles of one event, and the running efficiency after it."""
+        self.event_counts.append((n_particles, n_reco))
         self.n_events += 1
-        self.n_particles += len(particles)
-        self.n_reco += len(reconstructed(p2t))
-        self.recoeff.append(1.*self.n_reco/self.n_particles)
-        self.n_clones += sum([len(t)-1 for t in list(clones(t2p).values())])
-        hit_eff = hit_efficinecy(t2p, event.hit_to_mcp, event.mcp_to_hits)
-        purities = [pp[0] for _, pp in iter(t2p.items()) if pp[1] is not None]
-        self.n_pure +=np.sum(purities)
-        self.n_heff +=np.sum(list(hit_eff.values()))
-        self.n_hits +=len(hit_eff)
-        if len(hit_eff) > 0: self.hiteff.append(np.mean(list(hit_eff.values())))
-        if len(purities) > 0: self.purity.append(np.mean(purities))
-        if len(self.recoeff) > 0: self.avg_recoeff = 100.*np.mean(self.recoeff)
-        if len(self.purity) > 0: self.avg_purity = 100.*np.mean(self.purity)
-        if len(self.hiteff) > 0: self.avg_hiteff = 100.*np.mean(self.hiteff)
+        self.n_particles += n_particles
+        self.n_reco += n_reco
+        self.recoeff_sum += 1.*self.n_reco/self.n_particles
+
+    def update(self):
+        if self.n_events > 0: self.avg_recoeff = 100.*self.recoeff_sum/self.n_events
+        if self.purity_events > 0: self.avg_purity = 100.*self.purity_sum/self.purity_events
+        if self.hiteff_events > 0: self.avg_hiteff = 100.*self.hiteff_sum/self.hiteff_events
         if self.n_particles > 0:
             self.recoeffT = 100. * self.n_reco / self.n_particles
         if self.n_reco > 0:
             self.purityT = 100. * self.n_pure / (self.n_reco + self.n_clones)
 
+    def merge(self, other):
+        """Adds the events of other. The sums are added; the event average efficiency is the one of a serial run
+        if the events of other come after those of self.
+        """
+        for n_particles, n_reco in other.event_counts:
+            self.add_counts(n_particles, n_reco)
+        self.n_clones += other.n_clones
+        self.n_pure += other.n_pure
+        self.n_heff += other.n_heff
+        self.n_hits += other.n_hits
+        self.purity_sum += other.purity_sum
+        self.purity_events += other.purity_events
+        self.hiteff_sum += other.hiteff_sum
+        self.hiteff_events += other.hiteff_events
+        self.update()
+
     def __str__(self):
         clone_percentage = 0
         if self.n_reco > 0: clone_percentage = 100.*self.n_clones/self.n_reco
@@ -177,6 +228,30 @@ def update_efficiencies(eff, event, tracks, weights, label, cond):
         eff.add_event(t2p, p2t, particles_filtered, event)
     return eff
 
+def merge_efficiencies(eff, other):
+    """Merges Efficiency other into eff, either of which may be None."""
+    if other is None:
+        return eff
+    if eff is None:
+        return copy.deepcopy(other)
+    eff.merge(other)
+    return eff
+
+def efficiency_record(t2p, p2t, particles, event):
+    """
+    Contribution of one event to an Efficiency, as a tuple of plain numbers:
+    (# particles, # reconstructed, # clones, sum of purities, mean purity,
+    sum of hit efficiencies, # hit efficiencies, mean hit efficiency).
+    The means are None when the event has no associated tracks.
+    """
+    hit_eff = hit_efficinecy(t2p, event.hit_to_mcp, event.mcp_to_hits)
+    purities = [pp[0] for _, pp in iter(t2p.items()) if pp[1] is not None]
+    return (len(particles), len(reconstructed(p2t)),
+        sum([len(t)-1 for t in list(clones(t2p).values())]),
+        np.sum(purities), np.mean(purities) if len(purities) > 0 else None,
+        np.sum(list(hit_eff.values())), len(hit_eff),
+        np.mean(list(hit_eff.values())) if len(hit_eff) > 0 else None)
+
 def comp_weights(tracks, event):
     """
     Compute w(t,p)
@@ -227,7 +302,7 @@ def hit_purity(tracks, particles, weights):
             # store the weight anyway but don't associate a particle since this
             # track has no particle associated (i.e. it is a ghost)
             t2p[tracks[i]] = (wtp, None)
-    for i in range(len(particles)):
+    for i in range(len(particles) if len(tracks) > 0 else 0):
         wtp, nwtp = np.max(weights[:,i]), np.argmax(weights[:,i])
         if wtp > 0.7:
             p2t[particles[i]] = (wtp, tracks[nwtp])
@@ -286,61 +361,118 @@ def ghost_rate(t2p):
     "Returns the fraction of unassociated tracks (fake tracks) and number of ghosts"
     ntracks = len(t2p.keys())
     nghosts = len(ghosts(t2p))
-    return float(nghosts)/ntracks, nghosts
+    return float(nghosts)/ntracks if ntracks > 0 else 0., nghosts
 
-def validate_print(events_json_data, tracks_list):
-    tracking_data = []
-    for event, tracks in zip(events_json_data, tracks_list):
-        tracking_data.append((parse_json_data(event), tracks))
-
-    n_tracks = 0
-    avg_ghost_rate = 0.0
-    n_allghsots = 0
-    eff_velo = None
-    eff_long = None
-    eff_long5 = None
-    eff_long_strange = None
-    eff_long_strange5 = None
-    eff_long_fromb = None
-    eff_long_fromb5 = None
-    for event, tracks in tracking_data:
-        n_tracks += len(tracks)
+class ValidationAccumulator(object):
+    """Incremental validation of a stream of events.
+
+    (event, tracks) pairs are fed one at a time with add_event; the event is
+    parsed, its contribution added to the ghost rate and Efficiency sums, and
+    it is released right away. Accumulators of disjoint runs of events (eg.
+    from parallel workers) can be combined with merge, which adds the sums.
+    Only the event average efficiency (see Efficiency.event_counts) depends
+    on the order of the runs, so they are merged in event order to match a
+    serial run exactly.
+
+    particle_types restricts the Efficiency categories that are computed,
+    by default all of particle_categories.
+    """
+    def __init__(self, particle_types=None):
+        if particle_types is None:
+            particle_types = [label for label, _ in particle_categories]
+        self.particle_types = list(particle_types)
+        self.efficiencies = {label: None for label in self.particle_types}
+        self.n_events = 0
+        self.n_tracks = 0
+        self.n_ghosts = 0
+        self.ghost_rate_sum = 0.
+
+    def add_event(self, json_data, tracks):
+        """Validates the tracks of the event described by json_data."""
+        self.add_validator_event(parse_json_data(json_data), tracks)
+
+    def add_validator_event(self, event, tracks):
+        """Validates the tracks of an already parsed validator_event."""
         weights = comp_weights(tracks, event)
         t2p, _ = hit_purity(tracks, event.particles, weights)
         grate, nghosts = ghost_rate(t2p)
-        n_allghsots += nghosts
-        avg_ghost_rate += grate
-        eff_velo = update_efficiencies(eff_velo, event, tracks, weights, 'velo'
-                    , lambda p: p.isvelo and (abs(p.pid) != 11))
-        eff_long = update_efficiencies(eff_long, event, tracks, weights, 'long'
-                    , lambda p: p.islong and (abs(p.pid) != 11))
-        eff_long5 = update_efficiencies(eff_long5, event, tracks, weights, 'long>5GeV'
-                    , lambda p: p.islong and p.over5 and (abs(p.pid) != 11))
-        eff_long_strange = update_efficiencies(eff_long_strange, event, tracks, weights, 'long_strange'
-                    , lambda p: p.islong and p.strangelong and (abs(p.pid) != 11))
-        eff_long_strange5 = update_efficiencies(eff_long_strange5, event, tracks, weights, 'long_strange>5GeV'
-                    , lambda p: p.islong and p.over5 and p.strangelong and (abs(p.pid) != 11))
-        eff_long_fromb = update_efficiencies(eff_long_fromb, event, tracks, weights, 'long_fromb'
-                    , lambda p: p.islong and p.fromb and (abs(p.pid) != 11))
-        eff_long_fromb5 = update_efficiencies(eff_long_fromb5, event, tracks, weights, 'long_fromb>5GeV'
-                    , lambda p: p.islong and p.over5 and p.fromb and (abs(p.pid) != 11))
-
-    nevents = len(tracking_data)
-    # print("me test printing: ", n_tracks, n_allghsots, 100.*avg_ghost_rate/nevents, )
-
-    #print("Average reconstruction efficiency: %6.2f%% (%d #tracks of %d reconstructible particles)"%(100*avg_recoeff/nevents, n_allreco, n_allparticles))
-    print("%d tracks including %8d ghosts (%5.1f%%). Event average %5.1f%%"
-        %(n_tracks, n_allghsots, 100.*n_allghsots/n_tracks, 100.*avg_ghost_rate/nevents))
-    #print("Number of clones: %d"%n_clones)
-    #print("Average hit purity: %6.2f%%"%(100*avg_purity/nevents))
-    #print("Average hit efficiency: %6.2f%%"%(100*avg_hiteff/nevents))
-    print(eff_velo)
-    print(eff_long)
-    print(eff_long5)
-    print(eff_long_strange)
-    print(eff_long_strange5)
-    print(eff_long_fromb)
-    print(eff_long_fromb5)
+        self.n_events += 1
+        self.n_tracks += len(tracks)
+        self.n_ghosts += nghosts
+        self.ghost_rate_sum += grate
+        for label in self.particle_types:
+            self.efficiencies[label] = update_efficiencies(self.efficiencies[label],
+                event, tracks, weights, label, particle_lambda[label])
+
+    def merge(self, other):
+        """Adds the events of other. If they come after the events already added to self,
+        the result is the same as validating serially.
+        """
+        self.n_events += other.n_events
+        self.n_tracks += other.n_tracks
+        self.n_ghosts += other.n_ghosts
+        self.ghost_rate_sum += other.ghost_rate_sum
+        for label in self.particle_types:
+            self.efficiencies[label] = merge_efficiencies(self.efficiencies[label],
+                other.efficiencies.get(label))
+        return self
+
+    def efficiency(self, particle_type="long>5GeV"):
+        """Returns the Efficiency object of particle_type, None if no such particle was seen."""
+        return self.efficiencies[particle_type]
+
+    def ghost_fraction(self):
+        return self.n_ghosts / self.n_tracks if self.n_tracks > 0 else 0.
+
+    def report(self):
+        """Returns the validate_print report of the events added so far."""
+        lines = ["%d tracks including %8d ghosts (%5.1f%%). Event average %5.1f%%"
+            %(self.n_tracks, self.n_ghosts, 100.*self.n_ghosts/self.n_tracks,
+            100.*self.ghost_rate_sum/self.n_events)]
+        for label in self.particle_types:
+            lines.append(str(self.efficiencies[label]))
+        return "\n".join(lines)
+
+    def print_report(self):
+        print(self.report())
+
+def validate_print(events_json_data, tracks_list):
+    accumulator = ValidationAccumulator()
+    for event, tracks in zip(events_json_data, tracks_list):
+        accumulator.add_event(event, tracks)
+    accumulator.print_report()
+
+def validate_chunk(particle_types, chunk):
+    """Validates a list of (event, tracks) pairs into a fresh ValidationAccumulator.
+    The event is either its json data or the path of its json file.
+    """
+    accumulator = ValidationAccumulator(particle_types)
+    for json_data, tracks in chunk:
+        if isinstance(json_data, str):
+            with open(json_data) as f:
+                json_data = json.loads(f.read())
+        accumulator.add_event(json_data, tracks)
+    return accumulator
+
+def _validate_chunk(args):
+    return validate_chunk(*args)
+
+def validate_parallel(events_json_data, tracks_list, processes=None, chunksize=4, particle_types=None):
+    '''Validates the events on a pool of processes.
+
+    Events are sent to the workers in chunks of chunksize (json data or
+    json file paths, together with their tracks). Each worker returns the
+    partial ValidationAccumulator of its chunk, and these are merged in
+    event order, so the result is exactly the one of validate_print.
+    Returns the merged ValidationAccumulator.
+    '''
+    pairs = iter(zip(events_json_data, tracks_list))
+    chunks = iter(lambda: list(itertools.islice(pairs, chunksize)), [])
+    accumulator = ValidationAccumulator(particle_types)
+    with multiprocessing.Pool(processes) as pool:
+        for partial in pool.imap(_validate_chunk, ((particle_types, chunk) for chunk in chunks)):
+            accumulator.merge(partial)
+    return accumulator
 
 def validate(events_json_data, tracks_list, particle_type="long>5GeV"):
     '''Returns just the Efficiency object of the particle_type requested.
@@ -348,27 +480,11 @@ def validate(events_json_data, tracks_list, particle_type="long>5GeV"):
     particle_type can be one of {'velo', 'long', 'long>5GeV', 'long_strange',
     'long_strange>5GeV', 'long_fromb', 'long_fromb>5GeV'}.
     '''
-    tracking_data = []
+    accumulator = ValidationAccumulator([particle_type])
     for event, tracks in zip(events_json_data, tracks_list):
-        tracking_data.append((parse_json_data(event), tracks))
-
-    particle_lambda = {
-        'velo': lambda p: p.isvelo and (abs(p.pid) != 11),
-        'long': lambda p: p.islong and (abs(p.pid) != 11),
-        'long>5GeV': lambda p: p.islong and p.over5 and (abs(p.pid) != 11),
-        'long_strange': lambda p: p.islong and p.strangelong and (abs(p.pid) != 11),
-        'long_strange>5GeV': lambda p: p.islong and p.over5 and p.strangelong and (abs(p.pid) != 11),
-        'long_fromb': lambda p: p.islong and p.fromb and (abs(p.pid) != 11),
-        'long_fromb>5GeV': lambda p: p.islong and p.over5 and p.fromb and (abs(p.pid) != 11)
-    }
-
-    eff = None
-    for event, tracks in tracking_data:
-        weights = comp_weights(tracks, event)
-        eff = update_efficiencies(eff, event, tracks, weights, particle_type,
-            particle_lambda[particle_type])
+        accumulator.add_event(event, tracks)
 
-    return eff
+    return accumulator.efficiency(particle_type)
 
 def validate_efficiency(events_json_data, tracks_list, particle_type="long>5GeV"):
     '''Returns just the Reconstruction Efficiency of the particle_type requested,
@@ -387,19 +503,8 @@ def validate_ghost_fraction(events_json_data, tracks_list):
     '''Returns just the Clone Fraction of the particle_type requested,
     as a value in [0, 1].
     '''
-    tracking_data = []
+    accumulator = ValidationAccumulator([])
     for event, tracks in zip(events_json_data, tracks_list):
-        tracking_data.append((parse_json_data(event), tracks))
-
-    n_tracks = 0
-    avg_ghost_rate = 0.0
-    n_allghsots = 0
-    for event, tracks in tracking_data:
-        n_tracks += len(tracks)
-        weights = comp_weights(tracks, event)
-        t2p, _ = hit_purity(tracks, event.particles, weights)
-        grate, nghosts = ghost_rate(t2p)
-        n_allghsots += nghosts
-        avg_ghost_rate += grate
+        accumulator.add_event(event, tracks)
 
-    return n_allghsots / n_tracks
+    return accumulator.ghost_fraction()
@@ -0,0 +1,118 @@
+"""Solves the two VELO halves of an event in parallel.
+
+The even and odd sensors form the two sides of the detector, and most tracks
+live on one side only. halves_solver hands the event to two workers through
+shared memory, each one solving only the hits of its side, and merges the
+two track lists. Tracks crossing between the halves come back as one piece
+per side; the merge stage stitches together pieces that lie on the same
+straight line.
+
+No latency gain is claimed: it has not been measured on two cores, and each
+solve pays for the shared memory hand-over, the event build of each worker
+and the stitching on top of the solve of the larger half.
+"""
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import resource_tracker
+from shared_event import shared_event, solve_shared, read_tracks, discard_block
+from event_model import track
+import numpy as np
+import os
+import uuid
+
+
+def fit_lines(tracks):
+    """Straight line fits x = x0 + tx * z, y = y0 + ty * z of each track.
+    Returns an array with a row (x0, tx, y0, ty) per track.
+    """
+    lines = np.zeros((len(tracks), 4))
+    for i, t in enumerate(tracks):
+        z = np.array([h.z for h in t.hits])
+        tx, x0 = np.polyfit(z, [h.x for h in t.hits], 1)
+        ty, y0 = np.polyfit(z, [h.y for h in t.hits], 1)
+        lines[i] = (x0, tx, y0, ty)
+    return lines
+
+
+def max_residuals(lines, tracks):
+    """Matrix of the largest x or y distance between each line and the hits of each track."""
+    hits = [h for t in tracks for h in t.hits]
+    offsets = np.cumsum([0] + [len(t.hits) for t in tracks[:-1]])
+    x = np.array([h.x for h in hits])
+    y = np.array([h.y for h in hits])
+    z = np.array([h.z for h in hits])
+    dx = np.abs(lines[:, 0:1] + lines[:, 1:2] * z - x)
+    dy = np.abs(lines[:, 2:3] + lines[:, 3:4] * z - y)
+    return np.maximum.reduceat(np.maximum(dx, dy), offsets, axis=1)
+
+
+def stitch_tracks(tracks_0, tracks_1, max_tolerance=0.4):
+    """Joins pairs of tracks, one of each half, whose hits all lie within
+    max_tolerance of the line fitted to the other track. Each track is joined
+    at most once, best matching pairs first. Returns the merged list of tracks.
+    """
+    if len(tracks_0) == 0 or len(tracks_1) == 0:
+        return tracks_0 + tracks_1
+    residuals = np.maximum(max_residuals(fit_lines(tracks_0), tracks_1),
+                           max_residuals(fit_lines(tracks_1), tracks_0).T)
+    stitched_0 = set()
+    stitched_1 = set()
+    stitched = []
+    for i, j in zip(*np.unravel_index(np.argsort(residuals, axis=None), residuals.shape)):
+        if residuals[i, j] >= max_tolerance:
+            break
+        if i not in stitched_0 and j not in stitched_1:
+            stitched_0.add(i)
+            stitched_1.add(j)
+            hits = sorted(tracks_0[i].hits + tracks_1[j].hits, key=lambda h: h.z, reverse=True)
+            stitched.append(track(hits, len(hits)))
+    return [t for i, t in enumerate(tracks_0) if i not in stitched_0] + \
+           [t for j, t in enumerate(tracks_1) if j not in stitched_1] + stitched
+
+
+class halves_solver(object):
+    """Solves each VELO half of an event with solver, on its own worker,
+    and merges the results.
+
+    executor: a concurrent.futures executor with (at least) two workers,
+      by default a pool of two processes, which shutdown (or leaving a with
+      block) shuts down. An executor that is passed in is left to the caller.
+    stitch: whether crossing tracks are stitched together. Solvers that never
+      form tracks across halves (CellularAutomaton, graph_dfs with
+      allow_cross_track=False) give the serial result when it is off.
+    """
+    def __init__(self, solver, executor=None, stitch=True, max_tolerance=0.4):
+        self.solver = solver
+        self.stitch = stitch
+        self.max_tolerance = max_tolerance
+        self.owns_executor = executor is None
+        if executor is None:
+            resource_tracker.ensure_running()
+            executor = ProcessPoolExecutor(2)
+        self.executor = executor
+
+    def solve(self, event):
+        prefix = "velo%d_%s" % (os.getpid(), uuid.uuid4().hex[:8])
+        result_names = ["%s_h%d" % (prefix, side) for side in (0, 1)]
+        try:
+            with shared_event.create(event, prefix + "_e") as shared:
+                futures = [self.executor.submit(solve_shared, self.solver, shared.name, result_names[side], side)
+                           for side in (0, 1)]
+                for future in futures:
+                    future.result()
+            halves = [read_tracks(name).to_tracks(event.hits) for name in result_names]
+        finally:
+            for name in result_names:
+                discard_block(name)
+        if self.stitch:
+            return stitch_tracks(halves[0], halves[1], self.max_tolerance)
+        return halves[0] + halves[1]
+
+    def shutdown(self):
+        if self.owns_executor:
+            self.executor.shutdown()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.shutdown()